@@ -0,0 +1,133 @@
+"""
+Benchmarks of the hot paths, in the asv format: each time_* method is timed
+for every combination of params, after setup is called with the same
+params. Run them with asv, or with python -m benchmarks.run, which also
+records the peak memory and compares against a stored baseline.
+
+quick_params is a smaller set of params for python -m benchmarks.run --quick.
+"""
+import numpy as np
+from spyctra import (arPLS, arPLS_batch, AsLS, airPLS, drPLS, iarPLS, remove_cosmics,
+        multifit, fit_batch, lorentz, gaussian, voigt)
+
+from .synthetic import raman_spectra
+
+
+class Baseline(object):
+    params = [[512, 4096, 65536]]
+    param_names = ['N']
+    quick_params = [[512, 4096]]
+
+    def setup(self, N):
+        self.x, Y, _ = raman_spectra(1, N, cosmics=0.)
+        self.y = Y[0]
+
+    def time_arPLS(self, N):
+        arPLS(self.y, lambda_=1.e7)
+
+
+class BaselineIterations(object):
+    """
+    arPLS run for a fixed number of iterations. The iterations reuse the same
+    buffers, so the peak memory should not grow with itermax.
+    """
+    params = [[65536], [5, 50]]
+    param_names = ['N', 'itermax']
+    quick_params = [[65536], [5, 50]]
+
+    def setup(self, N, itermax):
+        self.x, Y, _ = raman_spectra(1, N, cosmics=0.)
+        self.y = Y[0]
+        # build the cached penalty outside of the measurement
+        arPLS(self.y, lambda_=1.e7, itermax=0)
+
+    def time_arPLS(self, N, itermax):
+        arPLS(self.y, lambda_=1.e7, ratio=0., itermax=itermax)
+
+    def peakmem_arPLS(self, N, itermax):
+        arPLS(self.y, lambda_=1.e7, ratio=0., itermax=itermax)
+
+
+class BaselineBatch(object):
+    params = [[1, 100, 10000, 100000], [1024]]
+    param_names = ['M', 'N']
+    quick_params = [[1, 100], [1024]]
+
+    def setup(self, M, N):
+        self.x, self.Y, _ = raman_spectra(M, N, cosmics=0.)
+
+    def time_arPLS_batch(self, M, N):
+        arPLS_batch(self.Y, lambda_=1.e7)
+
+
+class BaselineFamily(object):
+    params = [['arPLS', 'AsLS', 'airPLS', 'drPLS', 'iarPLS'], [100], [1024]]
+    param_names = ['method', 'M', 'N']
+    quick_params = [['arPLS', 'AsLS', 'airPLS', 'drPLS', 'iarPLS'], [100], [1024]]
+
+    def setup(self, method, M, N):
+        self.x, self.Y, _ = raman_spectra(M, N, cosmics=0.)
+        self.method = {'arPLS': arPLS_batch, 'AsLS': AsLS, 'airPLS': airPLS,
+                'drPLS': drPLS, 'iarPLS': iarPLS}[method]
+
+    def time_baseline(self, method, M, N):
+        self.method(self.Y)
+
+
+class Cosmics(object):
+    params = [[1, 1000, 100000], [512, 4096]]
+    param_names = ['M', 'N']
+    quick_params = [[1, 1000], [512]]
+
+    def setup(self, M, N):
+        self.x, self.Y, _ = raman_spectra(M, N)
+
+    def time_remove_cosmics(self, M, N):
+        remove_cosmics(self.Y, copy=True)
+
+
+class LineShapes(object):
+    params = [[1, 10, 100], [512, 65536]]
+    param_names = ['peaks', 'N']
+    quick_params = [[1, 10, 100], [512]]
+
+    def setup(self, peaks, N):
+        self.x = np.linspace(100., 3200., N)
+        self.params = raman_spectra(1, 16, peaks)[2]
+        self.voigt_params = np.column_stack((self.params[:, :1], self.params))
+
+    def time_lorentz(self, peaks, N):
+        lorentz(self.params, self.x)
+
+    def time_gaussian(self, peaks, N):
+        gaussian(self.params, self.x)
+
+    def time_voigt(self, peaks, N):
+        voigt(self.voigt_params, self.x)
+
+
+class Multifit(object):
+    params = [[1, 10]]
+    param_names = ['peaks']
+    quick_params = [[1, 3]]
+
+    def setup(self, peaks):
+        self.x, Y, self.params = raman_spectra(1, 1024, peaks, cosmics=0.)
+        self.y = lorentz(self.params, self.x) + np.random.RandomState(1).standard_normal(1024)
+
+    def time_multifit(self, peaks):
+        multifit(lorentz, self.x, self.y, np.ones_like(self.y), self.params*1.01, iterations=20, seed=0)
+
+
+class FitBatch(object):
+    params = [[100, 10000], [1, 10]]
+    param_names = ['M', 'peaks']
+    quick_params = [[100], [1, 3]]
+
+    def setup(self, M, peaks):
+        self.x, Y, self.params = raman_spectra(M, 1024, peaks, cosmics=0.)
+        rng = np.random.RandomState(1)
+        self.Y = lorentz(self.params, self.x)*rng.uniform(0.5, 1.5, (M, 1)) + rng.standard_normal((M, 1024))
+
+    def time_fit_batch(self, M, peaks):
+        fit_batch(lorentz, self.x, self.Y, self.params*1.01)
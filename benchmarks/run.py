@@ -0,0 +1,151 @@
+"""
+Run the benchmarks without asv, recording the time and the peak memory of
+each, and compare them against a stored baseline.
+
+Usage:
+    python -m benchmarks.run --quick --save baseline.json
+    # ... change the code ...
+    python -m benchmarks.run --quick --compare baseline.json
+
+The time is the best of several calls. The peak memory is the largest
+amount of memory allocated through Python and NumPy during one more call,
+untimed, as traced by tracemalloc. The exit status is 1 if any benchmark regressed by
+more than the tolerances.
+"""
+import argparse
+import inspect
+import itertools
+import json
+import re
+import sys
+import time
+import tracemalloc
+
+from . import benchmarks
+
+
+def discover():
+    """
+    :returns: List of the benchmark classes, which have time_* methods.
+    """
+    classes = []
+    for name, cls in inspect.getmembers(benchmarks, inspect.isclass):
+        if cls.__module__ == benchmarks.__name__ and any(m.startswith('time_') for m in dir(cls)):
+            classes.append(cls)
+    return classes
+
+
+def _name(cls, method, names, values):
+    arguments = ', '.join('{0}={1}'.format(n, v) for n, v in zip(names, values))
+    return '{0}.{1}({2})'.format(cls.__name__, method, arguments)
+
+
+def measure(func, repeat=5, budget=2.):
+    """
+    :returns: (best time of up to repeat calls in seconds, peak traced memory
+                of one call in bytes). The peak memory is taken in a
+                separate call that is not timed, as tracing slows the calls
+                down. Timed calls stop once they take more than budget
+                seconds in total.
+    """
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best = float('inf')
+    total = 0.
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+        if total > budget:
+            break
+    return best, peak
+
+
+def run(quick=False, pattern=None, repeat=5, budget=2., log=None):
+    """
+    Run the benchmarks.
+
+    :param quick: (Optional) True to use the quick_params of each class.
+    :param pattern: (Optional) Regular expression, only benchmarks with a
+                matching name are run.
+    :param repeat: (Optional) Maximum number of timed calls per benchmark.
+    :param budget: (Optional) Seconds of calls after which timing stops.
+    :param log: (Optional) File to print each result to as it is done.
+    :returns: dict of name -> {'time': seconds, 'peak_memory': bytes}
+    """
+    results = {}
+    for cls in discover():
+        params = cls.quick_params if quick else cls.params
+        methods = sorted(m for m in dir(cls) if m.startswith('time_'))
+        for values in itertools.product(*params):
+            names = [_name(cls, method, cls.param_names, values) for method in methods]
+            if pattern is not None and not any(re.search(pattern, name) for name in names):
+                continue
+            benchmark = cls()
+            benchmark.setup(*values)
+            for method, name in zip(methods, names):
+                if pattern is not None and not re.search(pattern, name):
+                    continue
+                func = getattr(benchmark, method)
+                seconds, peak = measure(lambda: func(*values), repeat, budget)
+                results[name] = {'time': seconds, 'peak_memory': peak}
+                if log is not None:
+                    print('{0:<55} {1:>12.6f} s {2:>10.1f} MB'.format(name, seconds, peak/1e6), file=log)
+    return results
+
+
+def compare(results, baseline, time_tolerance=0.2, memory_tolerance=0.1):
+    """
+    :returns: List of (name, quantity, baseline value, new value) of the
+                regressions, benchmarks more than the tolerance slower or
+                larger than in baseline.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for quantity, tolerance in (('time', time_tolerance), ('peak_memory', memory_tolerance)):
+            old, new = baseline[name][quantity], result[quantity]
+            if new > old*(1 + tolerance):
+                regressions.append((name, quantity, old, new))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the spyctra benchmarks.')
+    parser.add_argument('--quick', action='store_true', help='run the smaller quick_params')
+    parser.add_argument('--filter', dest='pattern', help='regular expression of the benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=5, help='maximum timed calls per benchmark (default: 5)')
+    parser.add_argument('--save', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON file of baseline results to compare against')
+    parser.add_argument('--time-tolerance', type=float, default=0.2,
+            help='allowed relative slow down (default: 0.2)')
+    parser.add_argument('--memory-tolerance', type=float, default=0.1,
+            help='allowed relative increase of the peak memory (default: 0.1)')
+    args = parser.parse_args(argv)
+
+    results = run(args.quick, args.pattern, args.repeat, log=sys.stdout)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+        for name, quantity, old, new in regressions:
+            print('REGRESSION {0} {1}: {2:.6g} -> {3:.6g} ({4:+.0%})'.format(name, quantity, old, new, new/old - 1))
+        if regressions:
+            return 1
+        print('No regressions against {0}'.format(args.compare))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
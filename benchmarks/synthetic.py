@@ -0,0 +1,42 @@
+"""
+Synthetic Raman spectra for the benchmarks.
+"""
+import numpy as np
+from spyctra import lorentz
+
+
+def peak_params(n_peaks, x, seed=0):
+    """
+    Random lorentzian peaks inside x, as a (n_peaks, 3) array of
+    [gamma, xo, amplitude].
+    """
+    rng = np.random.RandomState(seed)
+    span = x[-1] - x[0]
+    gamma = span*rng.uniform(0.002, 0.01, n_peaks)
+    xo = rng.uniform(x[0] + 0.05*span, x[-1] - 0.05*span, n_peaks)
+    amplitude = rng.uniform(20., 200., n_peaks)
+    return np.column_stack((gamma, xo, amplitude))
+
+
+def raman_spectra(M, N, n_peaks=10, cosmics=0.001, noise=1., seed=0):
+    """
+    M spectra of N points between 100 and 3200 cm-1: the same lorentzian peaks
+    in every spectrum with random intensity, on a smooth fluorescence
+    background, with normal noise and cosmic ray spikes.
+
+    :param cosmics: (Optional) Fraction of the points hit by a cosmic ray.
+    :returns: (x, (M, N) spectra, (n_peaks, 3) peak parameters)
+    """
+    rng = np.random.RandomState(seed)
+    x = np.linspace(100., 3200., N)
+    params = peak_params(n_peaks, x, seed)
+
+    t = (x - x[0])/(x[-1] - x[0])
+    background = 500.*np.exp(-2.*t) + 200.*t
+    Y = lorentz(params, x) * rng.uniform(0.5, 1.5, (M, 1))
+    Y += background * rng.uniform(0.8, 1.2, (M, 1))
+    Y += noise*rng.standard_normal((M, N))
+
+    hits = rng.random_sample((M, N)) < cosmics
+    Y[hits] += rng.uniform(1000., 10000., hits.sum())
+    return x, Y, params
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from distutils.core import setup
+from setuptools import setup
 
 setup(name='spyctra',
         version='0.1.0',
@@ -13,4 +13,9 @@ setup(name='spyctra',
             "numpy",
             "scipy",
             ],
+        entry_points={
+            'console_scripts': [
+                'spyctra = spyctra.cli:main',
+                ],
+            },
         )
@@ -1,7 +1,65 @@
-from .baseline import arPLS
+"""
+Helper tools for analyzing Raman and other spectroscopy data.
 
-from .functions import lorentz, gaussian
+The public names are imported from their modules on first use (PEP 562), so
+importing spyctra is fast, and e.g. using only gaussian never imports the
+baseline or fitting code, or SciPy.
+"""
+import importlib
 
-from .fitting import multifit
+# Module of each public name, relative to spyctra.
+_NAMES = {
+    'arPLS': 'baseline',
+    'arPLS_batch': 'baseline',
+    'arPLS_stream': 'baseline',
+    'arPLS2d': 'baseline',
+    'arPLSnd': 'baseline',
+    'AsLS': 'baseline',
+    'airPLS': 'baseline',
+    'drPLS': 'baseline',
+    'iarPLS': 'baseline',
 
-from .cosmics import remove_cosmics
+    'lorentz': 'functions',
+    'gaussian': 'functions',
+    'voigt': 'functions',
+    'pseudo_voigt': 'functions',
+    'lorentz_jac': 'functions',
+    'gaussian_jac': 'functions',
+    'voigt_jac': 'functions',
+    'pseudo_voigt_jac': 'functions',
+
+    'multifit': 'fitting',
+    'fit_batch': 'fitting',
+
+    'remove_cosmics': 'cosmics',
+    'remove_cosmics_multi': 'cosmics',
+
+    'find_peaks': 'peaks',
+
+    'SpectralCube': 'cube',
+
+    'Pipeline': 'pipeline',
+}
+
+# Submodules that can be used as attributes of spyctra without importing them.
+_MODULES = ('baseline', 'functions', 'fitting', 'cosmics', 'peaks', 'cube', 'pipeline',
+        'parallel', 'instrument', 'cli')
+
+__all__ = sorted(_NAMES) + ['instrument']
+
+
+def __getattr__(name):
+    if name in _NAMES:
+        module = importlib.import_module('.' + _NAMES[name], __name__)
+        value = getattr(module, name)
+    elif name in _MODULES:
+        value = importlib.import_module('.' + name, __name__)
+    else:
+        raise AttributeError("module '{0}' has no attribute '{1}'".format(__name__, name))
+    # cache it, so __getattr__ is not called again for this name
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_NAMES) | set(_MODULES))
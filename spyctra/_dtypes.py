@@ -0,0 +1,38 @@
+"""
+The floating point type of the numerics in baseline, cosmics and functions.
+
+Their dtype parameter defaults to following the data: float32 data (and
+smaller floats) is processed and returned as float32, anything else,
+including integer detector counts, as float64. Integer input is converted a
+chunk at a time, never copied whole to float64.
+
+float32 is only used where it is numerically safe:
+  - lorentz, gaussian, voigt, pseudo_voigt are evaluated in float32. The
+    error is about 1e-7 * |x| / width of the peak height, e.g. below 1e-4 of
+    the amplitude for peaks wider than 5 at x up to 3200.
+  - arPLS always solves in float64, because (W + H) has a condition number of
+    about 16*lambda_, too much for float32. Only the baselines and weights
+    are stored in float32, so they are the float64 result rounded to float32,
+    within a relative 1e-7.
+  - remove_cosmics computes the curvature in float32. Points within a
+    relative 1e-7 of max_curvature may be flagged differently, all others
+    give the float64 result rounded to float32.
+"""
+import numpy as np
+
+
+def float_dtype(dtype, data=None):
+    """
+    :param dtype: The requested floating point type, or None to follow data.
+    :param data: The input of the calculation.
+    :returns: The numpy floating point type to calculate in.
+    """
+    if dtype is None:
+        dtype = getattr(data, 'dtype', None)
+        if dtype is None or dtype.kind != 'f':
+            return np.dtype(float)
+        return np.dtype(np.float32) if dtype.itemsize <= 4 else np.dtype(float)
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'f':
+        raise ValueError("Unknown dtype '{0}', expected a floating point type".format(dtype))
+    return dtype
@@ -1,9 +1,634 @@
 import numpy as np
-from scipy.sparse import csc_matrix, eye, diags
-from scipy.sparse.linalg import spsolve
 import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
 
-def arPLS(y, lambda_=5.e5, ratio=1.e-6, itermax=50, log=False):
+from . import instrument
+from ._dtypes import float_dtype
+
+# Available linear solvers for the penalized least squares system (W + H) z = W y.
+#   'banded'  : H is kept in symmetric banded form and the system is solved with
+#               a banded Cholesky decomposition. O(N) per iteration.
+#   'spsolve' : Reference implementation using a general sparse LU solve.
+#   'cg'      : Preconditioned conjugate gradients, started from the previous
+#               baseline. Only the band of H is kept, so memory is O(N) and no
+#               factor is ever formed.
+SOLVERS = ('banded', 'spsolve', 'cg')
+
+# Maximum conjugate gradient iterations per reweighting iteration of the 'cg' solver.
+_CG_MAXITER = 500
+
+
+def _difference_matrix(N, order=2):
+    """
+    Sparse difference matrix of the given order, shape (N-order, N).
+
+    For order 2:
+    [1 -2 1 ......]
+    [0 1 -2 1 ....]
+    [.............]
+    [.... 0 1 -2 1]
+    """
+    from scipy.sparse import eye
+    # numpy.diff() does not work with sparse matrix. This is a workaround.
+    D = eye(N, format='csc')
+    for _ in range(order):
+        D = D[1:] - D[:-1]
+    return D
+
+
+def _to_banded(H, order=2):
+    """
+    Convert the symmetric sparse matrix H with bandwidth order into the upper
+    banded storage used by scipy.linalg.solveh_banded, shape (order+1, N).
+    The main diagonal is the last row.
+    """
+    N = H.shape[0]
+    ab = np.zeros((order+1, N))
+    for offset in range(order+1):
+        ab[order-offset, offset:] = H.diagonal(offset)
+    return ab
+
+
+def _build_penalty(N, lambda_, order, solver):
+    """
+    The smoothness penalty H = lambda_ * D.T * D in the storage format
+    expected by solver.
+    """
+    D = _difference_matrix(N, order)
+    H = lambda_*D.T*D
+    if solver == 'spsolve':
+        return H.tocsc()
+    return _to_banded(H, order)
+
+
+class PenaltyCache(object):
+    """
+    Bounded least recently used cache of smoothness penalties, keyed by
+    (N, lambda_, order).
+
+    Each entry holds the penalty in the storage format of every solver that
+    has asked for it. Cached arrays are read only.
+
+    Usage:
+    >>> from spyctra.baseline import penalty_cache
+    >>> penalty_cache.maxsize = 128
+    >>> hits, misses = penalty_cache.hits, penalty_cache.misses
+    >>> penalty_cache.clear()
+    """
+
+    def __init__(self, maxsize=32):
+        """
+        :param maxsize: (Optional) Maximum number of (N, lambda_, order) entries to keep.
+                    Default is 32.
+        """
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize):
+        with self._lock:
+            self._maxsize = maxsize
+            self._evict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        while len(self._entries) > max(self._maxsize, 0):
+            self._entries.popitem(last=False)
+
+    def get(self, N, lambda_, order=2, solver='banded'):
+        """
+        :returns: The penalty for solver, building it on a miss.
+        """
+        key = (N, float(lambda_), order)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and solver in entry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[solver]
+            self.misses += 1
+
+        H = _build_penalty(N, lambda_, order, solver)
+        if solver == 'banded':
+            H.flags.writeable = False
+
+        with self._lock:
+            entry = self._entries.setdefault(key, {})
+            entry[solver] = H
+            self._entries.move_to_end(key)
+            self._evict()
+        return H
+
+    def clear(self):
+        """
+        Remove all entries and reset the hit and miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Penalties shared by all the baseline functions.
+penalty_cache = PenaltyCache()
+
+
+def _penalty(N, lambda_, order=2, solver='banded'):
+    """
+    The smoothness penalty H = lambda_ * D.T * D in the storage format
+    expected by solver, from penalty_cache.
+    """
+    if solver not in SOLVERS:
+        raise ValueError("Unknown solver '{0}', expected one of {1}".format(solver, SOLVERS))
+    return penalty_cache.get(N, lambda_, order, solver)
+
+
+def _solve(H, w, y, solver='banded', ab=None, out=None):
+    """
+    Solve (W + H) z = W y, where W = diag(w).
+
+    w and y may be 2D, in which case each row is solved independently. The
+    rows are stacked into one block diagonal system, which is still banded, so
+    all of them are solved in a single call.
+
+    :param H: The penalty as returned by _penalty() for the same solver.
+    :param ab: (Optional) 'banded' only. Buffer of shape y.shape + (order+1,)
+               the system is assembled and factored in, so nothing of the
+               size of y is allocated.
+    :param out: (Optional) 'banded' only. Buffer of shape y.shape for the
+               right hand side, which is overwritten with the solution.
+    """
+    shape = y.shape
+    M = y.size // H.shape[-1]
+    if solver == 'banded':
+        from scipy.linalg import solveh_banded
+        if ab is None:
+            ab = np.empty(shape + (H.shape[0],))
+        if out is None:
+            out = np.empty(shape)
+        # ab in C order is the block diagonal band in the Fortran order LAPACK
+        # works on, so solveh_banded factors it in place.
+        np.copyto(ab, H.T)
+        ab = ab.reshape((-1, H.shape[0])).T
+        ab[-1] += w.reshape(-1)
+        b = np.multiply(w, y, out=out).reshape(-1)
+        z = solveh_banded(ab, b, overwrite_ab=True, overwrite_b=True, check_finite=False)
+    else:
+        from scipy.sparse import eye, diags, kron
+        from scipy.sparse.linalg import spsolve
+        if M > 1:
+            H = kron(eye(M), H, format='csc')
+        w = w.ravel()
+        z = spsolve(diags(w, 0, shape=H.shape, format='csc')+H, w*y.ravel())
+    return z.reshape(shape)
+
+
+def _general_band(ab):
+    """
+    The general band storage expected by solve_banded, shape (2u+1, N), of
+    the symmetric matrix in upper band storage ab, shape (u+1, N).
+    """
+    u, N = ab.shape[0] - 1, ab.shape[1]
+    G = np.zeros((2*u+1, N))
+    G[:u+1] = ab
+    for offset in range(1, u+1):
+        G[u+offset, :N-offset] = ab[u-offset, offset:]
+    return G
+
+
+def _solve_drPLS(H, H1, eta, w, y, solver='banded'):
+    """
+    Solve the drPLS system (W + H1 + (I - eta W) H) z = W y, where H1 is the
+    first order penalty. The rows of H are scaled, so the system is not
+    symmetric and needs a general banded LU solve instead of Cholesky. As in
+    _solve, the rows of 2D w and y are solved as one block diagonal system.
+    """
+    shape = y.shape
+    M = y.size // H.shape[-1]
+    w = w.reshape(-1)
+    b = w*y.reshape(-1)
+    if solver == 'banded':
+        from scipy.linalg import solve_banded
+        u = H.shape[0] - 1
+        ab = np.tile(_general_band(H), (1, M))
+        # row i of H times 1 - eta*w[i], ab[u + i - j, j] holds H[i, j]
+        scale = 1. - eta*w
+        n = ab.shape[1]
+        for row in range(2*u+1):
+            offset = row - u
+            if offset >= 0:
+                ab[row, :n-offset] *= scale[offset:]
+            else:
+                ab[row, -offset:] *= scale[:n+offset]
+        ab[u-1:u+2] += np.tile(_general_band(H1), (1, M))
+        ab[u] += w
+        z = solve_banded((u, u), ab, b, overwrite_ab=True, overwrite_b=True, check_finite=False)
+    else:
+        from scipy.sparse import eye, diags, kron
+        from scipy.sparse.linalg import spsolve
+        if M > 1:
+            H = kron(eye(M), H, format='csc')
+            H1 = kron(eye(M), H1, format='csc')
+        A = diags(w, 0, format='csc') + H1 + diags(1. - eta*w, 0, format='csc').dot(H)
+        z = spsolve(A.tocsc(), b)
+    return z.reshape(shape)
+
+
+def _noisy(y):
+    """
+    Add a tiny bit of noise to each row of y.
+    """
+    y = y.copy()
+    for row in y:
+        if np.std(row) != 0.:
+            row += (np.random.random(row.size)-0.5)*np.std(row)/1000.
+        elif np.mean(row) != 0.0 :
+            row += (np.random.random(row.size)-0.5)*np.mean(row)/1000.
+        else:
+            row += (np.random.random(row.size)-0.5)/1000.
+    return y
+
+
+# Weighting rules of the weighted Whittaker smoother _whittaker. Each is
+# called as weighting(d, iteration, out=..., mask=...) with the residuals
+# d = y - z of the rows, the 1-based iteration, and buffers of the shape of d
+# for the weights and for scratch. It returns (weights, degenerate rows). The
+# weights of degenerate rows are undefined, their spectra get a tiny bit of
+# noise and are solved again.
+
+def _negative_stats(d, out=None, mask=None):
+    """
+    Mean and standard deviation of the negative residuals of each row. Both
+    are nan for rows without enough negative residuals.
+
+    :returns: (mean, standard deviation, the negative residuals mask, out)
+    """
+    neg = np.less(d, 0.0, out=mask)
+    count = np.count_nonzero(neg, axis=-1)
+    # out holds the negative residuals and their deviations
+    scratch = np.multiply(d, neg, out=out)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        m = scratch.sum(axis=-1) / count
+        np.subtract(d, m[..., None], out=scratch)
+        scratch *= neg
+        np.square(scratch, out=scratch)
+        s = np.sqrt(scratch.sum(axis=-1) / (count - 1))
+    return m, s, neg, scratch
+
+
+def _arPLS_weights(d, iteration=None, out=None, mask=None):
+    """
+    The arPLS weights, a logistic function of the residuals,
+    1 / (1 + exp(2 (d - (2 s - m)) / s)), with m and s the mean and standard
+    deviation of the negative residuals.
+    """
+    m, s, _, wt = _negative_stats(d, out, mask)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        np.subtract(d, (2*s - m)[..., None], out=wt)
+        wt *= (2./s)[..., None]
+        np.exp(wt, out=wt)
+        wt += 1.
+        np.reciprocal(wt, out=wt)
+    return wt, np.isnan(s)
+
+
+def _iarPLS_weights(d, iteration, out=None, mask=None):
+    """
+    The improved arPLS weights of Ye et al., Appl. Opt. 59, 10933 (2020),
+    1/2 (1 - u / sqrt(1 + u**2)), u = exp(iteration) (d - 2 s) / s, which
+    sharpen with the iterations.
+    """
+    m, s, _, wt = _negative_stats(d, out, mask)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        np.subtract(d, (2*s)[..., None], out=wt)
+        wt *= (np.exp(iteration)/s)[..., None]
+        # u / sqrt(1 + u**2) = sin(arctan(u)), without a second buffer
+        np.arctan(wt, out=wt)
+        np.sin(wt, out=wt)
+        np.subtract(1., wt, out=wt)
+        wt *= 0.5
+    return wt, np.isnan(s)
+
+
+def _drPLS_weights(d, iteration, out=None, mask=None):
+    """
+    The doubly reweighted PLS weights of Xu et al., Appl. Opt. 58, 3913 (2019),
+    1/2 (1 - u / (1 + |u|)), u = exp(iteration) (d - (2 s - m)) / s.
+    """
+    m, s, neg, wt = _negative_stats(d, out, mask)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        np.subtract(d, (2*s - m)[..., None], out=wt)
+        # with r = 1 / (1 + |u|), the weight is r/2 for u > 0, 1 - r/2 otherwise
+        below = np.less(wt, 0., out=neg)
+        np.abs(wt, out=wt)
+        wt *= (np.exp(iteration)/s)[..., None]
+        wt += 1.
+        np.reciprocal(wt, out=wt)
+        wt *= 0.5
+        np.subtract(1., wt, out=wt, where=below)
+    return wt, np.isnan(s)
+
+
+def _AsLS_weights(d, iteration, out=None, mask=None, p=0.01):
+    """
+    The asymmetric least squares weights of Eilers and Boelens (2005), p above
+    the baseline and 1 - p below it.
+    """
+    wt = np.empty_like(d) if out is None else out
+    wt.fill(1. - p)
+    np.copyto(wt, p, where=np.greater(d, 0., out=mask))
+    return wt, np.zeros(len(d), dtype=bool)
+
+
+def _airPLS_weights(d, iteration, out=None, mask=None):
+    """
+    The adaptive iteratively reweighted PLS weights of Zhang et al.,
+    Analyst 135, 1138 (2010), 0 above the baseline and
+    exp(iteration |d| / |sum of the negative d|) below it. The end points get
+    1 / the smallest of these, exp(iteration max(negative d) / |sum of the
+    negative d|). Rows without negative residuals get weights 1, and count
+    as converged in _airPLS_convergence.
+    """
+    neg = np.less(d, 0., out=mask)
+    wt = np.multiply(d, neg, out=out)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        dssn = -wt.sum(axis=-1)
+        wt *= (-iteration/dssn)[..., None]
+        np.exp(wt, out=wt)
+        wt *= neg
+        ends = 1./np.min(wt, axis=-1, where=neg, initial=np.inf)
+    wt[:, 0] = ends
+    wt[:, -1] = ends
+    wt[dssn == 0.] = 1.
+    return wt, np.zeros(len(d), dtype=bool)
+
+
+def _airPLS_convergence(d, y):
+    """
+    The airPLS exit condition, |sum of the negative residuals| / sum |y| of
+    each row, 0 for rows without negative residuals, e.g. all zero spectra.
+    Overwrites d.
+    """
+    np.minimum(d, 0., out=d)
+    dssn = -d.sum(axis=-1)
+    np.abs(y, out=d)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        condition = dssn / d.sum(axis=-1)
+    condition[dssn == 0.] = 0.
+    return condition
+
+
+def _compact(keep, *buffers):
+    """
+    Moves the rows keep of the buffers to their front, one row at a time.
+    """
+    for row, old in enumerate(keep):
+        if row != old:
+            for buf in buffers:
+                buf[row] = buf[old]
+
+
+def _whittaker(Y, lambda_, ratio, itermax, log, solver, weights=None, dtype=float,
+        weighting=_arPLS_weights, convergence=None, order=2, eta=None, name='arPLS', out=None, stats=None):
+    """
+    Iteratively reweighted Whittaker smoothing over the rows of the 2D array
+    Y, of any numeric type, the core of arPLS and the other baselines. Each
+    iteration solves (W + H) z = W y, then weighting gives the next weights.
+    Y is left unchanged: the rows are solved in float64 and the results
+    stored as dtype.
+
+    Rows with a non-finite value or weight are never solved and give NaN.
+    Rows are dropped from the active set as soon as they converge. The active
+    rows are kept at the front of buffers allocated once, so with the
+    'banded' solver an iteration allocates nothing of the size of Y.
+
+    :param weighting: The weighting rule, see _arPLS_weights.
+    :param convergence: (Optional) Called as convergence(d, y) with the
+                    residuals and spectra of the rows, returns the exit
+                    condition of each row and may overwrite d. Default is
+                    the relative change of the weights.
+    :param order: (Optional) Order of the differences of the penalty.
+    :param eta: (Optional) The drPLS system (W + D1'D1 + (I - eta W) H) z = W y
+                    instead, which is not symmetric.
+    :param name: (Optional) Name of the instrumentation event.
+    :param out: (Optional) (baselines, weights, iterations) arrays to write
+                    the results into.
+    :param stats: (Optional) dict to report the instrumentation into instead
+                    of emitting it, for callers that emit one event for
+                    several calls. Its 'condition' array gets the final
+                    condition of each row, and its 'solve_time' is set.
+    :returns: (baselines, weights of the final solve, number of solves) for each row.
+    """
+    M, N = Y.shape
+
+    if eta is not None and solver == 'cg':
+        raise ValueError("Unknown solver '{0}', expected one of {1}".format(solver, ('banded', 'spsolve')))
+    # 'cg' only needs the band of H for its products
+    H = _penalty(N, lambda_, order, solver='banded' if solver == 'cg' else solver)
+    if eta is not None:
+        H1 = _penalty(N, 1., 1, solver=solver)
+
+    if out is None:
+        out = np.empty((M, N), dtype=dtype), np.empty((M, N), dtype=dtype), np.zeros(M, dtype=int)
+    Z, W, niter = out
+    # the active rows in float64, and the weights they are solved with
+    y_buf = np.array(Y, dtype=float)
+    w_buf = np.ones((M, N))
+    if weights is not None:
+        w_buf[...] = weights
+    # the next weights, the residuals, and the system of the banded solver
+    wt_buf = np.empty((M, N))
+    d_buf = np.empty((M, N))
+    neg_buf = np.empty((M, N), dtype=bool)
+    if solver == 'banded' and eta is None:
+        ab_buf = np.empty((M, N, H.shape[0]))
+        z_buf = np.empty((M, N))
+    else:
+        z_buf = y_buf.copy()
+    if solver == 'cg':
+        condition = np.ones(M)
+        cg_tol = np.ones((M, 1))
+    active = np.arange(M)
+    instrumented = instrument.enabled()
+    if instrumented:
+        start = time.perf_counter()
+        solve_time = 0.
+        final = np.empty(M) if stats is None else stats['condition']
+
+    # A non-finite row would spread through the block-diagonal system to
+    # every row solved with it, so it is left out and gets NaN.
+    bad = ~np.isfinite(y_buf.sum(axis=1) + w_buf.sum(axis=1))
+    if np.any(bad):
+        Z[bad] = np.nan
+        W[bad] = np.nan
+        niter[bad] = 0
+        if instrumented:
+            final[bad] = np.nan
+        keep = np.flatnonzero(~bad)
+        _compact(keep, y_buf, w_buf, z_buf)
+        active = active[keep]
+        if solver == 'cg':
+            condition = condition[keep]
+            cg_tol = cg_tol[keep]
+
+    for i in range(itermax+10):
+        if active.size == 0:
+            break
+        k = active.size
+        y, w, wt, d = y_buf[:k], w_buf[:k], wt_buf[:k], d_buf[:k]
+        if instrumented:
+            tic = time.perf_counter()
+        if eta is not None:
+            z = _solve_drPLS(H, H1, eta, w, y, solver)
+        elif solver == 'banded':
+            z = _solve(H, w, y, solver, ab=ab_buf[:k], out=z_buf[:k])
+        elif solver == 'cg':
+            # The weights are only known to about condition, so early
+            # iterations do not need accurate solves. The tolerance never
+            # loosens again, or a warm started solve would not move at all.
+            cg_tol = np.maximum(ratio, np.minimum(cg_tol, 0.1*condition[:, None]))
+            z_buf[:k], _ = _solve_cg(lambda_, w, y, z_buf[:k], cg_tol, order)
+            z = z_buf[:k]
+        else:
+            z = _solve(H, w, y, solver)
+        if instrumented:
+            solve_time += time.perf_counter() - tic
+        np.subtract(y, z, out=d)
+        wt, degenerate = weighting(d, i+1, out=wt, mask=neg_buf[:k])
+
+        # check exit condition, d is free for the scratch
+        if convergence is not None:
+            condition = convergence(d, y)
+        else:
+            np.subtract(w, wt, out=d)
+            np.square(d, out=d)
+            change = d.sum(axis=1)
+            np.square(w, out=d)
+            condition = np.sqrt(change / d.sum(axis=1))
+
+        if np.any(degenerate):
+            # Add a tiny bit of noise to y, and solve again with the same
+            # weights in the next iteration.
+            y[degenerate] = _noisy(y[degenerate])
+            wt[degenerate] = w[degenerate]
+            condition[degenerate] = np.inf
+
+        done = condition < ratio
+        if solver == 'cg':
+            # only once the solve was as accurate as requested
+            done &= cg_tol[:, 0] <= ratio
+        if i > itermax:
+            if log:
+                for c in condition[~done]:
+                    sys.stderr.write("\nSURPASSED ITERMAX: {0}\tCondition: {1}\n".format(i, c))
+            done[:] = True
+
+        # the next weights become the current ones
+        w_buf, wt_buf = wt_buf, w_buf
+        if np.any(done):
+            Z[active[done]] = z[done]
+            W[active[done]] = w[done]
+            niter[active[done]] = i+1
+            if instrumented:
+                final[active[done]] = condition[done]
+            keep = np.flatnonzero(~done)
+            _compact(keep, y_buf, w_buf, z_buf)
+            active = active[keep]
+            if solver == 'cg':
+                condition = condition[keep]
+                cg_tol = cg_tol[keep]
+
+    if instrumented and stats is not None:
+        stats['solve_time'] = solve_time
+    elif instrumented:
+        instrument.emit(name, spectra=M, iterations=niter, condition=final,
+                converged=final < ratio, solve_time=solve_time, time=time.perf_counter() - start)
+    return Z, W, niter
+
+def _whittaker_map(block, full_output=False, **kwargs):
+    """
+    _whittaker for map_spectra. With full_output the result is [Z | W | niter].
+    """
+    Z, W, niter = _whittaker(block, **kwargs)
+    if not full_output:
+        return Z
+    return np.hstack((Z, W, niter[:, None]))
+
+def _whittaker_batch(Y, n_jobs, chunk_size, full_output, weights, dtype, **kwargs):
+    """
+    _whittaker over the spectra of Y, 1D or 2D, chunk_size at a time or over
+    n_jobs worker processes. kwargs are passed on to _whittaker.
+
+    :returns: The baselines of Y, same shape as Y. If full_output is True,
+                    (baselines, weights, iterations).
+    """
+    Y = np.asarray(Y)
+    single = Y.ndim == 1
+    if single:
+        Y = Y[None]
+    M, N = Y.shape
+    dtype = float_dtype(dtype, Y)
+
+    if n_jobs != 1:
+        from .parallel import map_spectra
+        # Weights of every spectrum go with the chunks, the same weights for
+        # all spectra as a keyword. dtype is both the output of map_spectra
+        # and a keyword of _whittaker.
+        row_kwargs = None
+        if weights is not None and np.ndim(weights) == 2:
+            row_kwargs = {'weights': np.broadcast_to(weights, (M, N))}
+        elif weights is not None:
+            kwargs['weights'] = weights
+        func = partial(_whittaker_map, full_output=full_output, dtype=dtype)
+        result = map_spectra(func, Y, n_jobs=n_jobs, chunk_size=chunk_size, dtype=dtype,
+                out_channels=2*N+1 if full_output else N, row_kwargs=row_kwargs, **kwargs)
+        if not full_output:
+            return result[0] if single else result
+        Z, W, niter = result[:, :N], result[:, N:2*N], result[:, 2*N].astype(int)
+    else:
+        if chunk_size is None:
+            chunk_size = 256
+        Z = np.empty((M, N), dtype=dtype)
+        W = np.empty((M, N), dtype=dtype)
+        niter = np.empty(M, dtype=int)
+        if weights is not None:
+            weights = np.broadcast_to(weights, (M, N))
+        # One event for all the chunks
+        instrumented = instrument.enabled()
+        if instrumented:
+            tic = time.perf_counter()
+            condition = np.empty(M)
+            solve_time = 0.
+        for start in range(0, M, chunk_size):
+            stop = start + chunk_size
+            stats = {'condition': condition[start:stop]} if instrumented else None
+            _whittaker(Y[start:stop], weights=None if weights is None else weights[start:stop],
+                    dtype=dtype, out=(Z[start:stop], W[start:stop], niter[start:stop]), stats=stats, **kwargs)
+            if instrumented:
+                solve_time += stats['solve_time']
+        if instrumented:
+            instrument.emit(kwargs.get('name', 'arPLS'), spectra=M, iterations=niter, condition=condition,
+                    converged=condition < kwargs['ratio'], solve_time=solve_time, time=time.perf_counter() - tic)
+
+    if single:
+        Z, W, niter = Z[0], W[0], int(niter[0])
+    if full_output:
+        return Z, W, niter
+    return Z
+
+def arPLS(y, lambda_=5.e5, ratio=1.e-6, itermax=50, log=False, solver='banded', weights=None, full_output=False, dtype=None):
     """
     Baseline correction using asymmetrically reweighted penalized least squares
     smoothing.
@@ -23,119 +648,391 @@ def arPLS(y, lambda_=5.e5, ratio=1.e-6, itermax=50, log=False):
                     (weights_(i) - weights_(i+1)) / (weights_(i)) < ratio.
                     Default is 1.e-6.
     :param log: (Optional) True to debug log. Default False.
-    :returns: The smoothed baseline of y.
+    :param solver: (Optional) Linear solver used for each reweighting iteration.
+                    'banded' solves the pentadiagonal system with a banded
+                    Cholesky decomposition in O(N). 'cg' uses conjugate
+                    gradients, preconditioned with a discrete cosine transform
+                    and started from the previous baseline, with a tolerance
+                    tied to ratio. It never forms a factor, so memory stays
+                    linear in N, but 'banded' is usually faster.
+                    'spsolve' is the reference general sparse solver.
+                    Default is 'banded'.
+    :param weights: (Optional) Initial weights, e.g. the final weights of a
+                    similar spectrum. Default is all ones.
+    :param full_output: (Optional) True to also return the final weights and
+                    the number of iterations. Default False.
+    :param dtype: (Optional) Floating point type of the baseline and weights.
+                    The system is always solved in float64, see
+                    spyctra._dtypes. Default is float32 for a float32 y,
+                    float64 otherwise.
+    :returns: The smoothed baseline of y. If full_output is True,
+                    (baseline, weights, iterations).
     """
-    y = np.array(y)
+    return _whittaker_batch(np.asarray(y), 1, None, full_output, weights, dtype,
+            lambda_=lambda_, ratio=ratio, itermax=itermax, log=log, solver=solver)
 
-    N = y.shape[0]
+def arPLS_batch(Y, lambda_=5.e5, ratio=1.e-6, itermax=50, log=False, solver='banded', weights=None, full_output=False, n_jobs=1, chunk_size=None, dtype=None):
+    """
+    arPLS baseline correction of a stack of spectra.
 
-    E=eye(N,format='csc')
-    # numpy.diff() does not work with sparse matrix. This is a workaround.
-    # It creates the second order difference matrix.
-    # [1 -2 1 ......]
-    # [0 1 -2 1 ....]
-    # [.............]
-    # [.... 0 1 -2 1]
-    D=E[:-2]-2*E[1:-1]+E[2:]
+    The penalty is built once, and the weights and the exit condition are
+    updated for all spectra at once. Spectra stop iterating as soon as they
+    converge, so quickly converging spectra do not wait for slow ones.
 
-    H = lambda_*D.T*D
-    Y = np.matrix(y)
+    The spectra are solved chunk_size at a time, so Y, e.g. integer detector
+    counts, is only converted to float64 one chunk at a time.
 
-    w = np.ones(N)
+    Usage:
+    >>> from spyctra import arPLS_batch
+    >>> # Y is a 2D array, one spectrum per row
+    >>> baselines = arPLS_batch(Y)
 
-    for i in range(itermax+10):
-        W=diags(w,0,shape=(N,N))
-        Q = W+H
-        B = W*Y.T
+    :param Y: 2D array of shape (M, N), M spectra of N points each.
+    :param lambda_: (Optional) See arPLS.
+    :param ratio: (Optional) See arPLS. Applied to each spectrum separately.
+    :param itermax: (Optional) See arPLS.
+    :param log: (Optional) See arPLS.
+    :param solver: (Optional) See arPLS.
+    :param weights: (Optional) Initial weights, shape (N,) for all spectra or
+                    (M, N). Default is all ones.
+    :param full_output: (Optional) True to also return the (M, N) final weights
+                    and the (M,) number of iterations. Default False.
+    :param n_jobs: (Optional) Number of worker processes to split the spectra over.
+                    None uses all CPUs. Default is 1.
+    :param chunk_size: (Optional) Number of spectra solved at a time, and the
+                    number of spectra per worker task with n_jobs, see
+                    spyctra.parallel.map_spectra. Default is 256 without n_jobs.
+    :param dtype: (Optional) See arPLS.
+    :returns: The (M, N) baselines of Y. If full_output is True,
+                    (baselines, weights, iterations).
+    """
+    Y = np.asarray(Y)
+    if Y.ndim < 2:
+        Y = Y.reshape((1, -1))
 
-        z=spsolve(Q,B)
-        d = y-z
-        dn = d[d<0.0]
+    return _whittaker_batch(Y, n_jobs, chunk_size, full_output, weights, dtype,
+            lambda_=lambda_, ratio=ratio, itermax=itermax, log=log, solver=solver)
 
-        m = np.mean(dn)
-        if np.isnan(m):
-            # add a tiny bit of noise to Y
-            y2 = y.copy()
-            if np.std(y) != 0.:
-                y2 += (np.random.random(y.size)-0.5)*np.std(y)/1000.
-            elif np.mean(y) != 0.0 :
-                y2 += (np.random.random(y.size)-0.5)*np.mean(y)/1000.
-            else:
-                y2 += (np.random.random(y.size)-0.5)/1000.
-            y = y2
-            Y = np.matrix(y2)
-            W=diags(w,0,shape=(N,N))
-            Q = W+H
-            B = W*Y.T
-
-            z=spsolve(Q,B)
-            d = y-z
-            dn = d[d<0.0]
+def arPLS_stream(spectra, lambda_=5.e5, ratio=1.e-6, itermax=50, log=False, solver='banded', weights=None, full_output=False, dtype=None):
+    """
+    arPLS baseline correction of a sequence of similar spectra, e.g. a time
+    series. The final weights of each spectrum are the initial weights of the
+    next one, so each spectrum typically converges in a few iterations.
 
-            m = np.mean(dn)
-        s = np.std(dn,ddof=1)
+    Usage:
+    >>> from spyctra.baseline import arPLS_stream
+    >>> # spectra is any iterable of 1D spectra
+    >>> for baseline in arPLS_stream(spectra):
+    ...     pass
 
-        wt = 1./(1 + np.exp(2. * (d - (2*s-m))/s))
+    :param spectra: Iterable of 1D spectra of the same length.
+    :param weights: (Optional) Initial weights of the first spectrum.
+    :param full_output: (Optional) True to yield (baseline, weights, iterations)
+                    for each spectrum. Default False.
+    :returns: Generator of baselines, see arPLS for the other parameters.
+    """
+    for y in spectra:
+        z, weights, niter = arPLS(y, lambda_=lambda_, ratio=ratio, itermax=itermax,
+                log=log, solver=solver, weights=weights, full_output=True, dtype=dtype)
+        if full_output:
+            yield z, weights, niter
+        else:
+            yield z
 
-        # check exit condition
-        condition = np.linalg.norm(w-wt) / np.linalg.norm(w)
-        if condition < ratio:
-            break
-        if i > itermax:
-            if log:
-                sys.stderr.write("\nSURPASSED ITERMAX: {0}\tCondition: {1}\n".format(i, condition))
-            break
+def AsLS(Y, lambda_=1.e6, p=0.01, ratio=1.e-6, itermax=50, log=False, solver='banded', weights=None, full_output=False, n_jobs=1, chunk_size=None, dtype=None):
+    """
+    Baseline correction using asymmetric least squares smoothing, P. Eilers and
+    H. Boelens, Baseline Correction with Asymmetric Least Squares Smoothing
+    (2005). Points above the baseline get the weight p, points below 1 - p.
 
-        w = wt
+    Usage:
+    >>> from spyctra.baseline import AsLS
+    >>> # Y is a 1D spectrum, or a 2D array with one spectrum per row
+    >>> baseline = AsLS(Y, lambda_=1.e6, p=0.01)
+
+    :param Y: The 1D spectrum, or a 2D array of shape (M, N) with one
+                    spectrum per row.
+    :param lambda_: (Optional) See arPLS. Default is 1.e6.
+    :param p: (Optional) Asymmetry, the weight of the points above the
+                    baseline. Default is 0.01.
+    :param ratio: (Optional) See arPLS. Default is 1.e-6.
+    :param itermax: (Optional) See arPLS.
+    :param log: (Optional) See arPLS.
+    :param solver: (Optional) See arPLS.
+    :param weights: (Optional) See arPLS_batch.
+    :param full_output: (Optional) See arPLS_batch.
+    :param n_jobs: (Optional) See arPLS_batch.
+    :param chunk_size: (Optional) See arPLS_batch.
+    :param dtype: (Optional) See arPLS.
+    :returns: The baselines of Y, same shape as Y. If full_output is True,
+                    (baselines, weights, iterations).
+    """
+    return _whittaker_batch(Y, n_jobs, chunk_size, full_output, weights, dtype,
+            lambda_=lambda_, ratio=ratio, itermax=itermax, log=log, solver=solver,
+            weighting=partial(_AsLS_weights, p=p), name='AsLS')
+
+def airPLS(Y, lambda_=100., order=1, ratio=1.e-3, itermax=15, log=False, solver='banded', weights=None, full_output=False, n_jobs=1, chunk_size=None, dtype=None):
+    """
+    Baseline correction using adaptive iteratively reweighted penalized least
+    squares, Z.-M. Zhang, S. Chen and Y.-Z. Liang, Analyst 135, 1138 (2010).
+    Points above the baseline get no weight, points below a weight growing
+    with their distance and with the iterations.
+
+    Usage:
+    >>> from spyctra.baseline import airPLS
+    >>> baseline = airPLS(Y, lambda_=100.)
 
-    return z
+    :param Y: See AsLS.
+    :param lambda_: (Optional) See arPLS. Default is 100.
+    :param order: (Optional) Order of the differences of the penalty.
+                    Default is 1.
+    :param ratio: (Optional) Iteration will stop when the sum of the
+                    residuals below the baseline is less than ratio times
+                    the sum of |Y|. Default is 1.e-3.
+    :param itermax: (Optional) See arPLS. Default is 15.
+    :returns: See AsLS, for the other parameters too.
+    """
+    return _whittaker_batch(Y, n_jobs, chunk_size, full_output, weights, dtype,
+            lambda_=lambda_, ratio=ratio, itermax=itermax, log=log, solver=solver,
+            weighting=_airPLS_weights, convergence=_airPLS_convergence, order=order, name='airPLS')
 
-def arPLS2d(R, lambda_=5.e5, ratio=1.e-6, itermax=50, log=False):
+def drPLS(Y, lambda_=1.e5, eta=0.5, ratio=1.e-3, itermax=50, log=False, solver='banded', weights=None, full_output=False, n_jobs=1, chunk_size=None, dtype=None):
     """
-    :param R: NxN matrix to be smoothed.
+    Baseline correction using doubly reweighted penalized least squares,
+    D. Xu, S. Liu, Y. Cai and C. Yang, Appl. Opt. 58, 3913 (2019). The
+    smoothness penalty of each point is reweighted too, by 1 - eta*w, and a
+    first order penalty is added.
+
+    The system is not symmetric, so 'banded' uses a banded LU solve, and the
+    'cg' solver is not available.
+
+    Usage:
+    >>> from spyctra.baseline import drPLS
+    >>> baseline = drPLS(Y, lambda_=1.e5, eta=0.5)
+
+    :param Y: See AsLS.
+    :param lambda_: (Optional) See arPLS. Default is 1.e5.
+    :param eta: (Optional) Between 0 and 1, how much the weights relax the
+                    smoothness penalty. Default is 0.5.
+    :param ratio: (Optional) See arPLS. Default is 1.e-3.
+    :param solver: (Optional) 'banded' or 'spsolve', see arPLS.
+    :returns: See AsLS, for the other parameters too.
     """
-    N = R.shape[0]
+    return _whittaker_batch(Y, n_jobs, chunk_size, full_output, weights, dtype,
+            lambda_=lambda_, ratio=ratio, itermax=itermax, log=log, solver=solver,
+            weighting=_drPLS_weights, eta=eta, name='drPLS')
 
-    # flatten the array
-    Y = np.matrix(R.flatten())
-    N2 = N**2
+def iarPLS(Y, lambda_=1.e5, ratio=1.e-3, itermax=50, log=False, solver='banded', weights=None, full_output=False, n_jobs=1, chunk_size=None, dtype=None):
+    """
+    Baseline correction using improved asymmetrically reweighted penalized
+    least squares, J. Ye, C. Tian, Y. Ren and Y. Yang, Appl. Opt. 59, 10933
+    (2020). The arPLS weights, with a transition that sharpens with the
+    iterations.
 
-    E = eye(N2, format='csc')
+    Usage:
+    >>> from spyctra.baseline import iarPLS
+    >>> baseline = iarPLS(Y, lambda_=1.e5)
 
-    # There will be N-2 blocks in the D matrix
-    # Each block will be N-2 rows
-    blocks = N-2
-    ### Create the difference matrix,
-    ### will be (N-2)^2 x N
-    D = csc_matrix((blocks**2, N))
-    for i in xrange(blocks):
-        offset = 2 * (i+1) + blocks*i
-        D[i*blocks:(i+1)*blocks] += E[offset:offset+blocks]
-        offset2 = offset + 2 + blocks
-        D[i*blocks:(i+1)*blocks] -= 2*E[offset2:offset2+blocks]
-        offset3 = offset2 + blocks
-        D[i*blocks:(i+1)*blocks] += E[offset3:offset3+blocks] - 2*E[offset3+1:offset3+blocks+1] + 2*E[offset3+2:offset3+blocks+2]
+    :param Y: See AsLS.
+    :param lambda_: (Optional) See arPLS. Default is 1.e5.
+    :param ratio: (Optional) See arPLS. Default is 1.e-3.
+    :returns: See AsLS, for the other parameters too.
+    """
+    return _whittaker_batch(Y, n_jobs, chunk_size, full_output, weights, dtype,
+            lambda_=lambda_, ratio=ratio, itermax=itermax, log=log, solver=solver,
+            weighting=_iarPLS_weights, name='iarPLS')
 
-    w = np.ones(N2)
+def _apply_penalty(z, lambdas, order=2, axes=None):
+    """
+    H z for the Kronecker sum penalty H = sum_k lambdas[k] * D_k.T * D_k, where
+    D_k is the difference matrix along axis k. H is never formed, only the
+    banded 1D penalty of each axis is used.
 
-    for i in range(itermax+10):
-        W=diags(w,0,shape=(N2,N2))
-        Q = W+H
-        B = W*Y.T
+    :param axes: (Optional) The axes lambdas apply to. Default is all axes of z.
+    """
+    Hz = np.zeros_like(z)
+    if axes is None:
+        axes = range(z.ndim)
+    for axis, lambda_ in zip(axes, lambdas):
+        ab = _penalty(z.shape[axis], lambda_, order)
+        # move the axis last so the band broadcasts along it
+        zk = np.moveaxis(z, axis, -1)
+        Hk = np.moveaxis(Hz, axis, -1)
+        Hk += ab[order]*zk
+        for offset in range(1, order+1):
+            band = ab[order-offset, offset:]
+            Hk[..., :-offset] += band*zk[..., offset:]
+            Hk[..., offset:] += band*zk[..., :-offset]
+    return Hz
 
-        z = spsolve(Q,B)
-        d = y - z
-        dn = d[d<0]
 
-        m = np.mean(dn)
-        s = np.std(dn,ddof=1)
+def _penalty_eigenvalues(shape, lambdas, order=2):
+    """
+    Eigenvalues of the Kronecker sum penalty in the DCT-II basis. They are exact
+    for order 1 and a close approximation for higher orders, which makes the
+    DCT a cheap preconditioner for (W + H).
+    """
+    eig = 0.
+    for axis, (n, lambda_) in enumerate(zip(shape, lambdas)):
+        e = lambda_*(2. - 2.*np.cos(np.pi*np.arange(n)/n))**order
+        eig = eig + e.reshape((-1,) + (1,)*(len(shape)-axis-1))
+    return eig
 
-        wt = 1./(1 + np.exp(2. * (d - (2*s-m))/s))
 
-        # check exit condition
-        condition = np.linalg.norm(w-wt) / np.linalg.norm(w)
+def _pcg(A, b, x0, M, tol, maxiter, rows=False):
+    """
+    Preconditioned conjugate gradient for A x = b.
+
+    :param A: Callable returning A x.
+    :param M: Callable returning the preconditioned residual.
+    :param tol: Stop when |b - A x| < tol |b|.
+    :param rows: True if each row of b is an independent system. Each row
+                 gets its own step sizes, and stops updating once it meets tol,
+                 which may then hold one value per row, shape (M, 1).
+    :returns: (x, number of iterations)
+    """
+    if rows:
+        dot = lambda u, v: np.einsum('ij,ij->i', u, v)[:, None]
+    else:
+        dot = np.vdot
+    x = x0.copy()
+    r = b - A(x)
+    bnorm = np.sqrt(dot(b, b))
+    bnorm = np.where(bnorm == 0., 1., bnorm)
+    zr = M(r)
+    p = zr.copy()
+    rz = dot(r, zr)
+    for i in range(maxiter):
+        active = np.sqrt(dot(r, r)) >= tol*bnorm
+        if not np.any(active):
+            return x, i
+        Ap = A(p)
+        # converged rows take no step, so their residual stays put
+        alpha = np.where(active, rz / np.where(active, dot(p, Ap), 1.), 0.)
+        x += alpha*p
+        r -= alpha*Ap
+        zr = M(r)
+        rz, rz_old = dot(r, zr), rz
+        p *= np.where(active, rz / np.where(active, rz_old, 1.), 0.)
+        p += zr
+    return x, maxiter
+
 
-        if condition < ratio:
+def _solve_cg(lambda_, w, y, z0, tol, order=2):
+    """
+    Solve (W + H) z = W y for each row with preconditioned conjugate gradients,
+    started from z0. The preconditioner is the DCT of H plus the mean weight of
+    the row, see _penalty_eigenvalues.
+
+    :returns: (z, number of conjugate gradient iterations)
+    """
+    from scipy.fft import dct, idct
+    eig = _penalty_eigenvalues(y.shape[-1:], (lambda_,), order) + np.mean(w, axis=-1, keepdims=True)
+    A = lambda x: w*x + _apply_penalty(x, (lambda_,), order, axes=(-1,))
+    M = lambda r: idct(dct(r, norm='ortho', axis=-1)/eig, norm='ortho', axis=-1)
+    return _pcg(A, w*y, z0, M, tol, _CG_MAXITER, rows=True)
+
+
+def _solve_nd(lambdas, w, y, z0, solver, tol, maxiter):
+    """
+    Solve (W + H) z = W y on an N-D grid, with the Kronecker sum penalty.
+
+    :returns: (z, number of conjugate gradient iterations)
+    """
+    if solver == 'spsolve':
+        from scipy.sparse import eye, diags, kron
+        from scipy.sparse.linalg import spsolve
+        H = 0
+        for axis, (n, lambda_) in enumerate(zip(y.shape, lambdas)):
+            Hk = _penalty(n, lambda_, solver='spsolve')
+            before = int(np.prod(y.shape[:axis]))
+            after = int(np.prod(y.shape[axis+1:]))
+            H = H + kron(kron(eye(before), Hk), eye(after), format='csc')
+        z = spsolve(diags(w.ravel(), 0, format='csc')+H, (w*y).ravel())
+        return z.reshape(y.shape), 1
+
+    from scipy.fft import dctn, idctn
+    eig = _penalty_eigenvalues(y.shape, lambdas) + np.mean(w)
+    A = lambda x: w*x + _apply_penalty(x, lambdas)
+    M = lambda r: idctn(dctn(r, norm='ortho')/eig, norm='ortho')
+    return _pcg(A, w*y, z0, M, tol, maxiter)
+
+
+def arPLSnd(Y, lambda_=5.e5, ratio=1.e-6, itermax=50, log=False, solver='cg', tol=None, maxiter=200, dtype=None):
+    """
+    N-D baseline correction using asymmetrically reweighted penalized least
+    squares smoothing, e.g. for images or spectral cubes.
+
+    The smoothness penalty is the Kronecker sum of the second order difference
+    penalties along each axis, so each axis can have its own lambda_.
+
+    Usage:
+    >>> from spyctra.baseline import arPLSnd
+    >>> # R is a 2D image
+    >>> baseline = arPLSnd(R, lambda_=(1.e4, 1.e5))
+
+    :param Y: The N-D array to be smoothed. Any shape.
+    :param lambda_: (Optional) Adjusts the balance between fitness and smoothness,
+                    see arPLS. Either a single value, or one value per axis.
+                    Default is 5.e5.
+    :param ratio: (Optional) See arPLS.
+    :param itermax: (Optional) See arPLS.
+    :param log: (Optional) See arPLS.
+    :param solver: (Optional) 'cg' solves each iteration with conjugate gradients,
+                    preconditioned with a discrete cosine transform and started
+                    from the previous baseline. Memory is linear in Y.size.
+                    'spsolve' is a direct sparse solve, for small inputs.
+                    Default is 'cg'.
+    :param tol: (Optional) Relative residual tolerance of the 'cg' solver once
+                    the weights have settled. Early iterations are solved to
+                    a tenth of the current change in the weights.
+                    Default is ratio.
+    :param maxiter: (Optional) Maximum conjugate gradient iterations per
+                    reweighting iteration. Default is 200.
+    :param dtype: (Optional) Floating point type of the baseline, see arPLS.
+    :returns: The smoothed baseline of Y, same shape as Y.
+    """
+    if solver not in ('cg', 'spsolve'):
+        raise ValueError("Unknown solver '{0}', expected one of {1}".format(solver, ('cg', 'spsolve')))
+    dtype = float_dtype(dtype, Y)
+    y = np.array(Y, dtype=float)
+    lambdas = np.broadcast_to(lambda_, (y.ndim,))
+    if tol is None:
+        tol = ratio
+
+    w = np.ones(y.shape)
+    z = y.copy()
+    condition = 1.
+    instrumented = instrument.enabled()
+    if instrumented:
+        start = time.perf_counter()
+        solve_time = 0.
+        solver_iterations = 0
+
+    for i in range(itermax+10):
+        # The weights are only known to about condition, so early iterations
+        # do not need accurate solves.
+        cg_tol = max(tol, 0.1*condition) if solver == 'cg' else tol
+        if instrumented:
+            tic = time.perf_counter()
+        z, iterations = _solve_nd(lambdas, w, y, z, solver, cg_tol, maxiter)
+        if instrumented:
+            solve_time += time.perf_counter() - tic
+            solver_iterations += iterations
+        d = y-z
+        wt, degenerate = _arPLS_weights(d.reshape((1, -1)))
+
+        if degenerate[0]:
+            # add a tiny bit of noise to Y
+            y = _noisy(y.reshape((1, -1))).reshape(y.shape)
+            z, _ = _solve_nd(lambdas, w, y, z, solver, cg_tol, maxiter)
+            d = y-z
+            wt, _ = _arPLS_weights(d.reshape((1, -1)))
+        wt = wt.reshape(y.shape)
+
+        # check exit condition, once the solve was as accurate as requested
+        condition = np.linalg.norm(w-wt) / np.linalg.norm(w)
+        if condition < ratio and cg_tol <= tol:
             break
         if i > itermax:
             if log:
@@ -144,4 +1041,21 @@ def arPLS2d(R, lambda_=5.e5, ratio=1.e-6, itermax=50, log=False):
 
         w = wt
 
-    return z.reshape((N,N))
+    if instrumented:
+        instrument.emit('arPLSnd', iterations=i+1, condition=condition, converged=condition < ratio,
+                solver_iterations=solver_iterations, solve_time=solve_time, time=time.perf_counter() - start)
+    return z.astype(dtype, copy=False)
+
+def arPLS2d(R, lambda_=5.e5, ratio=1.e-6, itermax=50, log=False, solver='cg', tol=None, maxiter=200, dtype=None):
+    """
+    2D baseline correction using arPLS, see arPLSnd.
+
+    :param R: 2D array to be smoothed. Need not be square.
+    :param lambda_: (Optional) A single value, or (lambda_rows, lambda_columns).
+    :returns: The smoothed baseline of R.
+    """
+    R = np.asarray(R)
+    if R.ndim != 2:
+        raise ValueError("arPLS2d expects a 2D array, got {0} dimensions".format(R.ndim))
+    return arPLSnd(R, lambda_=lambda_, ratio=ratio, itermax=itermax, log=log, solver=solver, tol=tol,
+            maxiter=maxiter, dtype=dtype)
@@ -0,0 +1,232 @@
+"""
+Command line batch processing of files of spectra.
+
+Usage:
+    spyctra baseline --lambda 5e5 --jobs 8 in.npy out.npy
+    spyctra cosmics in.csv out.csv
+    spyctra fit --model lorentz --x wavenumbers.npy --p0 3,520,100,4,960,20 in.npy params.npy
+
+Inputs and outputs are .npy files, CSV files with one spectrum per row, or
+raw binary files of C ordered spectra. Inputs are read chunk by chunk, .npy
+and raw files through a memory map, so files larger than memory work.
+"""
+import argparse
+import sys
+import time
+import numpy as np
+
+MODELS = ('lorentz', 'gaussian', 'voigt', 'pseudo_voigt')
+
+
+def _is_text(path):
+    return path.lower().endswith(('.csv', '.txt'))
+
+
+def _csv_chunks(path, chunk_size):
+    """
+    The rows of a CSV file in 2D blocks of chunk_size rows.
+    """
+    with open(path) as f:
+        lines = []
+        for line in f:
+            if line.strip():
+                lines.append(line)
+            if len(lines) == chunk_size:
+                yield np.loadtxt(lines, delimiter=',', ndmin=2)
+                lines = []
+        if lines:
+            yield np.loadtxt(lines, delimiter=',', ndmin=2)
+
+
+def _count_rows(path):
+    with open(path) as f:
+        return sum(1 for line in f if line.strip())
+
+
+def _open_input(path, chunk_size, dtype, channels):
+    """
+    :returns: (source for Pipeline.stream, number of spectra)
+    """
+    if path.endswith('.npy'):
+        data = np.load(path, mmap_mode='r')
+        return data, int(np.prod(data.shape[:-1]))
+    if _is_text(path):
+        return _csv_chunks(path, chunk_size), _count_rows(path)
+    if channels is None:
+        raise ValueError("--channels is needed for the raw binary file {0}".format(path))
+    data = np.memmap(path, dtype=dtype, mode='r').reshape((-1, channels))
+    return data, len(data)
+
+
+class _Writer(object):
+    """
+    Writes the results chunk by chunk, creating the output at the first chunk
+    once the number of output channels is known.
+    """
+
+    def __init__(self, path, M):
+        self.path = path
+        self.M = M
+        self.out = None
+
+    def write(self, start, block):
+        if _is_text(self.path):
+            if self.out is None:
+                self.out = open(self.path, 'w')
+            np.savetxt(self.out, block, delimiter=',')
+            return
+        if self.out is None:
+            shape = (self.M, block.shape[-1])
+            if self.path.endswith('.npy'):
+                self.out = np.lib.format.open_memmap(self.path, mode='w+', dtype=block.dtype, shape=shape)
+            else:
+                self.out = np.memmap(self.path, mode='w+', dtype=block.dtype, shape=shape)
+        self.out[start:start+len(block)] = block
+        self.out.flush()
+
+    def close(self):
+        if _is_text(self.path) and self.out is not None:
+            self.out.close()
+        self.out = None
+
+
+def _load_values(value):
+    """
+    Numbers from a .npy or text file, or a comma separated list.
+    """
+    if value.endswith('.npy'):
+        return np.load(value)
+    if _is_text(value):
+        return np.loadtxt(value, delimiter=',')
+    return np.array([float(v) for v in value.split(',')])
+
+
+def _model(name):
+    from . import functions
+    return getattr(functions, name)
+
+
+def _pipeline(args, source):
+    """
+    :returns: The Pipeline of the subcommand.
+    """
+    from .pipeline import Pipeline
+    pipeline = Pipeline()
+    if args.command == 'baseline':
+        kwargs = dict(lambda_=args.lambda_, ratio=args.ratio, itermax=args.itermax)
+        if args.subtract:
+            return pipeline.subtract_baseline(**kwargs)
+        from .baseline import arPLS_batch
+        return pipeline.map(arPLS_batch, name='baseline', **kwargs)
+    if args.command == 'cosmics':
+        return pipeline.remove_cosmics(max_curvature=args.max_curvature, window=args.window)
+
+    model = _model(args.model)
+    if args.x is None:
+        raise ValueError("fit needs the x values of the spectra, --x")
+    x = _load_values(args.x)
+    if args.p0 is not None:
+        p0 = _load_values(args.p0)
+    elif args.peaks is not None:
+        p0 = _guess(source, x, args)
+    else:
+        raise ValueError("fit needs --p0, or --peaks to guess it")
+    if args.subtract:
+        pipeline.subtract_baseline(lambda_=args.lambda_)
+    return pipeline.fit(model, x, p0, maxiter=args.maxiter)
+
+
+def _guess(source, x, args):
+    """
+    Initial parameters for all spectra, from the peaks of the mean of the
+    first spectra of source.
+    """
+    from .peaks import find_peaks
+    if not isinstance(source, np.ndarray):
+        raise ValueError("--peaks needs a .npy or raw input, use --p0 for CSV")
+    first = np.asarray(source.reshape((-1, source.shape[-1]))[:args.chunk_size], dtype=float)
+    shape = 'gaussian' if args.model == 'gaussian' else 'lorentz'
+    params = find_peaks(first.mean(axis=0), x, max_peaks=args.peaks, shape=shape, baseline=args.subtract, lambda_=args.lambda_)
+    if len(params) < args.peaks:
+        raise ValueError("Found {0} of the {1} peaks asked for".format(len(params), args.peaks))
+    if args.model == 'voigt':
+        # sigma, gamma, xo, amplitude from a lorentzian guess
+        params = np.column_stack((params[:, 0]/2., params[:, 0]/2., params[:, 1], params[:, 2]))
+    elif args.model == 'pseudo_voigt':
+        params = np.column_stack((params, np.full(len(params), 0.5)))
+    return params
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog='spyctra', description='Batch processing of files of spectra.')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('input', help='.npy, .csv or raw binary file, one spectrum per row')
+    common.add_argument('output', help='.npy, .csv or raw float64 binary file for the results')
+    common.add_argument('--jobs', type=int, default=None,
+            help='number of worker processes (default: all cores)')
+    common.add_argument('--chunk-size', type=int, default=256,
+            help='number of spectra per chunk (default: 256)')
+    common.add_argument('--dtype', default='float64', help='dtype of raw binary input (default: float64)')
+    common.add_argument('--channels', type=int, default=None, help='points per spectrum of raw binary input')
+    common.add_argument('--timings', action='store_true', help='print the time spent in each step')
+
+    baseline = commands.add_parser('baseline', parents=[common], help='arPLS baselines')
+    baseline.add_argument('--lambda', dest='lambda_', type=float, default=5.e5, help='smoothness (default: 5e5)')
+    baseline.add_argument('--ratio', type=float, default=1.e-6, help='convergence ratio (default: 1e-6)')
+    baseline.add_argument('--itermax', type=int, default=50, help='maximum iterations (default: 50)')
+    baseline.add_argument('--subtract', action='store_true',
+            help='write the spectra minus their baselines instead of the baselines')
+
+    cosmics = commands.add_parser('cosmics', parents=[common], help='remove cosmic ray spikes')
+    cosmics.add_argument('--max-curvature', type=float, default=-1000., help='(default: -1000)')
+    cosmics.add_argument('--window', type=int, default=10, help='(default: 10)')
+
+    fit = commands.add_parser('fit', parents=[common], help='fit peaks to every spectrum')
+    fit.add_argument('--model', choices=MODELS, default='lorentz', help='line shape (default: lorentz)')
+    fit.add_argument('--x', help='x values: .npy, .csv, or comma separated')
+    fit.add_argument('--p0', help='initial parameters: .npy, .csv, or comma separated')
+    fit.add_argument('--peaks', type=int, default=None,
+            help='guess p0 from the most prominent peaks of the mean spectrum instead')
+    fit.add_argument('--subtract', action='store_true', help='subtract the arPLS baseline before fitting')
+    fit.add_argument('--lambda', dest='lambda_', type=float, default=5.e5,
+            help='smoothness of the baseline (default: 5e5)')
+    fit.add_argument('--maxiter', type=int, default=200, help='maximum iterations per spectrum (default: 200)')
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point of the spyctra command.
+
+    :param argv: (Optional) Arguments, default sys.argv[1:].
+    :returns: Exit status.
+    """
+    parser = _parser()
+    args = parser.parse_args(argv)
+
+    try:
+        source, M = _open_input(args.input, args.chunk_size, np.dtype(args.dtype), args.channels)
+        pipeline = _pipeline(args, source)
+    except (ValueError, IOError) as error:
+        parser.error(str(error))
+
+    writer = _Writer(args.output, M)
+    tic = time.perf_counter()
+    try:
+        for start, block in pipeline.stream(source, chunk_size=args.chunk_size, n_jobs=args.jobs):
+            writer.write(start, block)
+    finally:
+        writer.close()
+    seconds = time.perf_counter() - tic
+
+    print('{0} spectra in {1:.2f} s, {2:.1f} spectra/s'.format(M, seconds, M/max(seconds, 1e-9)))
+    if args.timings:
+        print(pipeline.report())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,31 +1,285 @@
+import os
+import time
 import numpy as np
-from scipy.interpolate import interp1d
+from concurrent.futures import ThreadPoolExecutor
 
-def remove_cosmics(spectrum, max_curvature=-1000):
+from . import instrument
+from ._dtypes import float_dtype
+
+
+def _fill(spectra, flagged, window):
+    """
+    Replace the flagged points of each row of spectra with the value of a
+    quadratic least squares fit through the unflagged points within window
+    points of it. All points are fitted at once.
+
+    Flagged points never take part in a fit, so the points of a contiguous
+    run of spikes are all filled from the smooth data around the run.
+
+    :returns: (row indices, column indices, values) of the filled points.
+    """
+    n = spectra.shape[-1]
+    rows, columns = np.nonzero(flagged)
+
+    offsets = np.arange(-window, window)
+    indices = columns[:, None] + offsets
+    inside = (indices >= 0) & (indices < n)
+    indices = np.clip(indices, 0, n-1)
+    # Fit only the low curvature points, and drop what is past the ends.
+    use = inside & ~flagged[rows[:, None], indices]
+
+    t = offsets.astype(float)
+    values = np.where(use, spectra[rows[:, None], indices], 0.)
+    u = use.astype(float)
+    # Normal equations of y = c0 + c1*t + c2*t**2, where t is the distance to
+    # the flagged point, so the fitted value is c0.
+    S = np.stack([u.dot(t**k) for k in range(5)], axis=-1)
+    A = np.stack([S[:, 0:3], S[:, 1:4], S[:, 2:5]], axis=-2)
+    b = np.stack([(values*t**k).sum(axis=-1) for k in range(3)], axis=-1)
+
+    # At least 3 points are needed for a quadratic, otherwise leave the point.
+    ok = use.sum(axis=-1) >= 3
+    A[~ok] = np.eye(3)
+    c = np.linalg.solve(A, b[..., None])[..., 0]
+
+    return rows[ok], columns[ok], c[ok, 0]
+
+
+def _curvature(spectra, gradient, curvature):
+    """
+    The 2nd derivative np.gradient(np.gradient(spectra, axis=-1), axis=-1),
+    computed into the given buffers without temporaries.
+    """
+    for y, g in ((spectra, gradient), (gradient, curvature)):
+        np.subtract(y[:, 2:], y[:, :-2], out=g[:, 1:-1], dtype=g.dtype)
+        g[:, 1:-1] *= 0.5
+        np.subtract(y[:, 1], y[:, 0], out=g[:, 0], dtype=g.dtype)
+        np.subtract(y[:, -1], y[:, -2], out=g[:, -1], dtype=g.dtype)
+    return curvature
+
+
+def _remove_cosmics(spectra, max_curvature, window, dtype, rows=None):
+    """
+    remove_cosmics on the 2D spectra, in place, rows spectra at a time.
+    Default is all at once.
+
+    :returns: (number of points replaced in each spectrum, number of flagged
+        points that could not be replaced)
+    """
+    M, N = spectra.shape
+    if rows is None:
+        rows = M
+
+    # Scratch buffers, reused for every chunk
+    gradient = np.empty((rows, N), dtype=dtype)
+    curvature = np.empty((rows, N), dtype=dtype)
+    flagged = np.empty((rows, N), dtype=bool)
+    replaced = np.zeros(M, dtype=int)
+    unreplaced = 0
+
+    for start in range(0, M, rows):
+        chunk = spectra[start:start+rows]
+        k = chunk.shape[0]
+        _curvature(chunk, gradient[:k], curvature[:k])
+        np.less_equal(curvature[:k], max_curvature, out=flagged[:k])
+
+        r, c, values = _fill(chunk, flagged[:k], window)
+        if chunk.dtype.kind in 'iu':
+            values = np.rint(values)
+        chunk[r, c] = values
+        replaced[start:start+k] = np.bincount(r, minlength=k)
+        unreplaced += np.count_nonzero(flagged[:k]) - len(r)
+    return replaced, unreplaced
+
+
+def remove_cosmics(spectrum, max_curvature=-1000, window=10, copy=False, out=None, chunk_size=None, n_jobs=1, dtype=None):
     """
+    Remove cosmic ray spikes. Points with a large negative curvature are
+    replaced with a local quadratic fit through the nearby low curvature
+    points.
+
+    By default spectrum is modified in place. Use copy=True to keep it, or
+    out to write the result into an existing array.
+
+    The spectra are processed chunk_size at a time. Apart from the result,
+    the memory used is bounded by the chunk, not by the number of spectra:
+    two float buffers and one boolean buffer of chunk_size*N, reused for
+    every chunk, plus about 12*window floats for each spike found in a chunk.
+    With n_jobs, each of the n_jobs threads has such buffers for the chunk it
+    works on, in place in the result. Integer spectra, e.g. 16 bit detector
+    counts, modified in place or written to out are never copied to float as
+    a whole; copy=True returns a float copy of dtype.
+
+    Usage:
+    >>> from spyctra import remove_cosmics
+    >>> # y is a 1D spectrum, or a 2D array with one spectrum per row
+    >>> y_clean = remove_cosmics(y, copy=True)
+
+    :param spectrum: The 1D spectrum, or a 2D array of shape (M, N) with one
+        spectrum per row.
     :param max_curvature: Maximum curvature to be allowed. This should be a
         negative number, indicating negative curvature.
+    :param window: (Optional) The fit uses the points up to window points
+        before and window-1 points after each spike. Default is 10.
+    :param copy: (Optional) True to leave spectrum unchanged and return the
+        result in a new array of dtype. Default False, in which case the
+        fitted values of integer spectra are rounded.
+    :param out: (Optional) Array with the shape of spectrum to write the result
+        into. May be spectrum itself. Overrides copy.
+    :param chunk_size: (Optional) Number of spectra processed at a time, by
+        each thread with n_jobs. Default is 256.
+    :param n_jobs: (Optional) Number of worker threads to split the spectra
+        over. None uses all CPUs. Default is 1.
+    :param dtype: (Optional) Floating point type of the curvature, and of the
+        copy with copy=True. Default is float32 for float32 spectra, float64
+        otherwise. See spyctra._dtypes for the accuracy of float32.
+    :returns: The spectrum with the cosmics removed, which is out, spectrum
+        itself, or a copy.
+    """
+    dtype = float_dtype(dtype, spectrum)
+    if out is None:
+        out = np.array(spectrum, dtype=dtype) if copy else spectrum
+    elif out is not spectrum:
+        np.copyto(out, spectrum)
+    if chunk_size is None:
+        chunk_size = 256
+
+    spectra = out if out.ndim == 2 else out[None]
+    M, N = spectra.shape
+    rows = min(chunk_size, M)
+    instrumented = instrument.enabled()
+    if instrumented:
+        tic = time.perf_counter()
+
+    if n_jobs != 1 and M > rows:
+        # One block of spectra per thread, worked on in place, chunk_size
+        # spectra at a time
+        if n_jobs is None:
+            n_jobs = os.cpu_count() or 1
+        edges = sorted(set(M*j // n_jobs for j in range(n_jobs+1)))
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(_remove_cosmics, spectra[start:stop], max_curvature, window, dtype, rows)
+                    for start, stop in zip(edges[:-1], edges[1:])]
+            results = [future.result() for future in futures]
+        replaced = np.concatenate([result[0] for result in results])
+        unreplaced = sum(result[1] for result in results)
+    else:
+        replaced, unreplaced = _remove_cosmics(spectra, max_curvature, window, dtype, rows)
+
+    if instrumented:
+        instrument.emit('remove_cosmics', spectra=M, replaced=replaced, unreplaced=unreplaced,
+                time=time.perf_counter() - tic)
+    return out
+
+
+def remove_cosmics_multi(frames, threshold=5., method='mad', combine='mean', iterations=3, chunk_size=None, out=None, full_output=False, dtype=None):
+    """
+    Remove cosmic ray spikes using repeated acquisitions of the same spectra,
+    and combine the acquisitions.
+
+    For every channel, values much larger than the other frames are flagged,
+    using a robust per channel statistic over the frames. Cosmics only add
+    counts, so only positive outliers are flagged. The flagged values are left
+    out of the combined spectrum.
+
+    The spectra are processed chunk_size at a time, so frames can be a memory
+    mapped array that does not fit in memory.
+
+    Usage:
+    >>> from spyctra import remove_cosmics_multi
+    >>> # frames is a (K, N) array of K acquisitions of a spectrum
+    >>> y = remove_cosmics_multi(frames)
+
+    :param frames: Array of shape (K, N) or (K, M, N), K acquisitions of each
+        spectrum. At least 3 frames are needed to tell a cosmic from noise.
+    :param threshold: (Optional) Values more than threshold standard deviations
+        above the center of their channel are flagged. Default is 5.
+    :param method: (Optional) 'mad' uses the median and the median absolute
+        deviation of each channel. 'sigma_clip' compares each value to the
+        mean and the standard deviation of the other values of its channel,
+        iteratively recomputed without the flagged values. Default is 'mad'.
+    :param combine: (Optional) 'mean' averages the unflagged values of each
+        channel. 'sum' scales that average by K, as for accumulations.
+        Default is 'mean'.
+    :param iterations: (Optional) Number of clipping iterations for
+        'sigma_clip'. Default is 3.
+    :param chunk_size: (Optional) Number of spectra processed at a time.
+        Default is 256.
+    :param out: (Optional) Array of shape frames.shape[1:] for the result.
+    :param full_output: (Optional) True to also return the boolean mask of the
+        flagged values, same shape as frames. Default False.
+    :param dtype: (Optional) Floating point type of the statistics and of a new
+        out. Default is float32 for float32 frames, float64 otherwise.
+    :returns: The combined spectra, shape frames.shape[1:]. If full_output is
+        True, (combined spectra, mask).
     """
-    n = len(spectrum)
+    if method not in ('mad', 'sigma_clip'):
+        raise ValueError("Unknown method '{0}', expected 'mad' or 'sigma_clip'".format(method))
+    if combine not in ('mean', 'sum'):
+        raise ValueError("Unknown combine '{0}', expected 'mean' or 'sum'".format(combine))
+    if chunk_size is None:
+        chunk_size = 256
+    dtype = float_dtype(dtype, frames)
+
+    stack = frames if frames.ndim == 3 else frames[:, None]
+    K, M, N = stack.shape
 
-    # Calculate the 2nd derivative
-    curvature = np.gradient(np.gradient(spectrum))
+    if out is None:
+        out = np.empty(frames.shape[1:], dtype=dtype)
+    combined = out if out.ndim == 2 else out[None]
+    if full_output:
+        mask = np.zeros(stack.shape, dtype=bool)
+    instrumented = instrument.enabled()
+    if instrumented:
+        tic = time.perf_counter()
+        flagged_count = 0
 
-    spec_indices = np.indices(spectrum.shape)[0]
+    for start in range(0, M, chunk_size):
+        block = np.asarray(stack[:, start:start+chunk_size], dtype=dtype)
 
-    # loop through the high curvature points and replace with the interpolated value
-    for index in spec_indices[np.where(curvature <= max_curvature)]:
-        # Ignore spikes close to the ends of the spectrum, as interp1d will
-        # throw an error if they are included.
-        if index > 5 and index < n - 6:
-            minindex = max(0, index - 10)
-            maxindex = min(n, index + 10)
-            # interpolate the local data, using only points that have low curvature
-            where_smooth = np.where(curvature[minindex:maxindex] > max_curvature)
-            temp_indices = spec_indices[minindex:maxindex][where_smooth]
-            temp_spec = spectrum[minindex:maxindex][where_smooth]
-            f = interp1d(temp_indices, temp_spec, kind='quadratic')
+        if method == 'mad':
+            center = np.median(block, axis=0)
+            deviation = block - center
+            # 1.4826 * MAD estimates the standard deviation of normal noise
+            scale = 1.4826*np.median(np.abs(deviation), axis=0)
+            # With few frames the MAD of a channel can be close to 0 by chance,
+            # so it is not allowed below the typical MAD of the spectrum.
+            scale = np.maximum(scale, np.median(scale, axis=-1, keepdims=True))
+            flagged = deviation > threshold*scale
+        else:
+            # Each value is compared to the mean and standard deviation of the
+            # other unflagged values of its channel, so that a cosmic does not
+            # hide itself by inflating the standard deviation.
+            flagged = np.zeros(block.shape, dtype=bool)
+            for _ in range(iterations):
+                good = ~flagged
+                values = np.where(good, block, 0.)
+                # The sums are in float64, the variance from them cancels
+                # too much for float32.
+                total = values.sum(axis=0, dtype=float)
+                total_sq = np.square(values, dtype=float).sum(axis=0)
+                # the count of the others, for unflagged and flagged values
+                others = good.sum(axis=0) - good
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    center = (total - values) / others
+                    variance = (total_sq - np.square(values, dtype=float) - others*np.square(center)) / (others - 1)
+                scale = np.sqrt(np.maximum(variance, 0.))
+                flagged = (block - center) > threshold*scale
+                flagged &= others >= 2
+        good = ~flagged
+        mean = np.where(good, block, 0.).sum(axis=0) / good.sum(axis=0)
+        if combine == 'sum':
+            mean *= K
+        combined[start:start+chunk_size] = mean
 
-            spectrum[index] = f(index)
+        if full_output:
+            mask[:, start:start+chunk_size] = flagged
+        if instrumented:
+            flagged_count += np.count_nonzero(flagged)
 
-    return spectrum
+    if instrumented:
+        instrument.emit('remove_cosmics_multi', frames=K, spectra=M, flagged=flagged_count,
+                time=time.perf_counter() - tic)
+    if full_output:
+        return out, mask.reshape(frames.shape)
+    return out
@@ -0,0 +1,239 @@
+"""
+Spectral cubes too large for memory, processed in chunks of spectra.
+"""
+import numpy as np
+
+
+def _open_memmap(filename, shape, dtype, mode, offset=0):
+    """
+    Memory map a .npy file, or a raw binary file of the given shape and dtype.
+    """
+    if str(filename).endswith('.npy'):
+        if mode == 'w+':
+            return np.lib.format.open_memmap(filename, mode=mode, dtype=dtype, shape=shape)
+        return np.load(filename, mmap_mode=mode)
+    if shape is None and mode != 'w+':
+        # a raw file of spectra, with the shape unknown
+        return np.memmap(filename, dtype=dtype, mode=mode, offset=offset)
+    return np.memmap(filename, dtype=dtype, mode=mode, shape=shape, offset=offset)
+
+
+class SpectralCube(object):
+    """
+    A stack of spectra of shape (..., N), e.g. a (rows, columns, N)
+    hyperspectral map, with its wavenumber axis.
+
+    The data is usually a numpy.memmap of a raw binary or .npy file, so the
+    cube can be much larger than memory. Methods that process the cube work on
+    chunks of chunk_size spectra and write the result to another cube, so the
+    memory used is bounded by the chunk, not by the cube.
+
+    Usage:
+    >>> from spyctra.cube import SpectralCube
+    >>> cube = SpectralCube.open('map.npy', wavenumbers=wavenumbers)
+    >>> baselines = cube.arPLS(out='baselines.npy', lambda_=1.e5)
+    >>> for start, block in cube.chunks(chunk_size=1024):
+    ...     pass
+    """
+
+    def __init__(self, data, wavenumbers=None):
+        """
+        :param data: Array of spectra, shape (..., N). Any array works, and a
+                    numpy.memmap keeps the cube on disk.
+        :param wavenumbers: (Optional) The N wavenumbers, or other x values, of
+                    the spectra. Default is the channel index.
+        """
+        self.data = data
+        if wavenumbers is None:
+            wavenumbers = np.arange(data.shape[-1], dtype=float)
+        self.wavenumbers = np.asarray(wavenumbers, dtype=float)
+        if self.wavenumbers.shape != data.shape[-1:]:
+            raise ValueError("Expected {0} wavenumbers, got shape {1}".format(data.shape[-1], self.wavenumbers.shape))
+
+    @classmethod
+    def open(cls, filename, shape=None, dtype=float, wavenumbers=None, mode='r', offset=0):
+        """
+        Memory map an existing file of spectra.
+
+        :param filename: A .npy file, or a raw binary file of C ordered spectra.
+        :param shape: (Optional) Shape of the data in a raw file, (..., N). Not
+                    needed for .npy files. Default reads the raw file as spectra
+                    of len(wavenumbers) channels.
+        :param dtype: (Optional) dtype of a raw file. Default is float64.
+        :param wavenumbers: (Optional) See SpectralCube.
+        :param mode: (Optional) Memory map mode, 'r' or 'r+'. Default is 'r'.
+        :param offset: (Optional) Header bytes before the data of a raw file.
+        :returns: The SpectralCube.
+        """
+        data = _open_memmap(filename, shape, dtype, mode, offset)
+        if data.ndim == 1 and wavenumbers is not None:
+            data = data.reshape((-1, len(wavenumbers)))
+        return cls(data, wavenumbers)
+
+    @classmethod
+    def create(cls, filename, shape, dtype=float, wavenumbers=None):
+        """
+        Create a new memory mapped cube, overwriting filename.
+
+        :param filename: A .npy file, or any other name for a raw binary file.
+        :param shape: Shape of the data, (..., N).
+        :param dtype: (Optional) Default is float64.
+        :param wavenumbers: (Optional) See SpectralCube.
+        :returns: The SpectralCube.
+        """
+        return cls(_open_memmap(filename, shape, dtype, 'w+'), wavenumbers)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def n_channels(self):
+        return self.data.shape[-1]
+
+    @property
+    def n_spectra(self):
+        return int(np.prod(self.data.shape[:-1]))
+
+    @property
+    def spectra(self):
+        """
+        The data as a 2D (n_spectra, N) array, a view of a memmap.
+        """
+        return self.data.reshape((self.n_spectra, self.n_channels))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def chunks(self, chunk_size=None):
+        """
+        Iterate over the spectra in chunks. Only the chunk being used is read
+        into memory.
+
+        :param chunk_size: (Optional) Number of spectra per chunk. Default is 256.
+        :returns: Iterator of (index of the first spectrum, (k, N) array of the
+                    k <= chunk_size spectra of the chunk). The arrays are
+                    copies, so they can be changed freely.
+        """
+        if chunk_size is None:
+            chunk_size = 256
+        spectra = self.spectra
+        for start in range(0, len(spectra), chunk_size):
+            yield start, np.array(spectra[start:start+chunk_size])
+
+    def _output(self, out, channels, dtype, wavenumbers):
+        """
+        The output cube of a method: out itself, a new memmap at the filename
+        out, or a new cube in memory.
+        """
+        shape = self.shape[:-1] + (channels,)
+        if wavenumbers is None and channels == self.n_channels:
+            wavenumbers = self.wavenumbers
+        if out is None:
+            return SpectralCube(np.empty(shape, dtype=dtype), wavenumbers)
+        if isinstance(out, SpectralCube):
+            if out.shape != shape:
+                raise ValueError("Expected an output of shape {0}, got {1}".format(shape, out.shape))
+            return out
+        return SpectralCube.create(out, shape, dtype, wavenumbers)
+
+    def apply(self, func, out=None, chunk_size=None, out_channels=None, dtype=float, wavenumbers=None, **kwargs):
+        """
+        Apply func to the cube, chunk by chunk, and write the results to
+        another cube.
+
+        Written chunks of a memory mapped output are flushed to disk as they
+        are done, so neither the input nor the output has to fit in memory.
+
+        Usage:
+        >>> from spyctra import arPLS_batch
+        >>> Z = cube.apply(arPLS_batch, out='baselines.npy', lambda_=1.e5)
+
+        :param func: Called as func(block, **kwargs) with a (k, N) array of
+                    spectra. Must return an array of shape (k, out_channels).
+                    block is a copy, so func may change it in place.
+        :param out: (Optional) SpectralCube, or filename of a new .npy or raw
+                    memory mapped cube, for the result. Default is a cube in
+                    memory.
+        :param chunk_size: (Optional) Number of spectra per chunk. Default is 256.
+        :param out_channels: (Optional) Length of each output spectrum.
+                    Default is N.
+        :param dtype: (Optional) dtype of a new output. Default is float64.
+        :param wavenumbers: (Optional) Wavenumbers of a new output. Default is
+                    the wavenumbers of this cube, if out_channels is N.
+        :param kwargs: Passed on to func.
+        :returns: The output SpectralCube.
+        """
+        if out_channels is None:
+            out_channels = self.n_channels
+        result = self._output(out, out_channels, dtype, wavenumbers)
+        spectra = result.spectra
+        flush = getattr(result.data, 'flush', None)
+        for start, block in self.chunks(chunk_size):
+            spectra[start:start+len(block)] = func(block, **kwargs)
+            if flush is not None:
+                flush()
+        return result
+
+    def arPLS(self, out=None, chunk_size=None, **kwargs):
+        """
+        The arPLS baselines of all spectra, see spyctra.arPLS_batch.
+
+        :param out: (Optional) See apply.
+        :param chunk_size: (Optional) See apply.
+        :param kwargs: Passed on to arPLS_batch, e.g. lambda_.
+        :returns: SpectralCube of the baselines.
+        """
+        from .baseline import arPLS_batch
+        return self.apply(arPLS_batch, out=out, chunk_size=chunk_size, **kwargs)
+
+    def remove_cosmics(self, out=None, chunk_size=None, **kwargs):
+        """
+        The spectra with the cosmic ray spikes removed, see
+        spyctra.remove_cosmics. This cube is not changed.
+
+        :param out: (Optional) See apply. May be this cube, if opened with
+                    mode 'r+', to remove the cosmics in place.
+        :param chunk_size: (Optional) See apply.
+        :param kwargs: Passed on to remove_cosmics, e.g. max_curvature.
+        :returns: SpectralCube of the cleaned spectra.
+        """
+        from .cosmics import remove_cosmics
+        return self.apply(remove_cosmics, out=out, chunk_size=chunk_size, dtype=self.dtype, **kwargs)
+
+    @classmethod
+    def evaluate(cls, func, params, wavenumbers, out=None, chunk_size=None, npar=None):
+        """
+        Evaluate a line shape function, such as spyctra.lorentz, for the
+        parameters of every spectrum of a cube, e.g. the result of fitting
+        every spectrum of a map.
+
+        :param func: Line shape function, called as func(p, wavenumbers) with a
+                    (k, P, npar) batch of parameters.
+        :param params: Array of shape (..., P*npar), the parameters of each
+                    spectrum flattened as for fit_batch. May be memory mapped.
+        :param wavenumbers: The N points to evaluate the spectra at.
+        :param out: (Optional) See apply.
+        :param chunk_size: (Optional) See apply.
+        :param npar: (Optional) Number of parameters per peak, when params is
+                    flat. Default is 4 for voigt and pseudo_voigt, 3 otherwise.
+        :returns: SpectralCube of the spectra, shape params.shape[:-1] + (N,).
+        """
+        from .fitting import _NPARAMS
+        if npar is None:
+            npar = _NPARAMS.get(func, 3)
+        wavenumbers = np.asarray(wavenumbers, dtype=float)
+
+        def spectra(block):
+            return func(block.reshape((len(block), -1, npar)), wavenumbers)
+
+        cube = cls(params, np.zeros(params.shape[-1]))
+        return cube.apply(spectra, out=out, chunk_size=chunk_size,
+                out_channels=len(wavenumbers), wavenumbers=wavenumbers)
@@ -1,65 +1,201 @@
+import os
+import time
+from functools import partial
 import numpy as np
-from scipy.optimize import leastsq, curve_fit
+from concurrent.futures import ProcessPoolExecutor
 
+from . import instrument
+from .functions import lorentz, gaussian, voigt, pseudo_voigt, lorentz_jac, gaussian_jac, voigt_jac, pseudo_voigt_jac
 
-def multifit(func, datax, datay, datayerrors, p0, dataxerrors=None, iterations=1000, func_residuals=False, extra_args=None, _random_generator=np.random):
+# Analytic Jacobians of the built in line shapes, which take (p, x).
+_JACOBIANS = {
+    lorentz: lorentz_jac,
+    gaussian: gaussian_jac,
+    voigt: voigt_jac,
+    pseudo_voigt: pseudo_voigt_jac,
+}
+
+# Number of parameters per peak of the built in line shapes, when not 3.
+_NPARAMS = {
+    voigt: 4,
+    pseudo_voigt: 4,
+}
+
+
+def _lookup(table, func, default=None):
+    """
+    table.get(func, default), also for unhashable callables.
+    """
+    try:
+        return table.get(func, default)
+    except TypeError:
+        return default
+
+
+class _Residuals(object):
+    """
+    Residuals of func for leastsq. A class rather than a closure so it can be
+    sent to worker processes.
+    """
+
+    def __init__(self, func, func_residuals=False):
+        self.func = func
+        self.func_residuals = func_residuals
+        # The analytic Jacobian of a built in line shape, which takes (p, x)
+        self.jacobian = _lookup(_JACOBIANS, func)
+
+    def __call__(self, p, x, y, *extra):
+        if self.jacobian is not None:
+            return self.func(p, x) - y
+        if self.func_residuals:
+            return self.func(p, x, y, *extra)
+        # If func does not compute residuals, we need to do it ourselves.
+        return self.func(x, *(tuple(p) + extra)) - y
+
+
+class _Jacobian(object):
+    """
+    Jacobian of the residuals for leastsq's Dfun, from a jac with the same
+    call convention as func.
+    """
+
+    def __init__(self, jac, func_residuals=False, builtin=False):
+        self.jac = jac
+        self.func_residuals = func_residuals
+        self.builtin = builtin
+
+    def __call__(self, p, x, y, *extra):
+        if self.builtin:
+            return self.jac(p, x)
+        if self.func_residuals:
+            return self.jac(p, x, y, *extra)
+        return self.jac(x, *(tuple(p) + extra))
+
+
+def _fit_perturbed(errfunc, Dfun, p0, datax, datay, deltay, deltax, extra_args):
+    """
+    Fit each of the perturbed data sets datay + deltay[i], datax + deltax[i].
+
+    :returns: Array of the fitted parameters, one row per data set.
+    """
+    from scipy.optimize import leastsq
+    fits = []
+    instrumented = instrument.enabled()
+    if instrumented:
+        tic = time.perf_counter()
+        evaluations = np.zeros(len(deltay), dtype=int)
+        status = np.zeros(len(deltay), dtype=int)
+    for i in range(len(deltay)):
+        randomdataX = datax if deltax is None else datax + deltax[i]
+        args = (randomdataX, datay + deltay[i])
+        if extra_args is not None:
+            args += extra_args
+        if instrumented:
+            randomfit, randomcov, info, message, status[i] = \
+                leastsq( errfunc, p0, args=args, Dfun=Dfun,\
+                                full_output=1, maxfev=10000)
+            evaluations[i] = info['nfev']
+        else:
+            randomfit, randomcov = \
+                leastsq( errfunc, p0, args=args, Dfun=Dfun,\
+                                full_output=0, maxfev=10000)
+        fits.append(randomfit)
+    if instrumented:
+        # leastsq status 5 is maxfev reached, above 4 is a failure
+        instrument.emit('multifit', fits=len(deltay), evaluations=evaluations,
+                maxfev_reached=status == 5, failed=(status < 1) | (status > 4),
+                time=time.perf_counter() - tic)
+    return np.array(fits).reshape((len(fits), np.size(p0)))
+
+
+def _draw(rng, iterations, yscale, n, dataxerrors):
+    """
+    Draw the perturbations of all iterations at once.
+
+    :returns: (y perturbations, x perturbations or None), shape (iterations, n)
+    """
+    deltay = rng.normal(0., yscale, (iterations, n))
+    deltax = None
+    if dataxerrors is not None:
+        deltax = rng.normal(0., dataxerrors, (iterations, n))
+    return deltay, deltax
+
+
+def _monte_carlo(seed, iterations, yscale, dataxerrors, errfunc, Dfun, p0, datax, datay, extra_args):
+    """
+    Draw and fit iterations perturbed data sets with a generator seeded from
+    seed, a numpy.random.SeedSequence.
+    """
+    rng = np.random.default_rng(seed)
+    deltay, deltax = _draw(rng, iterations, yscale, len(datay), dataxerrors)
+    return _fit_perturbed(errfunc, Dfun, p0, datax, datay, deltay, deltax, extra_args)
+
+
+def multifit(func, datax, datay, datayerrors, p0, dataxerrors=None, iterations=1000, func_residuals=False, extra_args=None, _random_generator=np.random, seed=None, n_jobs=1, jac=None):
     """
     Does Monte Carlo fitting by varying the datay by datayerrors in order to estimate the error on the fitting parameters.
 
+    The perturbations of all iterations are drawn at once. With n_jobs or a
+    seed, the iterations are split over n_jobs workers, each drawing from its
+    own numpy.random.Generator spawned from seed, so the result is
+    reproducible for a given seed and n_jobs.
+
     :param func: The function for fitting. func takes independent variable as first parameter, dependent variable 2nd, then fitting variables next.
+                The built in line shapes, e.g. lorentz, can also be passed directly, with p0 as their parameters. Their analytic Jacobians are then used.
     :param func_residuals: (Optional) True if func calculates residuals. False if func returns values, not residuals. Default False.
     :param extra_args: (Optional) list of extra arguments to pass to func,.
+    :param seed: (Optional) Seed for the numpy.random.SeedSequence of the workers. Default uses _random_generator when n_jobs is 1, fresh entropy otherwise.
+    :param n_jobs: (Optional) Number of worker processes. None uses all CPUs. func must be picklable for more than 1. Default 1.
+    :param jac: (Optional) Jacobian of func with respect to the fitting variables, called with the same arguments as func and returning an array of shape (len(datax), len(p0)). Default uses finite differences, or the analytic Jacobian of a built in line shape.
 
     :returns: [fitted parameters, standard deviation means for the fitted parameters of all the iterations]
     """
-    if func_residuals:
-        errfunc = func
-    else:
-        # If func does not compute residuals, we need to do it ourselves.
-        errfunc = lambda p, x, y, *extra: func(x,*p+extra) - y if len(extra) > 0 else func(x,*p)-y
+    from scipy.optimize import leastsq
+    errfunc = _Residuals(func, func_residuals)
+    Dfun = None
+    if jac is not None:
+        Dfun = _Jacobian(jac, func_residuals)
+    elif errfunc.jacobian is not None:
+        Dfun = _Jacobian(errfunc.jacobian, builtin=True)
+        p0 = np.ravel(p0)
+    datax = np.asarray(datax)
+    datay = np.asarray(datay)
+    if extra_args is not None:
+        extra_args = tuple(extra_args)
     # Fit the data with curvefit
     args = (datax, datay)
     if extra_args is not None:
         args += extra_args
     pfit, perr = \
-        leastsq(errfunc, p0, args=args,\
+        leastsq(errfunc, p0, args=args, Dfun=Dfun,\
                         full_output=0, maxfev=10000)
 
     # Get the residuals
     residuals = errfunc(pfit, *args)
 
     s_res = np.std(residuals, ddof=1)
-    ps = []
-    # 100 random data sets are generated and fitted
-    for i in range(iterations):
-        if len(ps) < 1:
-            guess = pfit
-        else:
-            guess = np.mean(ps, axis=0)
-        if datayerrors is None:
-            randomDelta = _random_generator.normal(0., s_res, len(datay))
-            randomdataY = datay + randomDelta
-        else:
-            randomDelta =  np.array( [ \
-                                _random_generator.normal(0., derr,1)[0] \
-                                for derr in datayerrors ] )
-            randomdataY = datay + randomDelta
-        if dataxerrors is None:
-            randomdataX = datax
+    if datayerrors is None:
+        yscale = s_res
+    else:
+        yscale = np.asarray(datayerrors)
+
+    # random data sets are generated and fitted
+    if seed is None and n_jobs == 1:
+        deltay, deltax = _draw(_random_generator, iterations, yscale, len(datay), dataxerrors)
+        ps = _fit_perturbed(errfunc, Dfun, p0, datax, datay, deltay, deltax, extra_args)
+    else:
+        if n_jobs is None:
+            n_jobs = os.cpu_count() or 1
+        seeds = np.random.SeedSequence(seed).spawn(n_jobs)
+        counts = [len(part) for part in np.array_split(np.arange(iterations), n_jobs)]
+        jobs = [(s, count, yscale, dataxerrors, errfunc, Dfun, p0, datax, datay, extra_args) for s, count in zip(seeds, counts)]
+        if n_jobs == 1:
+            ps = _monte_carlo(*jobs[0])
         else:
-            randomDeltaX =  np.array( [ \
-                                _random_generator.normal(0., derr,1)[0] \
-                                for derr in dataxerrors ] )
-            randomdataX = datax + randomDeltaX
-        args = (randomdataX, randomdataY)
-        if extra_args is not None:
-            args += extra_args
-        randomfit, randomcov = \
-            leastsq( errfunc, p0, args=args,\
-                            full_output=0, maxfev=10000)
-        ps.append( randomfit )
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                futures = [pool.submit(_monte_carlo, *job) for job in jobs]
+                ps = np.concatenate([future.result() for future in futures])
 
-    ps = np.array(ps)
     mean_pfit = np.mean(ps,0)
     Nsigma = 1. # 1sigma gets approximately the same as methods above
     # 1sigma corresponds to 68.3% confidence interval
@@ -70,3 +206,284 @@ def multifit(func, datax, datay, datayerrors, p0, dataxerrors=None, iterations=1
     perr = err_pfit
 
     return pfit, perr
+
+
+def _numerical_jacobian(model, p, x, step=1e-7):
+    """
+    Forward difference Jacobian of a batch model, shape (S, len(x), K).
+    """
+    S = p.shape[0]
+    flat = p.reshape((S, -1))
+    f0 = model(p, x)
+    jac = np.empty(f0.shape + (flat.shape[1],))
+    for k in range(flat.shape[1]):
+        h = step*np.maximum(np.abs(flat[:, k]), 1.)
+        shifted = flat.copy()
+        shifted[:, k] += h
+        jac[..., k] = (model(shifted.reshape(p.shape), x) - f0) / h[:, None]
+    return jac
+
+
+def _solve_normal(A, b):
+    """
+    Solve the stacked normal equations A x = b, falling back to the pseudo
+    inverse when some of them are singular.
+    """
+    try:
+        return np.linalg.solve(A, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return np.einsum('akl,al->ak', np.linalg.pinv(A), b)
+
+
+def _levenberg_marquardt(model, jac, x, Y, p0, maxiter, ftol, xtol):
+    """
+    Levenberg-Marquardt fits of model to every row of Y at once.
+
+    Each row has its own damping and trust radius, as in MINPACK: a step is
+    bounded by the radius, and accepted only if the actual reduction of the
+    sum of squares is a fair part of the reduction predicted by the
+    linearized model. Each row stops as soon as it converges.
+
+    :param p0: Initial parameters, shape (M, P, npar).
+    :returns: (parameters, covariances, costs, iterations, success)
+    """
+    M, N = Y.shape
+    pshape = p0.shape[1:]
+    K = int(np.prod(pshape))
+
+    p = p0.astype(float)
+    cost = np.empty(M)
+    niter = np.zeros(M, dtype=int)
+    success = np.zeros(M, dtype=bool)
+    mu = np.full(M, 1.e-3)
+
+    # Rows with non-finite data or guesses are not fitted
+    finite = np.isfinite(Y).all(axis=1) & np.isfinite(p.reshape((M, K))).all(axis=1)
+    p[~finite] = np.nan
+    cost[~finite] = np.nan
+    active = np.flatnonzero(finite)
+    r = model(p[active], x) - Y[active]
+    cost[active] = np.square(r).sum(axis=1)
+    J = jac(p[active], x).reshape((-1, N, K))
+
+    # The parameters are scaled by the largest norm of their column of the
+    # Jacobian so far, and the initial trust radius is 100 times the scaled
+    # norm of p0, both as in MINPACK
+    scale = np.zeros((M, K))
+    scale[active] = np.sqrt(np.einsum('ank,ank->ak', J, J))
+    radius = np.zeros(M)
+    radius[active] = 100.*np.linalg.norm(scale[active]*p[active].reshape((-1, K)), axis=1)
+    radius[radius == 0.] = 100.
+
+    for i in range(maxiter):
+        if active.size == 0:
+            break
+        pa = p[active]
+        Jt = J.transpose((0, 2, 1))
+        JtJ = np.matmul(Jt, J)
+        g = np.matmul(Jt, r[..., None])[..., 0]
+
+        # Marquardt's scaling of the damping
+        scale[active] = np.maximum(scale[active], np.sqrt(np.einsum('akk->ak', JtJ)))
+        diag = np.maximum(np.square(scale[active]), 1.e-12)
+        damped = JtJ.copy()
+        damped[:, np.arange(K), np.arange(K)] += mu[active, None]*diag
+        delta = -_solve_normal(damped, g)
+
+        # Bound the step by the trust radius, in the same scaling
+        dnorm = np.linalg.norm(np.sqrt(diag)*delta, axis=1)
+        bound = np.minimum(dnorm, radius[active])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta *= np.where(dnorm > bound, bound/dnorm, 1.)[:, None]
+
+        p_new = pa + delta.reshape((-1,) + pshape)
+        r_new = model(p_new, x) - Y[active]
+        cost_new = np.square(r_new).sum(axis=1)
+        niter[active] += 1
+
+        # The gain ratio, of the actual to the predicted reduction
+        actual = cost[active] - cost_new
+        predicted = cost[active] - np.square(r + np.matmul(J, delta[..., None])[..., 0]).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            gain = actual / predicted
+        accept = np.isfinite(cost_new) & (gain > 1.e-4)
+
+        # Shrink the radius and raise the damping after poor steps, relax
+        # both after good ones
+        poor = ~(gain >= 0.25)
+        good = gain >= 0.75
+        radius[active] = np.where(poor, 0.5*np.minimum(radius[active], 10.*bound),
+                np.where(good, np.maximum(radius[active], 2.*bound), radius[active]))
+        mu[active] *= np.where(~accept, 10., np.where(poor, 2., np.where(good, 1./3., 1.)))
+
+        small_step = np.linalg.norm(delta, axis=1) <= xtol*(np.linalg.norm(pa.reshape((-1, K)), axis=1) + xtol)
+        small_change = (np.abs(actual) <= ftol*cost[active]) & (predicted <= ftol*cost[active])
+        converged = (accept & small_step) | small_change
+        stuck = mu[active] > 1.e16
+
+        # Move the accepted rows
+        rows = active[accept]
+        p[rows] = p_new[accept]
+        cost[rows] = cost_new[accept]
+        r[accept] = r_new[accept]
+        if np.any(accept):
+            J[accept] = jac(p_new[accept], x).reshape((-1, N, K))
+
+        success[active[converged]] = True
+        keep = ~(converged | stuck)
+        active = active[keep]
+        r = r[keep]
+        J = J[keep]
+
+    # Covariance from the Jacobian at the solution, scaled by the residual variance
+    cov = np.full((M, K, K), np.nan)
+    if np.any(finite):
+        J = jac(p[finite], x).reshape((-1, N, K))
+        JtJ = np.matmul(J.transpose((0, 2, 1)), J)
+        ok = np.isfinite(JtJ).all(axis=(1, 2))
+        rows = np.flatnonzero(finite)[ok]
+        cov[rows] = np.linalg.pinv(JtJ[ok]) * (cost[rows] / max(N - K, 1))[:, None, None]
+    return p, cov, cost, niter, success
+
+
+def _fit_batch(model, jac, x, Y, p0, map_width, maxiter, ftol, xtol):
+    """
+    fit_batch on p0 of shape (M, P, npar), optionally seeding each map row
+    from the converged parameters of the row before it. Emits one event for
+    all the map rows.
+    """
+    instrumented = instrument.enabled()
+    if instrumented:
+        tic = time.perf_counter()
+
+    if map_width is None:
+        result = _levenberg_marquardt(model, jac, x, Y, p0, maxiter, ftol, xtol)
+    else:
+        result = _fit_map_rows(model, jac, x, Y, p0, map_width, maxiter, ftol, xtol)
+
+    if instrumented:
+        p, cov, cost, niter, success = result
+        # the model is evaluated once at the start and once per iteration
+        instrument.emit('fit_batch', spectra=len(Y), iterations=niter, evaluations=niter + 1,
+                success=success, cost=cost, time=time.perf_counter() - tic)
+    return result
+
+
+def _fit_map_rows(model, jac, x, Y, p0, map_width, maxiter, ftol, xtol):
+    """
+    _levenberg_marquardt one map row at a time, each row starting from the
+    converged parameters of the row before it.
+    """
+    results = []
+    for start in range(0, len(Y), map_width):
+        stop = min(start+map_width, len(Y))
+        guess = np.array(p0[start:stop])
+        if start > 0:
+            # Start from the pixel above, unless its fit failed
+            previous = results[-1]
+            n = stop - start
+            ok = previous[4][:n]
+            guess[ok] = previous[0][:n][ok]
+        results.append(_levenberg_marquardt(model, jac, x, Y[start:stop], guess, maxiter, ftol, xtol))
+    return tuple(np.concatenate(parts) for parts in zip(*results))
+
+
+def _fit_batch_packed(block, model, jac, x, pshape, **kwargs):
+    """
+    _fit_batch for map_spectra. block is [Y | p0], the result is
+    [parameters | covariances | cost | iterations | success].
+    """
+    K = int(np.prod(pshape))
+    N = block.shape[1] - K
+    p0 = block[:, N:].reshape((-1,) + pshape)
+    p, cov, cost, niter, success = _fit_batch(model, jac, x, block[:, :N], p0, **kwargs)
+    return np.hstack((p.reshape((-1, K)), cov.reshape((-1, K*K)), cost[:, None], niter[:, None], success[:, None]))
+
+
+def fit_batch(model, x, Y, p0, jac=None, maxiter=200, ftol=1.e-10, xtol=1.e-10, map_width=None, full_output=False, n_jobs=1, chunk_size=None):
+    """
+    Fit the same model to every spectrum of a stack at once, with a vectorized
+    Levenberg-Marquardt. The residuals and Jacobians of all spectra are
+    stacked, each spectrum has its own damping, and each spectrum stops
+    iterating as soon as it converges. Spectra with a NaN, in Y or in their
+    p0, are not fitted: they get NaN parameters and covariances, and success
+    False.
+
+    Usage:
+    >>> from spyctra import lorentz
+    >>> from spyctra.fitting import fit_batch
+    >>> # Y is a (M, N) stack of spectra measured at x
+    >>> params, cov = fit_batch(lorentz, x, Y, [[3., 520., 100.], [4., 960., 20.]])
+
+    :param model: The model, called as model(p, x) with p of shape
+                (S, P, npar), returning the (S, len(x)) values for S parameter
+                sets. The built in line shapes, e.g. lorentz, work this way.
+    :param x: The x values of the spectra, shape (N,).
+    :param Y: The spectra, shape (M, N).
+    :param p0: Initial parameters, in the lorentz convention: flat or (P, npar)
+                for all spectra, or (M, P, npar) with one guess per spectrum.
+    :param jac: (Optional) Jacobian of model, called as jac(p, x) and returning
+                shape (S, len(x), P*npar). Default uses the analytic Jacobian
+                of a built in line shape, or forward differences.
+    :param maxiter: (Optional) Maximum iterations per spectrum. Default 200.
+    :param ftol: (Optional) Stop when the relative decrease of the sum of
+                squares is below ftol. Default 1.e-10.
+    :param xtol: (Optional) Stop when the relative step is below xtol. Default 1.e-10.
+    :param map_width: (Optional) Width of the map, if the rows of Y are the
+                pixels of a map in raster order. Each map row is then fitted
+                from the converged parameters of the row above it, instead of
+                from p0. With n_jobs, the first map row of each chunk starts
+                from p0, so the results depend on the chunking. Default None.
+    :param full_output: (Optional) True to also return a dict with the 'cost',
+                number of 'iterations' and 'success' of each spectrum.
+    :param n_jobs: (Optional) Number of worker processes. None uses all CPUs.
+                model and jac must be picklable for more than 1. Default 1.
+    :param chunk_size: (Optional) Number of spectra per worker task, rounded up
+                to whole map rows with map_width. Default about 4 tasks per
+                worker, see spyctra.parallel.map_spectra.
+    :returns: (parameters, covariances). parameters has shape (M,) + the shape
+                of the parameters of one spectrum, covariances (M, K, K) for
+                the K flattened parameters.
+    """
+    x = np.asarray(x, dtype=float)
+    Y = np.array(Y, dtype=float, ndmin=2)
+    M, N = Y.shape
+    p0 = np.array(p0, dtype=float)
+
+    # The parameters of one spectrum, as given, and as (P, npar)
+    if p0.ndim == 3:
+        shape = p0.shape[1:]
+    else:
+        shape = p0.shape
+    npar = shape[-1] if len(shape) > 1 else _lookup(_NPARAMS, model, 3)
+    pshape = (int(np.prod(shape)) // npar, npar)
+    p0 = np.array(np.broadcast_to(p0.reshape((-1,) + pshape), (M,) + pshape))
+
+    if jac is None:
+        jac = _lookup(_JACOBIANS, model)
+        if jac is None:
+            jac = partial(_numerical_jacobian, model)
+    kwargs = dict(map_width=map_width, maxiter=maxiter, ftol=ftol, xtol=xtol)
+
+    if n_jobs != 1:
+        from .parallel import map_spectra
+        K = int(np.prod(pshape))
+        if map_width is not None:
+            # Whole map rows per task, or the rows would lose their seeds
+            if chunk_size is None:
+                workers = os.cpu_count() or 1 if n_jobs is None else n_jobs
+                chunk_size = -(-M // (4*workers))
+            chunk_size = -(-chunk_size // map_width) * map_width
+        packed = map_spectra(_fit_batch_packed, np.hstack((Y, p0.reshape((M, K)))),
+                n_jobs=n_jobs, chunk_size=chunk_size, out_channels=K + K*K + 3,
+                model=model, jac=jac, x=x, pshape=pshape, **kwargs)
+        p = packed[:, :K].reshape((M,) + pshape)
+        cov = packed[:, K:K+K*K].reshape((M, K, K))
+        cost, niter, success = packed[:, -3], packed[:, -2].astype(int), packed[:, -1].astype(bool)
+    else:
+        p, cov, cost, niter, success = _fit_batch(model, jac, x, Y, p0, **kwargs)
+
+    params = p.reshape((M,) + shape)
+    if full_output:
+        return params, cov, {'cost': cost, 'iterations': niter, 'success': success}
+    return params, cov
@@ -3,7 +3,115 @@ Implementation of useful functions.
 """
 import numpy as np
 
-def lorentz(p, x):
+from ._dtypes import float_dtype
+
+# Largest number of elements of the temporary (peaks, len(x)) arrays that are
+# evaluated at once. Peaks are summed in chunks to stay below it, which keeps
+# the temporaries in cache.
+_CHUNK_ELEMENTS = 2**16
+
+def _peaks(p, npar=3, dtype=None):
+    """
+    The parameters as an array with one row of npar parameters per peak,
+    shape (P, npar), or (S, P, npar) for a batch of S parameter sets.
+    """
+    params = np.array(p, dtype=float if dtype is None else dtype)
+
+    if params.ndim < 2:
+        ## Reshape a flattened array into full array
+        n = len(params)
+        total = n // npar
+        if total > 1:
+            params = params.reshape((total, npar))
+        else:
+            params = params.reshape((1, npar))
+
+    return params
+
+def _columns(params, ndim):
+    """
+    The parameter columns of params, shaped to broadcast against an x with
+    ndim dimensions.
+    """
+    shape = params.shape[:-1] + (1,)*ndim
+    return [params[..., i].reshape(shape) for i in range(params.shape[-1])]
+
+def _evaluate(kernel, params, x, chunk_size=None):
+    """
+    Sum of kernel(x, *parameters) over the peaks, evaluated for all peaks at
+    once in chunks of chunk_size peaks. Batches of parameter sets are split
+    into chunks as well, so the temporaries stay small.
+
+    :returns: Array of shape params.shape[:-2] + x.shape.
+    """
+    x = np.asarray(x, dtype=params.dtype)
+    batch = params.shape[:-2]
+    npeaks, npar = params.shape[-2:]
+    if chunk_size is None:
+        chunk_size = max(1, _CHUNK_ELEMENTS // max(1, x.size))
+    chunk_size = min(chunk_size, npeaks)
+    # parameter sets per chunk
+    sets = max(1, _CHUNK_ELEMENTS // (chunk_size*max(1, x.size)))
+
+    params = params.reshape((-1, npeaks, npar))
+    result = np.zeros((len(params),) + x.shape, dtype=params.dtype)
+    for first in range(0, len(params), sets):
+        block = params[first:first+sets]
+        for start in range(0, npeaks, chunk_size):
+            chunk = block[:, start:start+chunk_size]
+            result[first:first+sets] += kernel(x, *_columns(chunk, x.ndim)).sum(axis=1)
+
+    result = result.reshape(batch + x.shape)
+    if result.ndim == 0:
+        return result[()]
+    return result
+
+def _jacobian(kernel_jac, params, x):
+    """
+    Derivatives of the sum of kernel over the peaks with respect to the
+    flattened parameters.
+
+    :param kernel_jac: Returns the list of derivatives of kernel(x, *parameters)
+                with respect to each parameter.
+    :returns: Array of shape params.shape[:-2] + x.shape + (P*npar,).
+    """
+    x = np.asarray(x, dtype=params.dtype)
+    batch = params.shape[:-2]
+    npeaks, npar = params.shape[-2:]
+
+    # batch + (P,) + x.shape + (npar,), then move the peaks next to the parameters
+    jac = np.stack(kernel_jac(x, *_columns(params, x.ndim)), axis=-1)
+    jac = np.moveaxis(jac, len(batch), -2)
+    return jac.reshape(batch + x.shape + (npeaks*npar,))
+
+def _lorentz(x, gamma, xo, amplitude):
+    u = x - xo
+    u /= gamma
+    np.square(u, out=u)
+    u += 1
+    return np.divide(amplitude, u, out=u)
+
+def _lorentz_jac(x, gamma, xo, amplitude):
+    u = (x - xo)/gamma
+    shape = 1./(1 + np.square(u))
+    dxo = 2.*amplitude*np.square(shape)*u/gamma
+    return [dxo*u, dxo, shape]
+
+def _gaussian(x, sigma, xo, amplitude):
+    u = x - xo
+    u /= sigma
+    np.square(u, out=u)
+    u *= -0.5
+    np.exp(u, out=u)
+    return np.multiply(amplitude, u, out=u)
+
+def _gaussian_jac(x, sigma, xo, amplitude):
+    u = (x - xo)/sigma
+    shape = np.exp(- 0.5 * np.square(u))
+    dxo = amplitude*shape*u/sigma
+    return [dxo*u, dxo, shape]
+
+def lorentz(p, x, dtype=None, chunk_size=None):
     """
     Lorentzian function.
 
@@ -14,7 +122,17 @@ def lorentz(p, x):
                 multiple lorentzians.
                 You can also pass in a 1D array with multiple sets of parameters, if
                 so the function will return the sum of the gaussians.
-    :returns: Element by element lorenzian.
+                A 3D array of shape (S, P, 3) evaluates S sets of P lorentzians
+                at once.
+    :param x: Single value or array of x values.
+    :param dtype: (Optional) Floating point type of the calculation, e.g.
+                numpy.float32 for large grids. Default is float32 for a
+                float32 x, float64 otherwise. See spyctra._dtypes for the
+                accuracy of float32.
+    :param chunk_size: (Optional) Number of peaks evaluated at once. Default
+                keeps the temporary arrays around 512 kB.
+    :returns: Element by element lorenzian. Shape x.shape, or (S,) + x.shape
+                for 3D parameters.
 
     To use the single value:
 
@@ -35,26 +153,11 @@ def lorentz(p, x):
     array([2.8642, 3.3383])
 
     """
-    params = np.array(p)
-    x = np.array(x)
+    params = _peaks(p, dtype=float_dtype(dtype, x))
 
-    if params.ndim < 2:
-        ## Reshape a flattened array into full array
-        n = len(params)
-        total = n // 3
-        if total > 1:
-            params = params.reshape((total, 3))
-        else:
-            params = np.array([params])
-
-    result = 0.
-
-    for param in params:
-        result += param[2] / (1 + np.square((1.*x - param[1])/param[0]))
-
-    return result
+    return _evaluate(_lorentz, params, x, chunk_size)
 
-def gaussian(p, x):
+def gaussian(p, x, dtype=None, chunk_size=None):
     """
     The Gaussian function
 
@@ -65,8 +168,16 @@ def gaussian(p, x):
             will return the sum of the gaussians.
             You can also pass in a 1D array with multiple sets of parameters, if
             so the function will return the sum of the gaussians.
+            A 3D array of shape (S, P, 3) evaluates S sets of P gaussians at
+            once.
     :param x: Single value or array of x values.
-    :returns: Gaussian along x.
+    :param dtype: (Optional) Floating point type of the calculation, e.g.
+            numpy.float32 for large grids. Default is float32 for a float32
+            x, float64 otherwise.
+    :param chunk_size: (Optional) Number of peaks evaluated at once. Default
+            keeps the temporary arrays around 512 kB.
+    :returns: Gaussian along x. Shape x.shape, or (S,) + x.shape for 3D
+            parameters.
 
     To use the single value:
 
@@ -86,21 +197,193 @@ def gaussian(p, x):
     >>> result = gaussian(params, x)
 
     """
-    params = np.array(p)
-    x = np.array(x)
+    params = _peaks(p, dtype=float_dtype(dtype, x))
 
-    if params.ndim < 2:
-        ## Reshape a flattened array into full array
-        n = len(params)
-        total = n // 3
-        if total > 1:
-            params = params.reshape((total, 3))
-        else:
-            params = np.array([params])
+    return _evaluate(_gaussian, params, x, chunk_size)
 
-    result = 0.
+def lorentz_jac(p, x):
+    """
+    Jacobian of lorentz with respect to its parameters.
+
+    :param p: Parameters as for lorentz, for one or more peaks, or a 3D batch.
+    :param x: Single value or array of x values.
+    :returns: Array of shape x.shape + (3*P,) for P peaks, or
+                (S,) + x.shape + (3*P,) for 3D parameters. The last axis is in
+                the order of the flattened parameters,
+                d/dgamma, d/dxo, d/damplitude for each peak.
+    """
+    return _jacobian(_lorentz_jac, _peaks(p), x)
 
-    for param in params:
-        result += param[2] * np.exp(- 0.5 * np.square((1.*x - param[1]) / param[0]))
+def gaussian_jac(p, x):
+    """
+    Jacobian of gaussian with respect to its parameters.
 
-    return result
+    :param p: Parameters as for gaussian, for one or more peaks, or a 3D batch.
+    :param x: Single value or array of x values.
+    :returns: Array of shape x.shape + (3*P,) for P peaks, or
+                (S,) + x.shape + (3*P,) for 3D parameters. The last axis is in
+                the order of the flattened parameters,
+                d/dsigma, d/dmean, d/damplitude for each peak.
+    """
+    return _jacobian(_gaussian_jac, _peaks(p), x)
+
+def _pseudo_voigt_parts(x, gamma, xo):
+    u = (x - xo)/gamma
+    lorentzian = 1./(1 + np.square(u))
+    gaussian = np.exp(- np.log(2.) * np.square(u))
+    return u, lorentzian, gaussian
+
+def _pseudo_voigt(x, gamma, xo, amplitude, eta):
+    u, lorentzian, gaussian = _pseudo_voigt_parts(x, gamma, xo)
+    return amplitude*(eta*lorentzian + (1 - eta)*gaussian)
+
+def _pseudo_voigt_jac(x, gamma, xo, amplitude, eta):
+    u, lorentzian, gaussian = _pseudo_voigt_parts(x, gamma, xo)
+    du = -2.*amplitude*u*(eta*np.square(lorentzian) + (1 - eta)*np.log(2.)*gaussian)
+    return [-du*u/gamma, -du/gamma, eta*lorentzian + (1 - eta)*gaussian, amplitude*(lorentzian - gaussian)]
+
+def _voigt(x, sigma, gamma, xo, amplitude):
+    from scipy.special import wofz, erfcx
+    s = sigma*np.sqrt(2.)
+    z = ((x - xo) + 1j*gamma)/s
+    return amplitude*wofz(z).real/erfcx(gamma/s)
+
+def _voigt_jac(x, sigma, gamma, xo, amplitude):
+    from scipy.special import wofz, erfcx
+    s = sigma*np.sqrt(2.)
+    z = ((x - xo) + 1j*gamma)/s
+    w = wofz(z)
+    # w'(z) = -2 z w(z) + 2i/sqrt(pi)
+    dw = -2.*z*w + 2j/np.sqrt(np.pi)
+    t = gamma/s
+    F = w.real
+    F0 = erfcx(t)
+    dF0 = 2.*t*F0 - 2./np.sqrt(np.pi)
+
+    def quotient(dF, dF0_):
+        return amplitude*(dF*F0 - F*dF0_)/np.square(F0)
+
+    dsigma = quotient((dw*(-z/sigma)).real, dF0*(-t/sigma))
+    dgamma = quotient((dw*1j/s).real, dF0/s)
+    dxo = amplitude*(dw*(-1./s)).real/F0
+    return [dsigma, dgamma, dxo, F/F0]
+
+def _voigt_tch(x, sigma, gamma, xo, amplitude):
+    # Thompson, Cox and Hastings pseudo-Voigt with the FWHM and mixing of the
+    # Voigt profile, J. Appl. Cryst. 20, 79 (1987).
+    fg = 2.*np.sqrt(2.*np.log(2.))*sigma
+    fl = 2.*gamma
+    f = (fg**5 + 2.69269*fg**4*fl + 2.42843*fg**3*fl**2 + 4.47163*fg**2*fl**3
+            + 0.07842*fg*fl**4 + fl**5)**0.2
+    r = fl/f
+    eta = 1.36603*r - 0.47719*r**2 + 0.11116*r**3
+    # The pseudo-Voigt normalized to a peak height of 1
+    lorentz0 = 2./(np.pi*f)
+    gauss0 = 2.*np.sqrt(np.log(2.)/np.pi)/f
+    height = eta*lorentz0 + (1 - eta)*gauss0
+    return _pseudo_voigt(x, f/2., xo, amplitude, eta*lorentz0/height)
+
+def _difference_jac(kernel, step=1e-6):
+    """
+    Central difference derivatives of a kernel. Every peak only depends on its
+    own parameters, so each parameter is stepped for all peaks at once, which
+    takes 2*npar evaluations of the kernel.
+    """
+    def kernel_jac(x, *columns):
+        derivatives = []
+        for i, column in enumerate(columns):
+            h = step*np.maximum(np.abs(column), 1.)
+            up = list(columns)
+            down = list(columns)
+            up[i] = column + h
+            down[i] = column - h
+            derivatives.append((kernel(x, *up) - kernel(x, *down)) / (2*h))
+        return derivatives
+    return kernel_jac
+
+def voigt(p, x, approximate=False, dtype=None, chunk_size=None):
+    """
+    The Voigt profile, a gaussian convolved with a lorentzian, scaled to a peak
+    height of amplitude.
+
+    amplitude * Re[w(z)] / Re[w(z0)],
+    z = (x - xo + i*gamma) / (sigma*sqrt(2)), z0 = i*gamma / (sigma*sqrt(2))
+
+    where w is the Faddeeva function.
+
+    :param p: Parameters. p[0] = sigma, p[1] = gamma, p[2] = xo, p[3] = amplitude.
+            sigma is the standard deviation of the gaussian and gamma the half
+            width at half maximum of the lorentzian.
+            As for lorentz, a 2D array or a flat array with multiple sets of
+            parameters returns the sum of the peaks, and a 3D array of shape
+            (S, P, 4) evaluates S sets of P peaks at once.
+    :param x: Single value or array of x values.
+    :param approximate: (Optional) True to use the Thompson-Cox-Hastings
+            pseudo-Voigt instead of the Faddeeva function. It is several
+            times faster and within 1.2% of the peak height of the Voigt
+            profile. Default False.
+    :param dtype: (Optional) Floating point type of the result. Default is
+            float32 for a float32 x, float64 otherwise.
+    :param chunk_size: (Optional) Number of peaks evaluated at once.
+    :returns: Voigt profile along x.
+
+    >>> x = np.linspace(0., 100., 500)
+    >>> params = [[2., 1., 30., 50.], [3., 2., 60., 20.]]
+    >>> result = voigt(params, x)
+    """
+    params = _peaks(p, npar=4, dtype=float_dtype(dtype, x))
+
+    return _evaluate(_voigt_tch if approximate else _voigt, params, x, chunk_size)
+
+def voigt_jac(p, x, approximate=False):
+    """
+    Jacobian of voigt with respect to its parameters.
+
+    :param p: Parameters as for voigt.
+    :param x: Single value or array of x values.
+    :param approximate: (Optional) True for the Jacobian of the approximate
+                profile, by central differences. Default False.
+    :returns: Array of shape x.shape + (4*P,) for P peaks, or
+                (S,) + x.shape + (4*P,) for 3D parameters. The last axis is in
+                the order of the flattened parameters,
+                d/dsigma, d/dgamma, d/dxo, d/damplitude for each peak.
+    """
+    kernel_jac = _difference_jac(_voigt_tch) if approximate else _voigt_jac
+    return _jacobian(kernel_jac, _peaks(p, npar=4), x)
+
+def pseudo_voigt(p, x, dtype=None, chunk_size=None):
+    """
+    The pseudo-Voigt function, a mix of a lorentzian and a gaussian with the
+    same width.
+
+    amplitude * (eta / (1 + u**2) + (1 - eta) * exp(-ln(2) * u**2)),
+    u = (x - xo) / gamma
+
+    :param p: Parameters. p[0] = gamma, p[1] = xo, p[2] = amplitude, p[3] = eta.
+            gamma is the half width at half maximum and eta the lorentzian
+            fraction, between 0 and 1.
+            As for lorentz, a 2D array or a flat array with multiple sets of
+            parameters returns the sum of the peaks, and a 3D array of shape
+            (S, P, 4) evaluates S sets of P peaks at once.
+    :param x: Single value or array of x values.
+    :param dtype: (Optional) Floating point type of the calculation. Default
+            is float32 for a float32 x, float64 otherwise.
+    :param chunk_size: (Optional) Number of peaks evaluated at once.
+    :returns: Pseudo-Voigt along x.
+    """
+    params = _peaks(p, npar=4, dtype=float_dtype(dtype, x))
+
+    return _evaluate(_pseudo_voigt, params, x, chunk_size)
+
+def pseudo_voigt_jac(p, x):
+    """
+    Jacobian of pseudo_voigt with respect to its parameters.
+
+    :param p: Parameters as for pseudo_voigt.
+    :param x: Single value or array of x values.
+    :returns: Array of shape x.shape + (4*P,) for P peaks, or
+                (S,) + x.shape + (4*P,) for 3D parameters. The last axis is in
+                the order of the flattened parameters,
+                d/dgamma, d/dxo, d/damplitude, d/deta for each peak.
+    """
+    return _jacobian(_pseudo_voigt_jac, _peaks(p, npar=4), x)
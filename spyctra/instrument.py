@@ -0,0 +1,120 @@
+"""
+Opt in instrumentation of the hot paths.
+
+While a listener is registered, arPLS, arPLSnd, the other baselines of
+spyctra.baseline (AsLS, airPLS, drPLS, iarPLS), remove_cosmics,
+remove_cosmics_multi, multifit and fit_batch report one event per call:
+a dict with the 'name' of the function and what it did, e.g. the number of
+iterations of each spectrum, its final convergence condition, and the time
+spent in the linear solves. Without listeners, the only cost is checking
+that the listener list is empty.
+
+Events are emitted in the process that does the work, so with n_jobs and
+the 'process' backend the work done in the worker processes is not seen.
+
+Usage:
+>>> from spyctra import arPLS_batch, instrument
+>>> with instrument.record() as recorder:
+...     Z = arPLS_batch(Y)
+>>> recorder.events[0]['iterations']
+>>> recorder.summary()
+>>> # or send every event to a metrics system
+>>> instrument.add_listener(lambda event: metrics.send(event))
+"""
+import threading
+import numpy as np
+
+# Callables that receive every event. Functions check this list is not
+# empty before measuring anything.
+_listeners = []
+_lock = threading.Lock()
+
+
+def enabled():
+    """
+    :returns: True if any listener is registered.
+    """
+    return bool(_listeners)
+
+
+def emit(name, **values):
+    """
+    Send an event to all listeners.
+
+    :param name: Name of the function reporting the event.
+    :param values: The quantities of the event.
+    """
+    event = dict(values)
+    event['name'] = name
+    for listener in list(_listeners):
+        listener(event)
+
+
+def add_listener(listener):
+    """
+    Register listener, called with the dict of every event.
+    """
+    with _lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    with _lock:
+        _listeners.remove(listener)
+
+
+class record(object):
+    """
+    Context manager that collects the events emitted inside it.
+
+    Usage:
+    >>> with instrument.record(names=['arPLS']) as recorder:
+    ...     arPLS(y)
+    >>> recorder.events
+    """
+
+    def __init__(self, callback=None, names=None):
+        """
+        :param callback: (Optional) Also called with each event as it happens.
+        :param names: (Optional) Only record the events of these functions.
+                    Default records all.
+        """
+        self.callback = callback
+        self.names = None if names is None else set(names)
+        self.events = []
+
+    def _listen(self, event):
+        if self.names is not None and event['name'] not in self.names:
+            return
+        self.events.append(event)
+        if self.callback is not None:
+            self.callback(event)
+
+    def __enter__(self):
+        add_listener(self._listen)
+        return self
+
+    def __exit__(self, *exc_info):
+        remove_listener(self._listen)
+        return False
+
+    def summary(self):
+        """
+        Totals of the recorded events for each function, e.g. to export to a
+        metrics system: the number of 'calls', and the sum of each numeric
+        quantity over the calls and spectra. Boolean quantities are counted.
+
+        :returns: dict of name -> dict of quantity -> total.
+        """
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event['name'], {'calls': 0})
+            total['calls'] += 1
+            for key, value in event.items():
+                if key == 'name':
+                    continue
+                value = np.asarray(value)
+                if value.dtype.kind not in 'biuf':
+                    continue
+                total[key] = total.get(key, 0) + value.sum().item()
+        return totals
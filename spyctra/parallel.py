@@ -0,0 +1,150 @@
+"""
+Parallel processing of stacks of spectra.
+"""
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+BACKENDS = ('process', 'thread')
+
+# Shared memory arrays of the current worker process, set by _init_worker.
+_worker_arrays = {}
+
+
+def _init_worker(specs):
+    """
+    Attach the input and output arrays in a worker process.
+
+    :param specs: dict of key -> (shared memory name, shape, dtype string)
+    """
+    for key, (name, shape, dtype) in specs.items():
+        # Workers share the resource tracker of the parent, which unlinks the
+        # block once map_spectra is done with it.
+        shm = shared_memory.SharedMemory(name=name)
+        _worker_arrays[key] = (shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+
+
+def _chunk_kwargs(kwargs, row_kwargs, start, stop):
+    """
+    kwargs, with the rows start:stop of the arrays of row_kwargs added.
+    """
+    if not row_kwargs:
+        return kwargs
+    kwargs = dict(kwargs)
+    for key, value in row_kwargs.items():
+        kwargs[key] = value[start:stop]
+    return kwargs
+
+
+def _run_chunk(func, start, stop, kwargs):
+    """
+    Apply func to rows start:stop of the shared input in a worker process.
+    """
+    Y = _worker_arrays['in'][1]
+    out = _worker_arrays['out'][1]
+    out[start:stop] = func(Y[start:stop], **kwargs)
+
+
+def _apply_chunk(func, Y, out, start, stop, kwargs, row_kwargs=None):
+    out[start:stop] = func(Y[start:stop], **_chunk_kwargs(kwargs, row_kwargs, start, stop))
+
+
+def _shared_copy(a):
+    """
+    :returns: (shared memory block, array in the block holding a copy of a)
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+    shared = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+    shared[...] = a
+    return shm, shared
+
+
+def map_spectra(func, Y, n_jobs=None, chunk_size=None, backend='process', out_channels=None, dtype=None, row_kwargs=None, **kwargs):
+    """
+    Apply func to blocks of spectra in parallel.
+
+    Y is split into chunks of chunk_size spectra, and func is called on each
+    chunk in a pool of workers. The result is always in the same order as Y,
+    regardless of the order in which the chunks finish.
+
+    With the 'process' backend the input and output are placed in shared
+    memory once, so they are not pickled for every chunk. func must then be
+    picklable, e.g. a module level function such as arPLS_batch.
+
+    Usage:
+    >>> from spyctra import arPLS_batch
+    >>> from spyctra.parallel import map_spectra
+    >>> # Y is a (rows, columns, N) spectral map
+    >>> baselines = map_spectra(arPLS_batch, Y, n_jobs=8, lambda_=1.e5)
+
+    :param func: Called as func(block, **kwargs), where block is a 2D array of
+                shape (k, N). Must return an array of shape (k, out_channels).
+    :param Y: Array of spectra, shape (..., N).
+    :param n_jobs: (Optional) Number of workers. Default is the number of CPUs.
+                1 runs in the calling process without a pool.
+    :param chunk_size: (Optional) Number of spectra per task. Default splits Y into
+                about 4 tasks per worker.
+    :param backend: (Optional) 'process' or 'thread'. Threads avoid copying Y
+                and work well for functions that spend their time in NumPy or
+                LAPACK. Default is 'process'.
+    :param out_channels: (Optional) Length of each output row. Default is N.
+    :param dtype: (Optional) dtype of the output. Default is the dtype of Y.
+    :param row_kwargs: (Optional) dict of keyword -> array with one row per
+                spectrum of Y, e.g. per spectrum weights. func gets the rows
+                of its chunk, sent with each task instead of shared.
+    :param kwargs: Passed on to func.
+    :returns: Array of shape Y.shape[:-1] + (out_channels,).
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend '{0}', expected one of {1}".format(backend, BACKENDS))
+    Y = np.asarray(Y)
+    shape = Y.shape[:-1]
+    Y = Y.reshape((-1, Y.shape[-1]))
+    M, N = Y.shape
+    if row_kwargs:
+        row_kwargs = {key: np.asarray(value).reshape((M,) + np.shape(value)[len(shape):])
+                for key, value in row_kwargs.items()}
+
+    if out_channels is None:
+        out_channels = N
+    if dtype is None:
+        dtype = Y.dtype
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = max(1, -(-M // (4*n_jobs)))
+
+    bounds = [(start, min(start+chunk_size, M)) for start in range(0, M, chunk_size)]
+
+    if n_jobs == 1 or len(bounds) <= 1:
+        out = np.empty((M, out_channels), dtype=dtype)
+        for start, stop in bounds:
+            _apply_chunk(func, Y, out, start, stop, kwargs, row_kwargs)
+    elif backend == 'thread':
+        out = np.empty((M, out_channels), dtype=dtype)
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(_apply_chunk, func, Y, out, start, stop, kwargs, row_kwargs) for start, stop in bounds]
+            for future in futures:
+                future.result()
+    else:
+        in_shm, shared_in = _shared_copy(Y)
+        out_shm = shared_memory.SharedMemory(create=True, size=max(M*out_channels*np.dtype(dtype).itemsize, 1))
+        try:
+            specs = {
+                'in': (in_shm.name, shared_in.shape, shared_in.dtype.str),
+                'out': (out_shm.name, (M, out_channels), np.dtype(dtype).str),
+            }
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(specs,)) as pool:
+                futures = [pool.submit(_run_chunk, func, start, stop, _chunk_kwargs(kwargs, row_kwargs, start, stop))
+                        for start, stop in bounds]
+                for future in futures:
+                    future.result()
+            out = np.ndarray((M, out_channels), dtype=dtype, buffer=out_shm.buf).copy()
+        finally:
+            del shared_in
+            for shm in (in_shm, out_shm):
+                shm.close()
+                shm.unlink()
+
+    return out.reshape(shape + (out_channels,))
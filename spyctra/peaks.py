@@ -0,0 +1,261 @@
+"""
+Peak detection, and initial guesses of the peak parameters for fitting.
+"""
+import numpy as np
+
+SHAPES = ('lorentz', 'gaussian')
+
+# Number of points looked at on each side of the peaks in the first pass of a
+# scan. Peaks that need more are scanned again with twice as many points.
+_FIRST_WINDOW = 8
+
+
+def _local_maxima(Y):
+    """
+    :returns: (row indices, column indices) of the points higher than the
+        point before them and at least as high as the point after them.
+    """
+    middle = Y[:, 1:-1]
+    maxima = (middle > Y[:, :-2]) & (middle >= Y[:, 2:])
+    rows, columns = np.nonzero(maxima)
+    return rows, columns + 1
+
+
+def _scan(Y, rows, columns, direction, visit):
+    """
+    Walk away from each peak in direction, window by window, until visit says
+    the walk is done or the end of the spectrum is reached.
+
+    Most local maxima of a noisy spectrum are done within a few points, so
+    only the few real peaks are scanned over long distances.
+
+    :param visit: Called as visit(active, indices, valid, values) for the
+        indices of the active peaks in rows, the (k, w) indices and values
+        of the next w points of each and whether they are inside the
+        spectrum. Returns the boolean (k,) array of the peaks that are done.
+    """
+    N = Y.shape[-1]
+    active = np.arange(len(rows))
+    start, w = 1, _FIRST_WINDOW
+    while active.size:
+        r, c = rows[active], columns[active]
+        indices = c[:, None] + direction*np.arange(start, start+w)
+        valid = (indices >= 0) & (indices < N)
+        values = Y[r[:, None], np.clip(indices, 0, N-1)]
+        done = visit(active, indices, valid, values) | ~valid[:, -1]
+        active = active[~done]
+        start += w
+        w *= 2
+
+
+def _bases(Y, rows, columns, direction, lowest, highest):
+    """
+    The lowest point on one side of each peak, before a point higher than the
+    peak, as used for the prominence.
+
+    :param lowest: Running minimum of Y towards the end of the side.
+    :param highest: Running maximum of Y towards the end of the side.
+    """
+    peak = Y[rows, columns]
+    # Without a higher point up to the end, the base is the lowest point of
+    # the side, which saves the longest scans.
+    base = lowest[rows, columns].copy()
+    scan = np.nonzero(highest[rows, columns+direction] > peak)[0]
+    base[scan] = peak[scan]
+
+    def visit(active, indices, valid, values):
+        active = scan[active]
+        higher = valid & (values > peak[active, None])
+        blocked = np.logical_or.accumulate(higher, axis=1)
+        lowest = np.where(valid & ~blocked, values, np.inf).min(axis=1)
+        base[active] = np.minimum(base[active], lowest)
+        return higher.any(axis=1)
+
+    _scan(Y, rows[scan], columns[scan], direction, visit)
+    return base
+
+
+def _crossings(Y, rows, columns, reference, direction):
+    """
+    Where each peak first drops to its reference height on one side, linearly
+    interpolated between points.
+
+    :returns: Fractional column indices.
+    """
+    position = columns.astype(float) + direction*(Y.shape[-1])
+    position = np.clip(position, 0, Y.shape[-1]-1)
+
+    def visit(active, indices, valid, values):
+        below = valid & (values <= reference[active, None])
+        found = below.any(axis=1)
+        j = below.argmax(axis=1)[found]
+        k = np.arange(len(active))[found]
+        # the point before the crossing, which may be the peak itself
+        previous = Y[rows[active[k]], indices[k, j] - direction]
+        drop = previous - values[k, j]
+        step = np.divide(previous - reference[active[k]], drop, out=np.ones_like(drop), where=drop > 0)
+        position[active[k]] = indices[k, j] - direction*(1. - step)
+        return found
+
+    _scan(Y, rows, columns, direction, visit)
+    return position
+
+
+def _noise(Y):
+    """
+    Robust estimate of the standard deviation of the noise of each spectrum,
+    from the median absolute difference between neighbouring points.
+    """
+    return 1.4826*np.median(np.abs(np.diff(Y, axis=-1)), axis=-1)/np.sqrt(2.)
+
+
+def _find(Y, x, prominence, rel_height):
+    """
+    Peaks of every row of Y with at least the prominence of their row.
+
+    :returns: (rows, columns, prominences, full widths at rel_height in x)
+    """
+    rows, columns = _local_maxima(Y)
+    prominence = prominence[rows]
+
+    # running minimum and maximum towards the left and right ends
+    left_lowest = np.minimum.accumulate(Y, axis=-1)
+    left_highest = np.maximum.accumulate(Y, axis=-1)
+    right_lowest = np.minimum.accumulate(Y[:, ::-1], axis=-1)[:, ::-1]
+    right_highest = np.maximum.accumulate(Y[:, ::-1], axis=-1)[:, ::-1]
+
+    # The bases are at least as high as the lowest point on their side, which
+    # rules out most maxima of the noise before the slower scans.
+    peak = Y[rows, columns]
+    keep = peak - np.maximum(left_lowest[rows, columns], right_lowest[rows, columns]) >= prominence
+    rows, columns, peak, prominence = rows[keep], columns[keep], peak[keep], prominence[keep]
+
+    # The prominence is at most the height above either base, so the maxima
+    # ruled out by the right base are not scanned to the left.
+    right = _bases(Y, rows, columns, 1, right_lowest, right_highest)
+    keep = peak - right >= prominence
+    rows, columns, peak, prominence, right = rows[keep], columns[keep], peak[keep], prominence[keep], right[keep]
+    left = _bases(Y, rows, columns, -1, left_lowest, left_highest)
+    prominences = peak - np.maximum(left, right)
+
+    keep = prominences >= prominence
+    rows, columns, prominences, peak = rows[keep], columns[keep], prominences[keep], peak[keep]
+
+    reference = peak - rel_height*prominences
+    points = np.arange(Y.shape[-1])
+    start = np.interp(_crossings(Y, rows, columns, reference, -1), points, x)
+    stop = np.interp(_crossings(Y, rows, columns, reference, 1), points, x)
+
+    return rows, columns, prominences, np.abs(stop - start)
+
+
+def _rank(rows):
+    """
+    The position of each entry within its row, for rows sorted in order.
+    """
+    first = np.searchsorted(rows, rows)
+    return np.arange(len(rows)) - first
+
+
+def find_peaks(Y, x=None, prominence=None, max_peaks=None, shape='lorentz', rel_height=0.5,
+        baseline=False, lambda_=5.e5, chunk_size=None, full_output=False):
+    """
+    Find the peaks of one or more spectra, and return their parameters as an
+    initial guess for fitting.
+
+    A peak is a local maximum with a prominence of at least prominence: the
+    height of the peak above the higher of the lowest points on either side
+    of it, before the spectrum rises above the peak again. Its width is
+    measured at rel_height of its prominence below the peak, as in
+    scipy.signal.peak_widths.
+
+    All spectra and peaks are handled at once. The points on either side of
+    the peaks are scanned in windows that double in size, so the many small
+    maxima of the noise do not cost a scan of the whole spectrum.
+
+    Usage:
+    >>> from spyctra import find_peaks, multifit, lorentz
+    >>> # y is a 1D spectrum at the points x
+    >>> p0 = find_peaks(y, x)
+    >>> multifit(lorentz, x, y, yerrors, p0)
+
+    :param Y: 1D spectrum of N points, or a 2D array of shape (M, N) with one
+        spectrum per row.
+    :param x: (Optional) The N x values, in increasing or decreasing order.
+        Default is the point index.
+    :param prominence: (Optional) Minimum prominence of a peak, a single value
+        or one per spectrum. Default is 8 times the noise of each spectrum,
+        estimated from the differences between neighbouring points.
+    :param max_peaks: (Optional) Keep only the max_peaks most prominent peaks
+        of each spectrum. Default keeps all.
+    :param shape: (Optional) 'lorentz' to return [gamma, xo, amplitude] or
+        'gaussian' to return [sigma, xo, amplitude] for each peak, with the
+        width converted from the measured full width at half maximum.
+        Default is 'lorentz'.
+    :param rel_height: (Optional) Height below the peak, relative to its
+        prominence, at which the width is measured. Default is 0.5.
+    :param baseline: (Optional) True to subtract the arPLS baseline of each
+        spectrum first. The amplitudes are then heights above the baseline.
+        Default False.
+    :param lambda_: (Optional) lambda_ of the arPLS baseline. Default is 5.e5.
+    :param chunk_size: (Optional) Number of spectra processed at a time.
+        Default is 256.
+    :param full_output: (Optional) True to also return the prominences of the
+        peaks. Default False.
+    :returns: Array of shape (P, 3) with the parameters of the P peaks of a 1D
+        spectrum, in order of xo. For 2D Y, an array of shape (M, P, 3) where P
+        is the largest number of peaks found in a spectrum, and the rows past
+        the peaks of a spectrum are NaN. If full_output is True,
+        (parameters, prominences), with prominences of shape (P,) or (M, P).
+    """
+    if shape not in SHAPES:
+        raise ValueError("Unknown shape '{0}', expected one of {1}".format(shape, SHAPES))
+    Y = np.asarray(Y, dtype=float)
+    single = Y.ndim == 1
+    Y = Y.reshape((-1, Y.shape[-1]))
+    M, N = Y.shape
+    x = np.arange(N, dtype=float) if x is None else np.asarray(x, dtype=float)
+    if chunk_size is None:
+        chunk_size = 256
+
+    if baseline:
+        from .baseline import arPLS_batch
+        Y = Y - arPLS_batch(Y, lambda_=lambda_)
+    if prominence is None:
+        prominence = 8.*_noise(Y)
+    prominence = np.broadcast_to(np.asarray(prominence, dtype=float), (M,))
+
+    found = []
+    for start in range(0, M, chunk_size):
+        chunk = Y[start:start+chunk_size]
+        rows, columns, prominences, widths = _find(chunk, x, prominence[start:start+chunk_size], rel_height)
+        found.append((rows + start, columns, prominences, widths))
+    rows, columns, prominences, widths = [np.concatenate(parts) for parts in zip(*found)]
+    heights = Y[rows, columns]
+
+    if max_peaks is not None:
+        # most prominent first within each spectrum
+        order = np.lexsort((-prominences, rows))
+        keep = order[_rank(rows[order]) < max_peaks]
+        rows, columns, prominences, widths, heights = rows[keep], columns[keep], prominences[keep], widths[keep], heights[keep]
+
+    order = np.lexsort((columns, rows))
+    rows, columns, prominences, widths, heights = rows[order], columns[order], prominences[order], widths[order], heights[order]
+    rank = _rank(rows)
+    P = rank.max() + 1 if rank.size else 0
+
+    if shape == 'lorentz':
+        # half width at half maximum
+        widths = widths/2.
+    else:
+        widths = widths/(2.*np.sqrt(2.*np.log(2.)))
+    params = np.full((M, P, 3), np.nan)
+    params[rows, rank] = np.stack((widths, x[columns], heights), axis=-1)
+    peak_prominences = np.full((M, P), np.nan)
+    peak_prominences[rows, rank] = prominences
+
+    if single:
+        params, peak_prominences = params[0], peak_prominences[0]
+    if full_output:
+        return params, peak_prominences
+    return params
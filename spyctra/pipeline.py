@@ -0,0 +1,387 @@
+"""
+Lazy processing pipelines, which run a chain of steps over a stack of
+spectra one chunk at a time.
+"""
+import json
+import os
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+
+# Largest number of elements of the sub blocks that fused steps are applied to
+# together, so a sub block stays in cache from one step to the next.
+_FUSED_ELEMENTS = 2**16
+
+# A step of the pipeline. func is called as func(block, **kwargs). Fused steps
+# must work on each spectrum on its own and change block in place.
+_Stage = namedtuple('_Stage', ['name', 'func', 'kwargs', 'fused'])
+
+
+def _remove_cosmics(block, **kwargs):
+    from .cosmics import remove_cosmics
+    return remove_cosmics(block, **kwargs)
+
+
+def _subtract_baseline(block, **kwargs):
+    from .baseline import arPLS_batch
+    block -= arPLS_batch(block, **kwargs)
+    return block
+
+
+def _normalize(block, method='max'):
+    if method == 'max':
+        scale = block.max(axis=-1, keepdims=True)
+    elif method == 'area':
+        scale = block.sum(axis=-1, keepdims=True)
+    else:
+        scale = np.sqrt(np.einsum('ij,ij->i', block, block))[:, None]
+    block /= scale
+    return block
+
+
+def _fit(block, model, x, p0, **kwargs):
+    from .fitting import fit_batch
+    params = fit_batch(model, x, block, p0, **kwargs)[0]
+    return params.reshape((len(block), -1))
+
+
+def _run_chunk(pipeline, block):
+    """
+    Run the pipeline on one chunk in a worker.
+    """
+    timings = OrderedDict()
+    return pipeline._process(block, timings), timings
+
+
+def _chunks(source, chunk_size, skip=0):
+    """
+    The source in (index of first spectrum, 2D block) chunks of chunk_size
+    spectra, starting at spectrum skip.
+
+    :param source: 2D array, SpectralCube, or an iterable of 1D spectra or 2D
+                blocks. Iterables are regrouped into chunk_size spectra.
+    """
+    from .cube import SpectralCube
+    if isinstance(source, SpectralCube):
+        source = source.spectra
+    if isinstance(source, np.ndarray):
+        source = source.reshape((-1, source.shape[-1]))
+        for start in range(skip, len(source), chunk_size):
+            yield start, source[start:start+chunk_size]
+        return
+
+    pending = []
+    count = 0
+    start = 0
+    for item in source:
+        item = np.asarray(item)
+        item = item.reshape((-1, item.shape[-1]))
+        # spectra before skip were done before a restart
+        if start + count + len(item) <= skip:
+            start += len(item)
+            continue
+        if start < skip:
+            item = item[skip-start:]
+            start = skip
+        pending.append(item)
+        count += len(item)
+        while count >= chunk_size:
+            block = np.vstack(pending)
+            yield start, block[:chunk_size]
+            start += chunk_size
+            pending = [block[chunk_size:]]
+            count = len(pending[0])
+    if count:
+        yield start, np.vstack(pending)
+
+
+class Pipeline(object):
+    """
+    A chain of processing steps, such as removing cosmics, subtracting the
+    baseline, normalizing and fitting, run on stacks of spectra chunk by
+    chunk.
+
+    Nothing is computed until the pipeline is run. Each chunk is copied once
+    into a work buffer, and all steps but the last work on that buffer in
+    place, so no step makes another copy of the data. Steps that work on each
+    value or spectrum on its own, such as normalize, are fused: they run one
+    after the other on cache sized blocks of spectra, instead of each going
+    over the whole chunk.
+
+    The time spent in each step is summed in timings.
+
+    Usage:
+    >>> from spyctra import lorentz
+    >>> from spyctra.pipeline import Pipeline
+    >>> pipeline = (Pipeline()
+    ...     .remove_cosmics()
+    ...     .subtract_baseline(lambda_=1.e5)
+    ...     .normalize()
+    ...     .fit(lorentz, x, p0))
+    >>> params = pipeline.run(cube, out='params.npy', n_jobs=8, checkpoint='params.json')
+    >>> print(pipeline.report())
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.timings = OrderedDict()
+
+    def map(self, func, name=None, fused=False, **kwargs):
+        """
+        Add a step.
+
+        :param func: Called as func(block, **kwargs) with a (k, N) float block
+                    of spectra. Returns the (k, n) result, which may be block
+                    changed in place.
+        :param name: (Optional) Name of the step in timings. Default is the
+                    name of func.
+        :param fused: (Optional) True if func handles each spectrum on its
+                    own, and changes block in place. It is then run on smaller
+                    blocks together with the fused steps next to it.
+                    Default False.
+        :param kwargs: Passed on to func.
+        :returns: The pipeline, to chain further steps.
+        """
+        if name is None:
+            name = getattr(func, '__name__', 'step')
+        names = [stage.name for stage in self.stages]
+        if name in names:
+            name = '{0}_{1}'.format(name, names.count(name) + 1)
+        self.stages.append(_Stage(name, func, kwargs, fused))
+        return self
+
+    def remove_cosmics(self, **kwargs):
+        """
+        Add spyctra.remove_cosmics, with kwargs such as max_curvature.
+        """
+        return self.map(_remove_cosmics, name='remove_cosmics', **kwargs)
+
+    def subtract_baseline(self, **kwargs):
+        """
+        Add subtracting the arPLS baseline, see spyctra.arPLS_batch for kwargs.
+        """
+        return self.map(_subtract_baseline, name='subtract_baseline', **kwargs)
+
+    def normalize(self, method='max'):
+        """
+        Add dividing each spectrum by its 'max', its 'area' (sum), or its 'l2'
+        norm.
+        """
+        if method not in ('max', 'area', 'l2'):
+            raise ValueError("Unknown method '{0}', expected 'max', 'area' or 'l2'".format(method))
+        return self.map(_normalize, name='normalize', fused=True, method=method)
+
+    def fit(self, model, x, p0, **kwargs):
+        """
+        Add fitting model to every spectrum with spyctra.fit_batch. The result
+        of the pipeline is then the flattened fitted parameters of each
+        spectrum.
+
+        :param model: The model, e.g. spyctra.lorentz.
+        :param x: The x values of the spectra.
+        :param p0: Initial parameters, see fit_batch.
+        :param kwargs: Passed on to fit_batch.
+        """
+        return self.map(_fit, name='fit', model=model, x=x, p0=p0, **kwargs)
+
+    def _groups(self):
+        """
+        The stages, with consecutive fused stages grouped into lists.
+        """
+        groups = []
+        for stage in self.stages:
+            if stage.fused and groups and isinstance(groups[-1], list):
+                groups[-1].append(stage)
+            else:
+                groups.append([stage] if stage.fused else stage)
+        return groups
+
+    def _process(self, block, timings, buffer=None):
+        """
+        Run all steps on one chunk.
+
+        :param buffer: (Optional) Work buffer of at least len(block) rows,
+                    reused between chunks.
+        :returns: The result of the last step.
+        """
+        tic = time.perf_counter()
+        if buffer is None:
+            work = np.array(block, dtype=float)
+        else:
+            work = buffer[:len(block)]
+            np.copyto(work, block, casting='unsafe')
+        timings['read'] = timings.get('read', 0.) + time.perf_counter() - tic
+
+        for group in self._groups():
+            if isinstance(group, list):
+                rows = max(1, _FUSED_ELEMENTS // max(1, work.shape[-1]))
+                for start in range(0, len(work), rows):
+                    sub = work[start:start+rows]
+                    for stage in group:
+                        tic = time.perf_counter()
+                        stage.func(sub, **stage.kwargs)
+                        timings[stage.name] = timings.get(stage.name, 0.) + time.perf_counter() - tic
+            else:
+                tic = time.perf_counter()
+                work = group.func(work, **group.kwargs)
+                timings[group.name] = timings.get(group.name, 0.) + time.perf_counter() - tic
+        return work
+
+    def _add_timings(self, timings):
+        for name, seconds in timings.items():
+            self.timings[name] = self.timings.get(name, 0.) + seconds
+
+    def stream(self, source, chunk_size=None, n_jobs=1, backend='process', skip=0):
+        """
+        Lazily run the pipeline over source.
+
+        With more than one job, up to 2*n_jobs chunks are processed at the
+        same time, so memory stays bounded for sources of any length.
+
+        :param source: 2D array of spectra, SpectralCube, or an iterable of 1D
+                    spectra or 2D blocks, e.g. a generator reading a file.
+        :param chunk_size: (Optional) Number of spectra per chunk. Default is 256.
+        :param n_jobs: (Optional) Number of workers. None uses all CPUs.
+                    The steps must be picklable for the 'process' backend.
+                    Default is 1.
+        :param backend: (Optional) 'process' or 'thread', see
+                    spyctra.parallel.map_spectra. Default is 'process'.
+        :param skip: (Optional) Number of spectra at the start of source to skip.
+        :returns: Iterator of (index of the first spectrum, result) for each
+                    chunk, in order.
+        """
+        from .parallel import BACKENDS
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend '{0}', expected one of {1}".format(backend, BACKENDS))
+        if chunk_size is None:
+            chunk_size = 256
+        if n_jobs is None:
+            n_jobs = os.cpu_count() or 1
+        self.timings = OrderedDict()
+        chunks = _chunks(source, chunk_size, skip)
+
+        if n_jobs == 1:
+            for start, block in chunks:
+                yield start, self._process(block, self.timings)
+            return
+
+        Executor = ProcessPoolExecutor if backend == 'process' else ThreadPoolExecutor
+        with Executor(max_workers=n_jobs) as pool:
+            pending = []
+            for start, block in chunks:
+                pending.append((start, pool.submit(_run_chunk, self, np.asarray(block))))
+                if len(pending) >= 2*n_jobs:
+                    start, future = pending.pop(0)
+                    result, timings = future.result()
+                    self._add_timings(timings)
+                    yield start, result
+            for start, future in pending:
+                result, timings = future.result()
+                self._add_timings(timings)
+                yield start, result
+
+    def run(self, source, out=None, chunk_size=None, n_jobs=1, backend='process', checkpoint=None):
+        """
+        Run the pipeline over source, and collect the results.
+
+        With checkpoint, the number of spectra done is saved to the checkpoint
+        file after every chunk is written to out. Running again with the same
+        arguments after a crash resumes after the last saved chunk. The
+        checkpoint file is removed when the run completes.
+
+        :param source: See stream.
+        :param out: (Optional) Array, SpectralCube, or filename of a .npy file
+                    for the (M, n) results. A filename needs a source of known
+                    length. Default collects the results in memory.
+        :param chunk_size: (Optional) See stream.
+        :param n_jobs: (Optional) See stream.
+        :param backend: (Optional) See stream.
+        :param checkpoint: (Optional) Filename of the checkpoint, a JSON file.
+                    Needs an out that is kept on disk.
+        :returns: The results, out or an (M, n) array.
+        """
+        from .cube import SpectralCube
+        if chunk_size is None:
+            chunk_size = 256
+        skip = 0
+        if checkpoint is not None:
+            if out is None:
+                raise ValueError("A checkpoint needs an out that is kept on disk")
+            if os.path.exists(checkpoint):
+                with open(checkpoint) as f:
+                    skip = json.load(f)['done']
+
+        results = []
+        if n_jobs == 1:
+            stream = self._serial(source, chunk_size, skip)
+        else:
+            stream = self.stream(source, chunk_size, n_jobs, backend, skip)
+
+        for start, result in stream:
+            tic = time.perf_counter()
+            if isinstance(out, str):
+                out = self._open_output(out, source, result, resume=skip > 0)
+            if out is None:
+                results.append(np.array(result))
+            else:
+                spectra = out.spectra if isinstance(out, SpectralCube) else out.reshape((-1, out.shape[-1]))
+                spectra[start:start+len(result)] = result
+                if hasattr(spectra, 'flush'):
+                    spectra.flush()
+            self.timings['write'] = self.timings.get('write', 0.) + time.perf_counter() - tic
+            if checkpoint is not None:
+                self._save_checkpoint(checkpoint, start + len(result))
+
+        if checkpoint is not None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        if out is None:
+            return np.vstack(results) if results else np.empty((0, 0))
+        return out
+
+    def _serial(self, source, chunk_size, skip):
+        """
+        stream with one job, with one work buffer for all chunks. Each result
+        must be used before the next chunk is processed.
+        """
+        self.timings = OrderedDict()
+        buffer = None
+        for start, block in _chunks(source, chunk_size, skip):
+            if buffer is None:
+                buffer = np.empty((chunk_size, block.shape[-1]))
+            yield start, self._process(block, self.timings, buffer)
+
+    def _open_output(self, filename, source, result, resume):
+        """
+        The memory mapped .npy output for the results, opened again to resume.
+        """
+        from .cube import SpectralCube
+        if resume and os.path.exists(filename):
+            return np.load(filename, mmap_mode='r+')
+        if isinstance(source, SpectralCube):
+            M = source.n_spectra
+        elif isinstance(source, np.ndarray):
+            M = int(np.prod(source.shape[:-1]))
+        else:
+            raise ValueError("An out filename needs an array or SpectralCube source of known length")
+        return np.lib.format.open_memmap(filename, mode='w+', dtype=result.dtype, shape=(M, result.shape[-1]))
+
+    def _save_checkpoint(self, checkpoint, done):
+        """
+        Save the number of spectra done, replacing the checkpoint file at once
+        so a crash never leaves half a checkpoint.
+        """
+        temporary = checkpoint + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'done': done}, f)
+        os.replace(temporary, checkpoint)
+
+    def report(self):
+        """
+        :returns: The timings of the last run as a table, one line per step.
+        """
+        total = sum(self.timings.values()) or 1.
+        lines = ['{0:<20} {1:>10} {2:>7}'.format('step', 'seconds', '%')]
+        for name, seconds in self.timings.items():
+            lines.append('{0:<20} {1:>10.4f} {2:>6.1f}%'.format(name, seconds, 100.*seconds/total))
+        return '\n'.join(lines)
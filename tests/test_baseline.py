@@ -1,5 +1,8 @@
 import unittest
-from spyctra import arPLS
+import tracemalloc
+from spyctra import arPLS, arPLS_batch, arPLS_stream, arPLS2d, arPLSnd, AsLS, airPLS, drPLS, iarPLS
+from spyctra import instrument
+from spyctra.baseline import PenaltyCache, penalty_cache
 import numpy as np
 from scipy.stats import norm
 
@@ -174,3 +177,422 @@ class TestArPLS(unittest.TestCase):
 
         self.assertAlmostEqual(fit[0], slope, places=1) # x
         self.assertAlmostEqual(fit[1], offset, places=1) # const
+
+    def test_banded_solver_matches_spsolve(self):
+        """
+        Tests that the banded solver gives the same baseline as the reference
+        sparse solver.
+        """
+        x = np.arange(0, 1000, 1)
+        g1 = norm(loc = 300, scale = 3.0)
+        y = 10. + 2.*x + 300.*g1.pdf(x)
+        y += np.random.random(1000)*0.5 - 0.25
+
+        z_banded = arPLS(y, solver='banded')
+        z_spsolve = arPLS(y, solver='spsolve')
+
+        np.testing.assert_allclose(z_banded, z_spsolve, rtol=1e-6, atol=1e-6)
+
+    def test_unknown_solver(self):
+        with self.assertRaises(ValueError):
+            arPLS(np.ones(100), solver='nope')
+
+    def test_cg_solver_matches_banded(self):
+        """
+        Tests that the conjugate gradient solver gives the same baseline as the
+        banded solver, for single spectra and batches.
+        """
+        x = np.arange(0, 1000, 1)
+        g1 = norm(loc = 300, scale = 3.0)
+        Y = np.array([offset + slope*x + 300.*g1.pdf(x) for offset, slope in [(10., 2.), (-5., 0.)]])
+        Y += np.random.RandomState(22).random_sample(Y.shape)*0.5 - 0.25
+
+        np.testing.assert_allclose(arPLS(Y[0], solver='cg'), arPLS(Y[0]), atol=1e-2)
+        np.testing.assert_allclose(arPLS_batch(Y, solver='cg'), arPLS_batch(Y), atol=1e-2)
+
+    def test_cg_solver_zero_spectrum(self):
+        Z = arPLS_batch(np.zeros((2, 500)), solver='cg')
+
+        self.assertTrue(np.all(np.isfinite(Z)))
+        self.assertAlmostEqual(np.mean(Z), 0, places=2)
+
+
+class TestArPLSBatch(unittest.TestCase):
+
+    def test_same_return_shape(self):
+        Y = np.ones((5, 100))
+        Y += np.random.random((5, 100))
+
+        Z = arPLS_batch(Y)
+
+        self.assertEqual(Y.shape, Z.shape)
+
+    def test_matches_arPLS(self):
+        """
+        Tests that each row of the batch is the same as calling arPLS on it.
+        """
+        x = np.arange(0, 1000, 1)
+        g1 = norm(loc = 300, scale = 3.0)
+        Y = np.array([offset + slope*x + 300.*g1.pdf(x) for offset, slope in [(10., 2.), (-5., 0.), (0., -1.)]])
+        Y += np.random.random(Y.shape)*0.5 - 0.25
+
+        Z = arPLS_batch(Y)
+
+        for y, z in zip(Y, Z):
+            np.testing.assert_allclose(z, arPLS(y), rtol=1e-8, atol=1e-8)
+
+    def test_zero_rows(self):
+        """
+        Tests that rows without any noise are handled next to normal rows.
+        """
+        Y = np.zeros((2, 1000))
+        Y[1] += np.random.random(1000)*0.5 - 0.25
+
+        Z = arPLS_batch(Y)
+
+        for y, z in zip(Y, Z):
+            self.assertAlmostEqual(np.mean(y-z), 0, places=1)
+
+    def test_nan_row(self):
+        """
+        Tests that a row with a NaN gives NaN without spreading to the rows
+        solved with it.
+        """
+        rng = np.random.RandomState(2)
+        Y = rng.random_sample((4, 200)) + np.linspace(0., 5., 200)
+        Y[0, 10] = np.nan
+
+        for solver in ('banded', 'spsolve', 'cg'):
+            Z, W, niter = arPLS_batch(Y, solver=solver, full_output=True)
+
+            self.assertTrue(np.all(np.isnan(Z[0])))
+            self.assertTrue(np.all(np.isnan(W[0])))
+            self.assertEqual(niter[0], 0)
+            np.testing.assert_allclose(Z[1:], arPLS_batch(Y[1:], solver=solver), rtol=1e-8, atol=1e-8)
+
+    def test_chunks_match(self):
+        Y = np.random.RandomState(5).random_sample((10, 200))
+
+        np.testing.assert_array_equal(arPLS_batch(Y, chunk_size=3), arPLS_batch(Y))
+
+
+class TestArPLSMemory(unittest.TestCase):
+
+    def test_iterations_allocate_nothing(self):
+        """
+        Tests that the iterations reuse the buffers allocated up front: the
+        peak memory does not grow with the iterations, and is not above the
+        buffers, about 11 arrays of the size of y.
+        """
+        y = np.linspace(0., 10., 100000) + np.random.RandomState(8).random_sample(100000)
+        arPLS(y, lambda_=1.e7)
+
+        def peak(itermax):
+            tracemalloc.start()
+            arPLS(y, lambda_=1.e7, ratio=0., itermax=itermax)
+            size = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return size
+
+        self.assertLessEqual(peak(40), 1.01*peak(3))
+        self.assertLess(peak(40), 12*y.nbytes)
+
+
+class TestArPLSDtype(unittest.TestCase):
+
+    def setUp(self):
+        x = np.arange(0, 1000, 1)
+        g1 = norm(loc = 300, scale = 3.0)
+        prng = np.random.RandomState(2323)
+        # 16 bit detector counts
+        self.Y = np.round(1000. + 2.*x + 30000.*g1.pdf(x) + prng.normal(0., 10., (3, 1000))).astype(np.int16)
+
+    def test_integer_input(self):
+        Z = arPLS_batch(self.Y)
+
+        self.assertEqual(Z.dtype, np.float64)
+        np.testing.assert_array_equal(Z, arPLS_batch(self.Y.astype(float)))
+        np.testing.assert_array_equal(arPLS(self.Y[0]), Z[0])
+
+    def test_float32(self):
+        """
+        Tests that float32 spectra give the float64 baselines rounded to float32.
+        """
+        Z, W, niter = arPLS_batch(self.Y.astype(np.float32), full_output=True)
+
+        self.assertEqual(Z.dtype, np.float32)
+        self.assertEqual(W.dtype, np.float32)
+        np.testing.assert_allclose(Z, arPLS_batch(self.Y.astype(float)), rtol=1e-7)
+        self.assertEqual(arPLS(self.Y[0].astype(np.float32)).dtype, np.float32)
+
+    def test_dtype(self):
+        self.assertEqual(arPLS_batch(self.Y, dtype=np.float32).dtype, np.float32)
+        self.assertEqual(arPLS2d(self.Y, lambda_=(1., 1.e4), dtype=np.float32).dtype, np.float32)
+        with self.assertRaises(ValueError):
+            arPLS(self.Y[0], dtype=int)
+
+    def test_n_jobs(self):
+        np.testing.assert_array_equal(
+                arPLS_batch(self.Y.astype(np.float32), n_jobs=2, chunk_size=1),
+                arPLS_batch(self.Y.astype(np.float32)))
+
+    def test_n_jobs_full_output(self):
+        """
+        Tests that the weights of each spectrum go to the workers and come
+        back in the requested dtype.
+        """
+        Z, W, niter = arPLS_batch(self.Y, full_output=True, dtype=np.float32)
+        weights = np.vstack((W[:2], np.ones(1000, dtype=np.float32)))
+
+        for w in (None, weights, weights[2]):
+            Z2, W2, niter2 = arPLS_batch(self.Y, full_output=True, weights=w, n_jobs=2, chunk_size=1, dtype=np.float32)
+
+            self.assertEqual(Z2.dtype, np.float32)
+            self.assertEqual(W2.dtype, np.float32)
+            expected = arPLS_batch(self.Y, full_output=True, weights=w, dtype=np.float32)
+            np.testing.assert_array_equal(Z2, expected[0])
+            np.testing.assert_array_equal(W2, expected[1])
+            np.testing.assert_array_equal(niter2, expected[2])
+
+
+class TestBaselineFamily(unittest.TestCase):
+
+    def setUp(self):
+        x = np.arange(0, 1000, 1)
+        self.baseline = 10. + 0.02*x + 5.*np.sin(x/300.)
+        peaks = 300.*norm(loc = 300, scale = 5.0).pdf(x) + 200.*norm(loc = 700, scale = 8.0).pdf(x)
+        prng = np.random.RandomState(2525)
+        self.Y = self.baseline + peaks*np.array([[1.], [2.], [3.]]) + prng.normal(0., 0.05, (3, 1000))
+        self.methods = (AsLS, airPLS, drPLS, iarPLS)
+
+    def test_baseline_under_peaks(self):
+        for method, atol in zip(self.methods, (0.3, 1., 0.1, 0.1)):
+            Z = method(self.Y)
+
+            self.assertEqual(Z.shape, self.Y.shape)
+            np.testing.assert_allclose(Z, np.broadcast_to(self.baseline, Z.shape), atol=atol,
+                    err_msg=method.__name__)
+
+    def test_single_spectrum_matches_batch(self):
+        for method in self.methods:
+            z, w, niter = method(self.Y[1], full_output=True)
+
+            Z, W, Niter = method(self.Y, full_output=True)
+            np.testing.assert_array_equal(z, Z[1])
+            np.testing.assert_array_equal(w, W[1])
+            self.assertEqual(niter, Niter[1])
+
+    def test_banded_matches_spsolve(self):
+        """
+        Tests the banded solves, the LU solve of the non symmetric drPLS
+        system in particular, against the sparse solver.
+        """
+        for method in self.methods:
+            np.testing.assert_allclose(method(self.Y, solver='banded'), method(self.Y, solver='spsolve'),
+                    atol=1e-6, err_msg=method.__name__)
+
+    def test_cg(self):
+        np.testing.assert_allclose(AsLS(self.Y, solver='cg'), AsLS(self.Y), atol=1e-3)
+        with self.assertRaises(ValueError):
+            drPLS(self.Y, solver='cg')
+
+    def test_n_jobs(self):
+        for method in self.methods:
+            np.testing.assert_allclose(method(self.Y, n_jobs=2, chunk_size=1), method(self.Y),
+                    err_msg=method.__name__)
+
+    def test_zero_row(self):
+        """
+        Tests that an all zero spectrum gives a zero baseline without
+        spreading NaN to the rows solved with it.
+        """
+        Y = np.vstack((np.zeros(1000), self.Y))
+        for method in self.methods:
+            Z = method(Y)
+
+            np.testing.assert_allclose(Z[0], 0., atol=0.01, err_msg=method.__name__)
+            np.testing.assert_allclose(Z[1:], method(self.Y), atol=1e-8, err_msg=method.__name__)
+
+    def test_asls_asymmetry(self):
+        z, w, _ = AsLS(self.Y[0], p=0.05, full_output=True)
+
+        np.testing.assert_array_equal(np.unique(w), [0.05, 0.95])
+        np.testing.assert_array_equal(w == 0.05, self.Y[0] > z)
+
+    def test_dtype(self):
+        for method in self.methods:
+            Z = method(self.Y.astype(np.float32))
+
+            self.assertEqual(Z.dtype, np.float32)
+
+    def test_instrumented(self):
+        with instrument.record() as recorder:
+            for method in self.methods:
+                method(self.Y)
+
+        self.assertEqual([event['name'] for event in recorder.events], ['AsLS', 'airPLS', 'drPLS', 'iarPLS'])
+        for event in recorder.events:
+            self.assertTrue(np.all(event['converged']))
+
+
+class TestPenaltyCache(unittest.TestCase):
+
+    def test_repeated_calls_hit(self):
+        penalty_cache.clear()
+        y = np.ones(100) + np.random.random(100)
+
+        arPLS(y)
+        self.assertEqual(penalty_cache.misses, 1)
+        self.assertEqual(penalty_cache.hits, 0)
+
+        arPLS(y)
+        arPLS_batch([y, y])
+        self.assertEqual(penalty_cache.misses, 1)
+        self.assertEqual(penalty_cache.hits, 2)
+
+        # a new lambda_ is a new entry
+        arPLS(y, lambda_=10.)
+        self.assertEqual(penalty_cache.misses, 2)
+        self.assertEqual(len(penalty_cache), 2)
+
+    def test_clear(self):
+        cache = PenaltyCache()
+        cache.get(100, 5.e5)
+        cache.get(100, 5.e5)
+
+        cache.clear()
+
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(cache.misses, 0)
+
+    def test_least_recently_used_evicted(self):
+        cache = PenaltyCache(maxsize=2)
+        cache.get(100, 1.)
+        cache.get(200, 1.)
+        cache.get(100, 1.)
+        cache.get(300, 1.)
+
+        self.assertEqual(len(cache), 2)
+
+        # 100 was used more recently than 200
+        cache.get(100, 1.)
+        self.assertEqual(cache.hits, 2)
+        cache.get(200, 1.)
+        self.assertEqual(cache.misses, 4)
+
+    def test_cached_penalty_read_only(self):
+        cache = PenaltyCache()
+        H = cache.get(100, 1.)
+
+        with self.assertRaises(ValueError):
+            H[0, 0] = 1.
+
+
+class TestArPLS2d(unittest.TestCase):
+
+    def setUp(self):
+        prng = np.random.RandomState(2741)
+        rows, columns = np.mgrid[0:40, 0:60]
+        self.plane = 10. + 0.5*rows - 0.2*columns
+        peak = 50.*np.exp(-((rows-20.)**2 + (columns-25.)**2)/8.)
+        self.R = self.plane + peak + prng.random_sample(rows.shape)*0.5 - 0.25
+
+    def test_same_return_shape(self):
+        z = arPLS2d(self.R)
+
+        self.assertEqual(z.shape, self.R.shape)
+
+    def test_plane_baseline_with_peak(self):
+        """
+        Tests that a tilted plane under a peak is recovered.
+        """
+        z = arPLS2d(self.R, lambda_=1.e3)
+
+        np.testing.assert_allclose(z, self.plane, atol=0.5)
+
+    def test_cg_matches_spsolve(self):
+        z_cg = arPLS2d(self.R, lambda_=(10., 1.e3))
+        z_spsolve = arPLS2d(self.R, lambda_=(10., 1.e3), solver='spsolve')
+
+        np.testing.assert_allclose(z_cg, z_spsolve, rtol=1e-4, atol=1e-4)
+
+    def test_separate_lambdas(self):
+        """
+        Tests that a large lambda_ along the first axis only smooths along it.
+        """
+        z = arPLS2d(self.R, lambda_=(1.e6, 1.e-6))
+
+        # much smoother along the first axis than along the second
+        curvature0 = np.abs(np.diff(z, n=2, axis=0)).max()
+        curvature1 = np.abs(np.diff(z, n=2, axis=1)).max()
+        self.assertLess(100.*curvature0, curvature1)
+
+    def test_not_2d(self):
+        with self.assertRaises(ValueError):
+            arPLS2d(np.ones(100))
+
+    def test_1d_matches_arPLS(self):
+        x = np.arange(0, 500, 1)
+        g1 = norm(loc = 300, scale = 3.0)
+        y = 10. + 2.*x + 300.*g1.pdf(x)
+        y += np.random.random(500)*0.5 - 0.25
+
+        np.testing.assert_allclose(arPLSnd(y, tol=1e-10), arPLS(y), rtol=1e-4, atol=1e-4)
+
+    def test_3d_shape(self):
+        Y = np.random.random((6, 7, 30))
+
+        z = arPLSnd(Y, lambda_=(1., 1., 1.e3))
+
+        self.assertEqual(z.shape, Y.shape)
+
+
+class TestWarmStart(unittest.TestCase):
+
+    def setUp(self):
+        prng = np.random.RandomState(777)
+        x = np.arange(0, 1000, 1)
+        g1 = norm(loc = 300, scale = 3.0)
+        self.spectra = [10. + (2.+0.01*k)*x + 300.*g1.pdf(x) + prng.random_sample(1000)*0.5 - 0.25 for k in range(5)]
+
+    def test_full_output(self):
+        y = self.spectra[0]
+
+        z, w, niter = arPLS(y, full_output=True)
+
+        np.testing.assert_array_equal(z, arPLS(y))
+        self.assertEqual(w.shape, y.shape)
+        self.assertGreater(niter, 1)
+
+    def test_converged_weights_converge_immediately(self):
+        y = self.spectra[0]
+        z, w, niter = arPLS(y, full_output=True)
+
+        z2, w2, niter2 = arPLS(y, weights=w, full_output=True)
+
+        self.assertLessEqual(niter2, 2)
+        np.testing.assert_allclose(z2, z, rtol=1e-6)
+
+    def test_stream_carries_weights(self):
+        results = list(arPLS_stream(self.spectra, full_output=True))
+
+        self.assertEqual(len(results), len(self.spectra))
+        z, w, niter = arPLS(self.spectra[1], weights=results[0][1], full_output=True)
+        np.testing.assert_array_equal(results[1][0], z)
+        self.assertEqual(results[1][2], niter)
+
+    def test_stream_fewer_iterations(self):
+        cold = sum(arPLS(y, full_output=True)[2] for y in self.spectra)
+        warm = sum(niter for z, w, niter in arPLS_stream(self.spectra, full_output=True))
+
+        self.assertLess(warm, cold)
+
+    def test_batch_full_output(self):
+        Z, W, niter = arPLS_batch(self.spectra, full_output=True)
+        Z2, W2, niter2 = arPLS_batch(self.spectra, weights=W, full_output=True, n_jobs=2, chunk_size=2)
+
+        self.assertEqual(W.shape, Z.shape)
+        self.assertEqual(niter.shape, (len(self.spectra),))
+        self.assertTrue(np.all(niter2 <= 2))
+        np.testing.assert_allclose(Z2, Z, rtol=1e-6)
@@ -0,0 +1,98 @@
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout, redirect_stderr
+import numpy as np
+from spyctra import arPLS_batch, remove_cosmics, lorentz
+from spyctra.cli import main
+
+
+class TestCli(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        prng = np.random.RandomState(1801)
+        self.x = np.linspace(0., 100., 200)
+        self.Y = lorentz([[2., 40., 100.], [3., 70., 40.]], self.x) + 0.1*self.x + prng.normal(size=(30, 200))
+        self.Y[4, 120] += 5000.
+        self.input = self.path('in.npy')
+        np.save(self.input, self.Y)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def run_main(self, *argv):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertEqual(main(list(argv)), 0)
+        return output.getvalue()
+
+    def test_baseline(self):
+        output = self.run_main('baseline', '--lambda', '1e4', '--jobs', '1', '--chunk-size', '7', self.input, self.path('out.npy'))
+
+        np.testing.assert_allclose(np.load(self.path('out.npy')), arPLS_batch(self.Y, lambda_=1.e4))
+        self.assertIn('30 spectra', output)
+        self.assertIn('spectra/s', output)
+
+    def test_baseline_subtract_jobs(self):
+        self.run_main('baseline', '--subtract', '--jobs', '2', '--chunk-size', '8', self.input, self.path('out.npy'))
+
+        np.testing.assert_allclose(np.load(self.path('out.npy')), self.Y - arPLS_batch(self.Y))
+
+    def test_cosmics_csv(self):
+        np.savetxt(self.path('in.csv'), self.Y, delimiter=',')
+
+        self.run_main('cosmics', '--jobs', '1', '--chunk-size', '8', self.path('in.csv'), self.path('out.csv'))
+
+        expected = remove_cosmics(np.loadtxt(self.path('in.csv'), delimiter=','))
+        np.testing.assert_allclose(np.loadtxt(self.path('out.csv'), delimiter=','), expected)
+
+    def test_raw(self):
+        self.Y.astype(np.float32).tofile(self.path('in.raw'))
+
+        self.run_main('cosmics', '--jobs', '1', '--dtype', 'float32', '--channels', '200', self.path('in.raw'), self.path('out.raw'))
+
+        out = np.fromfile(self.path('out.raw')).reshape((30, 200))
+        self.assertLess(out[4, 120], 100.)
+
+    def test_fit(self):
+        np.save(self.path('x.npy'), self.x)
+        Y = lorentz([[2., 40., 100.], [3., 70., 40.]], self.x)*np.linspace(0.5, 1.5, 30)[:, None]
+        np.save(self.input, Y)
+
+        self.run_main('fit', '--jobs', '1', '--x', self.path('x.npy'), '--p0', '2.5,41,80,2.5,69,30', self.input, self.path('params.npy'))
+
+        params = np.load(self.path('params.npy'))
+        self.assertEqual(params.shape, (30, 6))
+        np.testing.assert_allclose(params[:, [0, 1, 3, 4]], np.tile([2., 40., 3., 70.], (30, 1)), rtol=1e-6)
+
+    def test_fit_peaks(self):
+        np.save(self.path('x.npy'), self.x)
+
+        self.run_main('fit', '--jobs', '1', '--subtract', '--peaks', '2', '--x', self.path('x.npy'), self.input, self.path('params.csv'))
+
+        params = np.loadtxt(self.path('params.csv'), delimiter=',')
+        self.assertEqual(params.shape, (30, 6))
+        np.testing.assert_allclose(np.median(params[:, [1, 4]], axis=0), [40., 70.], atol=0.2)
+
+    def test_raw_needs_channels(self):
+        self.Y.tofile(self.path('in.raw'))
+
+        with self.assertRaises(SystemExit), redirect_stderr(io.StringIO()):
+            main(['cosmics', self.path('in.raw'), self.path('out.raw')])
+
+    def test_module(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        output = subprocess.check_output([sys.executable, '-m', 'spyctra', 'cosmics', '--jobs', '1',
+                self.input, self.path('out.npy')], cwd=root)
+
+        self.assertIn(b'spectra/s', output)
+        self.assertTrue(os.path.exists(self.path('out.npy')))
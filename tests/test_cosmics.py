@@ -1,6 +1,8 @@
 import unittest
+import tracemalloc
 import numpy as np
-from spyctra import remove_cosmics
+from scipy.interpolate import interp1d
+from spyctra import remove_cosmics, remove_cosmics_multi
 
 
 class TestRemoveCosmics(unittest.TestCase):
@@ -78,71 +80,282 @@ class TestRemoveCosmics(unittest.TestCase):
         self.assertLessEqual(y2[500], 5.)
         self.assertLessEqual(y2[601], 5.)
 
-    def test_cosmic_at_beginning_ignored(self):
+    def assert_spike_removed(self, y, index):
         """
-        Test that spikes at the beginning are ignored, as they will throw an error.
+        Asserts that the spike at index is removed, and that the points the
+        spike does not disturb are unchanged.
+        """
+        y_original = y.copy()
+        curvature = np.gradient(np.gradient(y))
+
+        y2 = remove_cosmics(y)
+
+        self.assertLessEqual(abs(y2[index]), 5.)
+        unflagged = curvature > -1000
+        np.testing.assert_array_equal(y_original[unflagged], y2[unflagged])
+
+    def test_cosmic_at_beginning_removed(self):
+        """
+        Test that spikes at the beginning are removed, using only the points
+        after them.
         """
         prng = np.random.RandomState(123459)
         y = prng.normal(size=1000)
 
         y[0] = -14000.
 
-        y2 = remove_cosmics(y)
-
-        # assert that all the points are unchanged
-        np.testing.assert_array_equal(y, y2)
+        self.assert_spike_removed(y, 0)
 
-    def test_cosmic_at_2nd_point_ignored(self):
+    def test_cosmic_at_2nd_point_removed(self):
         prng = np.random.RandomState(12345)
         y = prng.normal(size=1000)
 
         y[1] = 14000.
 
-        y2 = remove_cosmics(y)
-
-        # assert that all the points are unchanged
-        np.testing.assert_array_equal(y, y2)
+        self.assert_spike_removed(y, 1)
 
-    def test_cosmic_at_3rd_point_ignored(self):
+    def test_cosmic_at_3rd_point_removed(self):
         prng = np.random.RandomState(333)
         y = prng.normal(size=1000)
 
         y[2] = 14000.
 
-        y2 = remove_cosmics(y)
-
-        # assert that all the points are unchanged
-        np.testing.assert_array_equal(y, y2)
+        self.assert_spike_removed(y, 2)
 
-    def test_cosmic_at_end_ignored(self):
+    def test_cosmic_at_end_removed(self):
         prng = np.random.RandomState(4582398)
         y = prng.normal(size=1000)
 
         y[999] = -14000.
 
-        y2 = remove_cosmics(y)
+        self.assert_spike_removed(y, 999)
 
-        # assert that all the points are unchanged
-        np.testing.assert_array_equal(y, y2)
-
-    def test_cosmic_2nd_from_end_ignored(self):
+    def test_cosmic_2nd_from_end_removed(self):
         prng = np.random.RandomState(9)
         y = prng.normal(size=1000)
 
         y[998] = 14000.
 
-        y2 = remove_cosmics(y)
+        self.assert_spike_removed(y, 998)
 
-        # assert that all the points are unchanged
-        np.testing.assert_array_equal(y, y2)
-
-    def test_cosmic_3rd_from_end_ignored(self):
+    def test_cosmic_3rd_from_end_removed(self):
         prng = np.random.RandomState(1)
         y = prng.normal(size=1000)
 
         y[997] = 14000.
 
+        self.assert_spike_removed(y, 997)
+
+    def test_matches_interpolation(self):
+        """
+        Tests that the local fits agree with quadratic interpolation through
+        the same points on a smooth spectrum.
+        """
+        x = np.arange(1000.)
+        y0 = 1000.*np.exp(-0.5*np.square((x - 500.)/80.))
+        y = y0.copy()
+        spikes = [100, 300, 301, 480, 700]
+        y[spikes] += 5000.
+
+        curvature = np.gradient(np.gradient(y))
+        flagged = np.where(curvature <= -1000)[0]
+        expected = y.copy()
+        for index in flagged:
+            near = np.arange(index-10, index+10)
+            near = near[curvature[near] > -1000]
+            expected[index] = interp1d(near, y[near], kind='quadratic')(index)
+
         y2 = remove_cosmics(y)
 
-        # assert that all the points are unchanged
-        np.testing.assert_array_equal(y, y2)
+        np.testing.assert_allclose(y2, expected, atol=0.1)
+        np.testing.assert_allclose(y2, y0, atol=0.1)
+
+
+class TestRemoveCosmicsBatch(unittest.TestCase):
+
+    def test_matches_1d(self):
+        prng = np.random.RandomState(3571)
+        Y = prng.normal(size=(5, 1000))
+        Y[0, 500] = 4000.
+        Y[2, 10] = 12000.
+        Y[2, 11] = 9000.
+        Y[4, 990] = 3000.
+
+        expected = np.array([remove_cosmics(y.copy()) for y in Y])
+
+        Y2 = remove_cosmics(Y)
+
+        np.testing.assert_array_equal(Y2, expected)
+        self.assertTrue(np.all(Y2 < 5.))
+
+    def test_n_jobs(self):
+        prng = np.random.RandomState(3572)
+        Y = prng.normal(size=(6, 500))
+        Y[1, 200] = 4000.
+        Y[5, 3] = 9000.
+
+        expected = remove_cosmics(Y.copy())
+
+        Y2 = remove_cosmics(Y, n_jobs=2, chunk_size=2)
+
+        self.assertIs(Y2, Y)
+        np.testing.assert_array_equal(Y2, expected)
+
+
+class TestRemoveCosmicsMemory(unittest.TestCase):
+
+    def setUp(self):
+        prng = np.random.RandomState(9871)
+        self.Y = prng.normal(size=(40, 500))
+        self.Y[::3, 250] = 5000.
+
+    def test_copy(self):
+        Y = self.Y.copy()
+
+        Y2 = remove_cosmics(Y, copy=True)
+
+        np.testing.assert_array_equal(Y, self.Y)
+        self.assertTrue(np.all(Y2 < 5.))
+
+    def test_in_place_by_default(self):
+        Y = self.Y.copy()
+
+        Y2 = remove_cosmics(Y)
+
+        self.assertIs(Y2, Y)
+        self.assertTrue(np.all(Y < 5.))
+
+    def test_out(self):
+        Y = self.Y.copy()
+        out = np.empty_like(Y)
+
+        Y2 = remove_cosmics(Y, out=out)
+
+        self.assertIs(Y2, out)
+        np.testing.assert_array_equal(Y, self.Y)
+        np.testing.assert_array_equal(out, remove_cosmics(self.Y, copy=True))
+
+    def test_chunks_match(self):
+        np.testing.assert_array_equal(
+                remove_cosmics(self.Y, copy=True, chunk_size=7),
+                remove_cosmics(self.Y, copy=True))
+
+    def test_memory_bounded_by_chunk(self):
+        """
+        Tests that the scratch memory does not grow with the number of spectra.
+        """
+        def peak(Y, n_jobs=1):
+            tracemalloc.start()
+            remove_cosmics(Y, chunk_size=10, n_jobs=n_jobs)
+            size = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return size
+
+        small = np.tile(self.Y, (1, 1))
+        large = np.tile(self.Y, (10, 1))
+
+        self.assertLess(peak(large), 1.5*peak(small))
+        self.assertLess(peak(large), large.nbytes/4)
+        # one set of buffers per thread
+        self.assertLess(peak(large, n_jobs=2), 2.5*peak(small))
+
+
+class TestRemoveCosmicsDtype(unittest.TestCase):
+
+    def setUp(self):
+        prng = np.random.RandomState(1616)
+        # 16 bit detector counts
+        self.Y = prng.poisson(1000., size=(20, 400)).astype(np.uint16)
+        self.Y[::4, 200] = 30000
+
+    def test_integer_in_place(self):
+        Y = self.Y.copy()
+
+        remove_cosmics(Y)
+
+        self.assertEqual(Y.dtype, np.uint16)
+        np.testing.assert_array_equal(Y, np.round(remove_cosmics(self.Y.astype(float))))
+
+    def test_integer_copy(self):
+        Y2 = remove_cosmics(self.Y, copy=True)
+
+        self.assertEqual(Y2.dtype, np.float64)
+        np.testing.assert_array_equal(Y2, remove_cosmics(self.Y.astype(float)))
+
+    def test_float32(self):
+        """
+        Tests that float32 spectra give the float64 result rounded to float32.
+        """
+        Y = self.Y.astype(np.float32)
+
+        remove_cosmics(Y)
+
+        self.assertEqual(Y.dtype, np.float32)
+        np.testing.assert_allclose(Y, remove_cosmics(self.Y.astype(float)), rtol=1e-7)
+        self.assertEqual(remove_cosmics(self.Y, copy=True, dtype=np.float32).dtype, np.float32)
+
+    def test_multi_float32(self):
+        frames = np.stack([self.Y.astype(np.float32)]*5)
+        frames[2, 3, 50] += 20000.
+        for method in ('mad', 'sigma_clip'):
+            combined = remove_cosmics_multi(frames, method=method)
+
+            self.assertEqual(combined.dtype, np.float32)
+            np.testing.assert_allclose(combined, remove_cosmics_multi(frames.astype(float), method=method),
+                    rtol=1e-6)
+
+
+class TestRemoveCosmicsMulti(unittest.TestCase):
+
+    def setUp(self):
+        prng = np.random.RandomState(4242)
+        self.signal = 100. + 50.*np.sin(np.linspace(0, 10, 300))
+        self.frames = self.signal + prng.normal(size=(6, 4, 300))
+        self.frames[1, 0, 100] += 3000.
+        self.frames[4, 0, 100] += 500.
+        self.frames[2, 3, 7] += 800.
+
+    def test_mad(self):
+        combined, mask = remove_cosmics_multi(self.frames, full_output=True)
+
+        self.assertEqual(combined.shape, (4, 300))
+        self.assertTrue(mask[1, 0, 100])
+        self.assertTrue(mask[4, 0, 100])
+        self.assertTrue(mask[2, 3, 7])
+        np.testing.assert_allclose(combined, np.broadcast_to(self.signal, (4, 300)), atol=3.)
+
+    def test_sigma_clip(self):
+        combined, mask = remove_cosmics_multi(self.frames, method='sigma_clip', threshold=3., full_output=True)
+
+        self.assertTrue(mask[1, 0, 100])
+        self.assertTrue(mask[2, 3, 7])
+        np.testing.assert_allclose(combined, np.broadcast_to(self.signal, (4, 300)), atol=3.)
+
+    def test_single_spectrum_sum(self):
+        frames = self.frames[:, 0]
+
+        combined = remove_cosmics_multi(frames, combine='sum')
+
+        self.assertEqual(combined.shape, (300,))
+        np.testing.assert_allclose(combined, 6.*self.signal, atol=18.)
+
+    def test_no_cosmics_is_mean(self):
+        prng = np.random.RandomState(11)
+        frames = prng.normal(size=(5, 200))
+
+        combined, mask = remove_cosmics_multi(frames, threshold=10., full_output=True)
+
+        self.assertFalse(np.any(mask))
+        np.testing.assert_allclose(combined, frames.mean(axis=0))
+
+    def test_chunks_match(self):
+        out = np.empty((4, 300))
+
+        result = remove_cosmics_multi(self.frames, chunk_size=3, out=out)
+
+        self.assertIs(result, out)
+        np.testing.assert_array_equal(out, remove_cosmics_multi(self.frames))
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            remove_cosmics_multi(self.frames, method='nope')
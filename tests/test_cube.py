@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+import numpy as np
+from spyctra import arPLS_batch, remove_cosmics, lorentz
+from spyctra.cube import SpectralCube
+
+
+class TestSpectralCube(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        prng = np.random.RandomState(1601)
+        self.wavenumbers = np.linspace(100., 1000., 200)
+        self.data = 10.*np.sin(self.wavenumbers/100.) + prng.normal(size=(6, 5, 200))
+        self.data[2, 3, 50] += 5000.
+        self.filename = self.path('cube.npy')
+        np.save(self.filename, self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_open_npy(self):
+        cube = SpectralCube.open(self.filename, wavenumbers=self.wavenumbers)
+
+        self.assertIsInstance(cube.data, np.memmap)
+        self.assertEqual(cube.shape, (6, 5, 200))
+        self.assertEqual(cube.n_spectra, 30)
+        np.testing.assert_array_equal(cube[2], self.data[2])
+
+    def test_open_raw(self):
+        filename = self.path('cube.raw')
+        self.data.astype(np.float32).tofile(filename)
+
+        cube = SpectralCube.open(filename, dtype=np.float32, wavenumbers=self.wavenumbers)
+
+        self.assertEqual(cube.shape, (30, 200))
+        np.testing.assert_array_equal(cube.spectra, self.data.reshape((30, 200)).astype(np.float32))
+
+    def test_wrong_wavenumbers(self):
+        with self.assertRaises(ValueError):
+            SpectralCube(self.data, self.wavenumbers[1:])
+
+    def test_chunks(self):
+        cube = SpectralCube.open(self.filename)
+
+        chunks = list(cube.chunks(chunk_size=7))
+
+        self.assertEqual([start for start, block in chunks], [0, 7, 14, 21, 28])
+        np.testing.assert_array_equal(np.vstack([block for start, block in chunks]), cube.spectra)
+
+    def test_arPLS(self):
+        cube = SpectralCube.open(self.filename, wavenumbers=self.wavenumbers)
+
+        baselines = cube.arPLS(out=self.path('baselines.npy'), chunk_size=4, lambda_=1.e4)
+
+        self.assertIsInstance(baselines.data, np.memmap)
+        np.testing.assert_array_equal(baselines.wavenumbers, self.wavenumbers)
+        expected = arPLS_batch(self.data.reshape((30, 200)), lambda_=1.e4).reshape(self.data.shape)
+        np.testing.assert_allclose(np.load(self.path('baselines.npy')), expected)
+
+    def test_remove_cosmics(self):
+        cube = SpectralCube.open(self.filename)
+
+        cleaned = cube.remove_cosmics(out=self.path('cleaned.raw'), chunk_size=4)
+
+        np.testing.assert_array_equal(cube.data, self.data)
+        np.testing.assert_array_equal(cleaned.data, remove_cosmics(self.data.reshape((30, 200)), copy=True).reshape(self.data.shape))
+
+    def test_remove_cosmics_in_place(self):
+        cube = SpectralCube.open(self.filename, mode='r+')
+
+        cube.remove_cosmics(out=cube)
+
+        self.assertLess(np.load(self.filename)[2, 3, 50], 100.)
+
+    def test_evaluate(self):
+        params = np.tile([2., 500., 10., 5., 700., 3.], (6, 5, 1))
+
+        spectra = SpectralCube.evaluate(lorentz, params, self.wavenumbers, out=self.path('model.npy'), chunk_size=4)
+
+        self.assertEqual(spectra.shape, (6, 5, 200))
+        np.testing.assert_allclose(spectra[3, 1], lorentz(params[3, 1], self.wavenumbers))
+
+    def test_memory_bounded_by_chunk(self):
+        data = np.lib.format.open_memmap(self.path('large.npy'), mode='w+', shape=(2000, 200))
+        data[...] = np.tile(self.data.reshape((30, 200)), (67, 1))[:2000]
+        data.flush()
+        cube = SpectralCube.open(self.path('large.npy'))
+
+        tracemalloc.start()
+        cube.apply(remove_cosmics, out=self.path('large_out.npy'), chunk_size=100)
+        size = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        self.assertLess(size, data.nbytes/4)
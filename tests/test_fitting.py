@@ -3,7 +3,7 @@ import unittest
 
 from scipy.optimize import curve_fit, leastsq
 
-from spyctra import multifit
+from spyctra import multifit, fit_batch, lorentz, gaussian, voigt
 
 def linef( x, *p):
     return p[0]*np.power(x, 2) + p[1]
@@ -42,3 +42,209 @@ class TestErrorEstimate(unittest.TestCase):
         self.assertLess((aerr_should_be-perr[0])/aerr_should_be, 0.1)
         self.assertLess((b_should_be-pfit[1])/b_should_be, 0.15)
         self.assertLess((berr_should_be-perr[1])/berr_should_be, 0.1)
+
+    def test_seed_reproducible(self):
+        """
+        Tests that the same seed and number of workers give the same result.
+        """
+        prng = np.random.RandomState(31)
+        datax = np.linspace(0., 10, 200)
+        datay = linef(datax, 1.5, 0.5) + prng.normal(0., 10., len(datax))
+        datayerrors = np.ones_like(datay)*10.
+
+        result1 = multifit(linef, datax, datay, datayerrors, [1., 1.], iterations=50, seed=42, n_jobs=2)
+        result2 = multifit(linef, datax, datay, datayerrors, [1., 1.], iterations=50, seed=42, n_jobs=2)
+        result3 = multifit(linef, datax, datay, datayerrors, [1., 1.], iterations=50, seed=43, n_jobs=2)
+
+        np.testing.assert_array_equal(result1[0], result2[0])
+        np.testing.assert_array_equal(result1[1], result2[1])
+        self.assertFalse(np.array_equal(result1[0], result3[0]))
+
+    def test_extra_args(self):
+        prng = np.random.RandomState(32)
+        datax = np.linspace(0., 10, 200)
+        datay = linef(datax, 1.5, 0.5) + 3. + prng.normal(0., 1., len(datax))
+
+        def shifted(x, a, b, shift):
+            return linef(x, a, b) + shift
+
+        pfit, perr = multifit(shifted, datax, datay, None, [1., 1.], iterations=20, extra_args=(3.,), seed=1)
+
+        self.assertAlmostEqual(pfit[0], 1.5, places=1)
+
+    def test_unhashable_func(self):
+        class Line(object):
+            def __eq__(self, other):
+                return isinstance(other, Line)
+
+            def __call__(self, x, a, b):
+                return linef(x, a, b)
+
+        prng = np.random.RandomState(35)
+        datax = np.linspace(0., 10, 200)
+        datay = linef(datax, 1.5, 0.5) + prng.normal(0., 1., len(datax))
+
+        result = multifit(Line(), datax, datay, None, [1., 1.], iterations=20, seed=4)
+        expected = multifit(linef, datax, datay, None, [1., 1.], iterations=20, seed=4)
+
+        np.testing.assert_allclose(result[0], expected[0])
+
+    def test_builtin_line_shape(self):
+        """
+        Tests fitting a built in line shape, which uses its analytic Jacobian.
+        """
+        prng = np.random.RandomState(33)
+        datax = np.linspace(0., 100., 500)
+        params = [[3., 30., 50.], [5., 60., 20.]]
+        datay = lorentz(params, datax) + prng.normal(0., 0.5, len(datax))
+
+        pfit, perr = multifit(lorentz, datax, datay, None, [[4., 31., 40.], [4., 59., 25.]], iterations=20, seed=2)
+
+        np.testing.assert_allclose(pfit, np.ravel(params), rtol=0.05)
+        self.assertEqual(perr.shape, (6,))
+
+    def test_jac(self):
+        prng = np.random.RandomState(34)
+        datax = np.linspace(0., 10, 200)
+        datay = linef(datax, 1.5, 0.5) + prng.normal(0., 1., len(datax))
+
+        def linef_jac(x, *p):
+            return np.stack([np.power(x, 2), np.ones_like(x)], axis=-1)
+
+        result = multifit(linef, datax, datay, None, [1., 1.], iterations=20, seed=3, jac=linef_jac)
+        expected = multifit(linef, datax, datay, None, [1., 1.], iterations=20, seed=3)
+
+        np.testing.assert_allclose(result[0], expected[0], rtol=1e-6)
+
+
+def shifted_gaussians(p, x):
+    """
+    A model that is not built in, so it uses a numerical Jacobian.
+    """
+    return gaussian(p, x) + 1.
+
+
+class TestFitBatch(unittest.TestCase):
+
+    def setUp(self):
+        prng = np.random.RandomState(6060)
+        M = 12
+        self.x = np.linspace(0., 100., 400)
+        self.params = np.stack([
+            np.column_stack([prng.uniform(2., 4., M), prng.uniform(28., 32., M), prng.uniform(40., 60., M)]),
+            np.column_stack([prng.uniform(3., 6., M), prng.uniform(58., 62., M), prng.uniform(15., 25., M)]),
+        ], axis=1)
+        self.Y = lorentz(self.params, self.x) + prng.normal(0., 0.5, (M, 400))
+        self.p0 = [[3., 30., 50.], [4., 60., 20.]]
+
+    def test_matches_leastsq(self):
+        params, cov, info = fit_batch(lorentz, self.x, self.Y, self.p0, full_output=True)
+
+        self.assertEqual(params.shape, (12, 2, 3))
+        self.assertEqual(cov.shape, (12, 6, 6))
+        self.assertTrue(np.all(info['success']))
+        for y, p, c in zip(self.Y, params, cov):
+            errfunc = lambda q, x, y: lorentz(q, x) - y
+            expected, expected_cov, infodict, mesg, ier = leastsq(errfunc, np.ravel(self.p0), args=(self.x, y), full_output=1)
+            expected_cov *= np.sum(infodict['fvec']**2) / (len(y) - 6)
+            np.testing.assert_allclose(p.ravel(), expected, rtol=1e-5)
+            np.testing.assert_allclose(c, expected_cov, rtol=1e-3, atol=1e-10)
+
+    def test_flat_p0(self):
+        params, cov = fit_batch(lorentz, self.x, self.Y, np.ravel(self.p0))
+
+        self.assertEqual(params.shape, (12, 6))
+        np.testing.assert_allclose(params, self.params.reshape((12, 6)), rtol=0.1)
+
+    def test_p0_per_spectrum(self):
+        p0 = self.params * 1.05
+
+        params, cov = fit_batch(lorentz, self.x, self.Y, p0)
+
+        np.testing.assert_allclose(params, fit_batch(lorentz, self.x, self.Y, self.p0)[0], rtol=1e-5)
+
+    def test_map_width(self):
+        """
+        Tests that each map row starts from the row above it: a slowly
+        drifting peak takes fewer iterations, also split over workers with
+        the default chunk size.
+        """
+        x = np.arange(100.)
+        params = np.column_stack([np.full(24, 3.), 40. + 0.05*np.arange(24), np.full(24, 100.)])[:, None]
+        Y = lorentz(params, x) + np.random.RandomState(1).normal(0., 0.5, (24, 100))
+        p0 = [3., 46., 80.]
+        unseeded = fit_batch(lorentz, x, Y, p0, full_output=True)
+
+        fitted, cov, info = fit_batch(lorentz, x, Y, p0, map_width=2, full_output=True)
+
+        self.assertTrue(np.all(info['success']))
+        np.testing.assert_allclose(fitted, unseeded[0], rtol=1e-5)
+        self.assertTrue(np.all(info['iterations'][2:] < unseeded[2]['iterations'][2:]))
+
+        # 24 spectra over 2 workers are 4 map rows per task
+        fitted, cov, info = fit_batch(lorentz, x, Y, p0, map_width=2, full_output=True, n_jobs=2)
+
+        np.testing.assert_allclose(fitted, unseeded[0], rtol=1e-5)
+        seeded = np.arange(24) % 4 >= 2
+        self.assertTrue(np.all(info['iterations'][seeded] < unseeded[2]['iterations'][seeded]))
+
+    def test_nan_rows(self):
+        """
+        Tests that spectra or guesses with NaN fail without affecting the others.
+        """
+        Y = self.Y.copy()
+        Y[1, 50] = np.nan
+        p0 = np.tile(self.p0, (12, 1, 1))
+        p0[4, 0, 1] = np.nan
+
+        params, cov, info = fit_batch(lorentz, self.x, Y, p0, full_output=True)
+
+        for row in (1, 4):
+            self.assertFalse(info['success'][row])
+            self.assertTrue(np.all(np.isnan(params[row])))
+            self.assertTrue(np.all(np.isnan(cov[row])))
+        rows = [0, 2, 3] + list(range(5, 12))
+        self.assertTrue(np.all(info['success'][rows]))
+        np.testing.assert_allclose(params[rows], fit_batch(lorentz, self.x, self.Y, self.p0)[0][rows], rtol=1e-5)
+
+    def test_p0_widths_off(self):
+        """
+        Tests that a guess several widths from the peak still converges to it,
+        as with leastsq.
+        """
+        x = np.arange(100.)
+        y = lorentz([3., 40., 100.], x) + np.random.RandomState(0).normal(0., 1., 100)
+        errfunc = lambda q, x, y: lorentz(q, x) - y
+
+        for xo in (25., 32., 50., 55.):
+            params, cov, info = fit_batch(lorentz, x, y, [3., xo, 100.], full_output=True)
+
+            self.assertTrue(info['success'][0])
+            expected = leastsq(errfunc, [3., xo, 100.], args=(x, y))[0]
+            np.testing.assert_allclose(np.abs(params[0]), np.abs(expected), rtol=1e-5)
+
+    def test_numerical_jacobian(self):
+        Y = gaussian(self.params, self.x) + 1.
+
+        params, cov = fit_batch(shifted_gaussians, self.x, Y, self.p0)
+
+        np.testing.assert_allclose(params, self.params, rtol=1e-5)
+
+    def test_n_jobs(self):
+        params, cov = fit_batch(lorentz, self.x, self.Y, self.p0, n_jobs=2, chunk_size=5)
+
+        np.testing.assert_allclose(params, fit_batch(lorentz, self.x, self.Y, self.p0)[0])
+
+        Y = gaussian(self.params, self.x) + 1.
+        params, cov = fit_batch(shifted_gaussians, self.x, Y, self.p0, n_jobs=2, chunk_size=5)
+
+        np.testing.assert_allclose(params, self.params, rtol=1e-5)
+
+    def test_voigt(self):
+        params = np.array([[2., 1., 30., 50.], [3., 2., 60., 20.]])
+        Y = voigt(params, self.x)[None] * np.linspace(0.8, 1.2, 4)[:, None, None][:, 0]
+
+        fitted, cov = fit_batch(voigt, self.x, Y, [2.5, 1.5, 31., 40., 2.5, 1.5, 59., 25.])
+
+        self.assertEqual(fitted.shape, (4, 8))
+        np.testing.assert_allclose(fitted[:, [0, 1, 2, 4, 5, 6]], np.tile(params[:, :3].ravel(), (4, 1)), rtol=1e-5)
@@ -1,7 +1,7 @@
 import unittest
 import numpy as np
 
-from spyctra import lorentz, gaussian
+from spyctra import lorentz, gaussian, voigt, pseudo_voigt, lorentz_jac, gaussian_jac, voigt_jac, pseudo_voigt_jac
 
 
 class TestLorentz(unittest.TestCase):
@@ -220,3 +220,158 @@ class TestGaussian(unittest.TestCase):
         params = [sigma1, xo1, amplitude1, sigma2, xo2, amplitude2]
 
         result = gaussian(params, x)
+
+
+def numerical_jacobian(func, params, x, h=1e-6):
+    params = np.ravel(params).astype(float)
+    columns = []
+    for i in range(len(params)):
+        step = np.zeros_like(params)
+        step[i] = h
+        columns.append((func(params + step, x) - func(params - step, x)) / (2*h))
+    return np.stack(columns, axis=-1)
+
+
+class TestJacobians(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.linspace(0., 30., 50)
+        self.params = [[3., 12., 33.], [2., 15., -24.], [5., 20., 10.]]
+
+    def test_lorentz_jac(self):
+        jac = lorentz_jac(self.params, self.x)
+
+        self.assertEqual(jac.shape, (50, 9))
+        np.testing.assert_allclose(jac, numerical_jacobian(lorentz, self.params, self.x), atol=1e-6)
+
+    def test_gaussian_jac(self):
+        jac = gaussian_jac(self.params, self.x)
+
+        self.assertEqual(jac.shape, (50, 9))
+        np.testing.assert_allclose(jac, numerical_jacobian(gaussian, self.params, self.x), atol=1e-6)
+
+    def test_single_peak_single_value(self):
+        params = [6., 9., 20.]
+
+        jac = lorentz_jac(params, 10.)
+
+        self.assertEqual(jac.shape, (3,))
+        np.testing.assert_allclose(jac, numerical_jacobian(lorentz, params, 10.), atol=1e-6)
+
+
+class TestBroadcastEvaluation(unittest.TestCase):
+
+    def setUp(self):
+        prng = np.random.RandomState(8080)
+        self.x = np.linspace(0., 100., 300)
+        self.params = np.stack([
+            prng.uniform(1., 5., (4, 6)),
+            prng.uniform(0., 100., (4, 6)),
+            prng.uniform(-10., 50., (4, 6)),
+        ], axis=-1)
+
+    def test_batch(self):
+        for func in (lorentz, gaussian):
+            result = func(self.params, self.x)
+
+            self.assertEqual(result.shape, (4, 300))
+            for params, row in zip(self.params, result):
+                np.testing.assert_allclose(row, func(params, self.x))
+
+    def test_chunks(self):
+        for func in (lorentz, gaussian):
+            np.testing.assert_allclose(
+                    func(self.params[0], self.x, chunk_size=4),
+                    func(self.params[0], self.x))
+
+    def test_float32(self):
+        for func in (lorentz, gaussian):
+            result = func(self.params, self.x, dtype=np.float32)
+
+            self.assertEqual(result.dtype, np.float32)
+            np.testing.assert_allclose(result, func(self.params, self.x), rtol=1e-5, atol=1e-4)
+
+    def test_float32_follows_x(self):
+        """
+        Tests that a float32 x is evaluated in float32, within the documented
+        1e-7 * |x| / width of the amplitude.
+        """
+        x = np.linspace(100., 3200., 2000)
+        params = [[5., 1000., 50.], [8., 2500., 20.]]
+        for func in (lorentz, gaussian):
+            result = func(params, x.astype(np.float32))
+
+            self.assertEqual(result.dtype, np.float32)
+            np.testing.assert_allclose(result, func(params, x), atol=1e-4*50.)
+        self.assertEqual(lorentz(params, x.astype(np.int16)).dtype, np.float64)
+
+    def test_integer_dtype(self):
+        with self.assertRaises(ValueError):
+            lorentz(self.params, self.x, dtype=int)
+
+    def test_batch_jacobian(self):
+        for func, jac in ((lorentz, lorentz_jac), (gaussian, gaussian_jac)):
+            result = jac(self.params, self.x)
+
+            self.assertEqual(result.shape, (4, 300, 18))
+            np.testing.assert_allclose(result[2], jac(self.params[2], self.x))
+
+
+class TestVoigt(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.linspace(0., 60., 121)
+        self.params = [[2., 1., 20., 30.], [3., 2.5, 35., -10.]]
+
+    def test_peak_height(self):
+        self.assertAlmostEqual(voigt([2., 1., 20., 30.], 20.), 30.)
+
+    def test_gaussian_limit(self):
+        np.testing.assert_allclose(voigt([2., 1e-9, 20., 30.], self.x), gaussian([2., 20., 30.], self.x), atol=1e-6)
+
+    def test_lorentz_limit(self):
+        np.testing.assert_allclose(voigt([1e-4, 3., 20., 30.], self.x), lorentz([3., 20., 30.], self.x), atol=1e-3)
+
+    def test_multiple_peaks(self):
+        result = voigt(np.ravel(self.params), self.x)
+
+        np.testing.assert_allclose(result, voigt(self.params[0], self.x) + voigt(self.params[1], self.x))
+
+    def test_approximate(self):
+        for sigma, gamma in [(1., 0.01), (1., 1.), (0.1, 3.)]:
+            params = [sigma, gamma, 30., 1.]
+            exact = voigt(params, self.x)
+            approximate = voigt(params, self.x, approximate=True)
+            self.assertLess(np.abs(exact - approximate).max(), 0.012)
+
+    def test_voigt_jac(self):
+        jac = voigt_jac(self.params, self.x)
+
+        self.assertEqual(jac.shape, (121, 8))
+        np.testing.assert_allclose(jac, numerical_jacobian(voigt, self.params, self.x), atol=1e-6)
+
+    def test_approximate_jac(self):
+        approximate = lambda p, x: voigt(p, x, approximate=True)
+
+        jac = voigt_jac(self.params, self.x, approximate=True)
+
+        np.testing.assert_allclose(jac, numerical_jacobian(approximate, self.params, self.x), atol=1e-5)
+
+
+class TestPseudoVoigt(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.linspace(0., 60., 121)
+
+    def test_limits(self):
+        np.testing.assert_allclose(pseudo_voigt([3., 20., 30., 1.], self.x), lorentz([3., 20., 30.], self.x))
+        sigma = 3./np.sqrt(2.*np.log(2.))
+        np.testing.assert_allclose(pseudo_voigt([3., 20., 30., 0.], self.x), gaussian([sigma, 20., 30.], self.x))
+
+    def test_pseudo_voigt_jac(self):
+        params = [[3., 20., 30., 0.3], [2., 35., -10., 0.8]]
+
+        jac = pseudo_voigt_jac(params, self.x)
+
+        self.assertEqual(jac.shape, (121, 8))
+        np.testing.assert_allclose(jac, numerical_jacobian(pseudo_voigt, params, self.x), atol=1e-6)
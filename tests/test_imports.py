@@ -0,0 +1,56 @@
+import subprocess
+import sys
+import unittest
+import spyctra
+
+
+def run_python(code):
+    """
+    Run code in a fresh interpreter, and return what it prints.
+    """
+    return subprocess.check_output([sys.executable, '-c', code]).decode().strip()
+
+
+class TestLazyImports(unittest.TestCase):
+
+    def test_gaussian_without_scipy(self):
+        output = run_python(
+                "import sys, spyctra\n"
+                "spyctra.gaussian([1., 0., 1.], 0.)\n"
+                "print(sorted(m for m in sys.modules if m.split('.')[0] == 'scipy' or m == 'spyctra.baseline'))")
+
+        self.assertEqual(output, '[]')
+
+    def test_baseline_defers_scipy(self):
+        output = run_python(
+                "import sys\n"
+                "from spyctra import arPLS, remove_cosmics, fit_batch, find_peaks, Pipeline, SpectralCube\n"
+                "from spyctra.cli import _parser\n"
+                "_parser()\n"
+                "print(sorted(m for m in sys.modules if m.split('.')[0] == 'scipy'))")
+
+        self.assertEqual(output, '[]')
+
+    def test_import_time(self):
+        output = run_python(
+                "import time, numpy\n"
+                "start = time.perf_counter()\n"
+                "import spyctra\n"
+                "spyctra.gaussian, spyctra.lorentz, spyctra.remove_cosmics\n"
+                "print(time.perf_counter() - start)")
+
+        self.assertLess(float(output), 0.1)
+
+    def test_names(self):
+        from spyctra.baseline import arPLS
+        from spyctra import instrument
+
+        self.assertIs(spyctra.arPLS, arPLS)
+        self.assertIs(spyctra.instrument, instrument)
+        self.assertIn('fit_batch', dir(spyctra))
+        for name in spyctra.__all__:
+            self.assertTrue(hasattr(spyctra, name), name)
+
+    def test_unknown_name(self):
+        with self.assertRaises(AttributeError):
+            spyctra.nope
@@ -0,0 +1,152 @@
+import unittest
+import numpy as np
+from spyctra import (arPLS, arPLS_batch, arPLS2d, remove_cosmics, remove_cosmics_multi,
+        multifit, fit_batch, lorentz, instrument)
+
+
+class TestInstrument(unittest.TestCase):
+
+    def setUp(self):
+        prng = np.random.RandomState(2001)
+        self.x = np.linspace(0., 100., 300)
+        self.Y = lorentz([3., 50., 100.], self.x) + 0.5*self.x + prng.normal(size=(4, 300))
+
+    def test_disabled(self):
+        self.assertFalse(instrument.enabled())
+
+        arPLS(self.Y[0])
+
+        with instrument.record() as recorder:
+            self.assertTrue(instrument.enabled())
+        self.assertFalse(instrument.enabled())
+        self.assertEqual(recorder.events, [])
+
+    def test_arPLS(self):
+        with instrument.record() as recorder:
+            Z, W, niter = arPLS_batch(self.Y, full_output=True)
+
+        event, = recorder.events
+        self.assertEqual(event['name'], 'arPLS')
+        self.assertEqual(event['spectra'], 4)
+        np.testing.assert_array_equal(event['iterations'], niter)
+        self.assertTrue(np.all(event['converged']))
+        self.assertTrue(np.all(event['condition'] < 1.e-6))
+        self.assertGreater(event['solve_time'], 0.)
+        self.assertLessEqual(event['solve_time'], event['time'])
+
+    def test_arPLS_chunks(self):
+        """
+        Tests that a call over several chunks reports one event.
+        """
+        Y = np.tile(self.Y, (3, 1))
+
+        with instrument.record() as recorder:
+            Z, W, niter = arPLS_batch(Y, full_output=True, chunk_size=5)
+
+        event, = recorder.events
+        self.assertEqual(event['spectra'], 12)
+        np.testing.assert_array_equal(event['iterations'], niter)
+        self.assertEqual(event['condition'].shape, (12,))
+        self.assertTrue(np.all(event['converged']))
+        self.assertLessEqual(event['solve_time'], event['time'])
+        self.assertEqual(recorder.summary()['arPLS']['calls'], 1)
+
+    def test_arPLS_itermax(self):
+        with instrument.record() as recorder:
+            arPLS(self.Y[0], ratio=1.e-30, itermax=3)
+
+        event, = recorder.events
+        self.assertFalse(event['converged'][0])
+
+    def test_arPLSnd(self):
+        with instrument.record() as recorder:
+            arPLS2d(self.Y, lambda_=(1., 1.e4))
+
+        event, = recorder.events
+        self.assertEqual(event['name'], 'arPLSnd')
+        self.assertGreater(event['solver_iterations'], event['iterations'])
+
+    def test_remove_cosmics(self):
+        Y = self.Y.copy()
+        Y[1, 100] += 5000.
+        Y[1, 200] += 5000.
+        Y[3, 10] += 5000.
+        expected = np.count_nonzero(np.gradient(np.gradient(Y, axis=-1), axis=-1) <= -1000, axis=-1)
+
+        with instrument.record() as recorder:
+            remove_cosmics(Y)
+
+        event, = recorder.events
+        np.testing.assert_array_equal(event['replaced'], expected)
+        self.assertEqual(event['unreplaced'], 0)
+
+    def test_remove_cosmics_multi(self):
+        frames = np.stack([self.Y]*5) + np.random.RandomState(2002).normal(size=(5, 4, 300))
+        frames[2, 1, 30] += 1000.
+
+        with instrument.record() as recorder:
+            remove_cosmics_multi(frames)
+
+        self.assertGreaterEqual(recorder.events[0]['flagged'], 1)
+
+    def test_multifit(self):
+        y = lorentz([3., 50., 100.], self.x)
+
+        with instrument.record(names=['multifit']) as recorder:
+            multifit(lorentz, self.x, y, np.ones_like(y), [2., 49., 90.], iterations=10, seed=1)
+
+        event, = recorder.events
+        self.assertEqual(event['fits'], 10)
+        self.assertTrue(np.all(event['evaluations'] > 0))
+        self.assertFalse(np.any(event['maxfev_reached']))
+
+    def test_fit_batch(self):
+        Y = lorentz([3., 50., 100.], self.x)*np.array([[1.], [2.]])
+
+        with instrument.record() as recorder:
+            params, cov, info = fit_batch(lorentz, self.x, Y, [2., 49., 90.], full_output=True)
+
+        event, = recorder.events
+        np.testing.assert_array_equal(event['iterations'], info['iterations'])
+        np.testing.assert_array_equal(event['evaluations'], info['iterations'] + 1)
+
+    def test_fit_batch_map_width(self):
+        """
+        Tests that a map fitted one map row at a time reports one event.
+        """
+        Y = lorentz([3., 50., 100.], self.x)*np.linspace(1., 2., 12)[:, None]
+
+        with instrument.record() as recorder:
+            params, cov, info = fit_batch(lorentz, self.x, Y, [2., 49., 90.], map_width=4, full_output=True)
+
+        event, = recorder.events
+        self.assertEqual(event['spectra'], 12)
+        np.testing.assert_array_equal(event['iterations'], info['iterations'])
+        np.testing.assert_array_equal(event['evaluations'], info['iterations'] + 1)
+        np.testing.assert_array_equal(event['success'], info['success'])
+
+    def test_callback_and_summary(self):
+        received = []
+
+        with instrument.record(callback=received.append, names=['arPLS']) as recorder:
+            arPLS(self.Y[0])
+            arPLS(self.Y[1])
+            remove_cosmics(self.Y.copy())
+
+        self.assertEqual(len(received), 2)
+        summary = recorder.summary()
+        self.assertEqual(list(summary), ['arPLS'])
+        self.assertEqual(summary['arPLS']['calls'], 2)
+        self.assertEqual(summary['arPLS']['spectra'], 2)
+        self.assertEqual(summary['arPLS']['converged'], 2)
+
+    def test_listener(self):
+        received = []
+        instrument.add_listener(received.append)
+        try:
+            remove_cosmics(self.Y.copy())
+        finally:
+            instrument.remove_listener(received.append)
+
+        self.assertEqual(received[0]['name'], 'remove_cosmics')
+        self.assertFalse(instrument.enabled())
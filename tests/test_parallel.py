@@ -0,0 +1,63 @@
+import unittest
+import numpy as np
+
+from spyctra import arPLS_batch
+from spyctra.parallel import map_spectra
+
+
+def scaled_cumsum(block, scale=1.):
+    return scale*np.cumsum(block, axis=1)
+
+
+def row_sums(block):
+    return block.sum(axis=1, keepdims=True)
+
+
+def scaled_rows(block, scale):
+    return scale*block
+
+
+class TestMapSpectra(unittest.TestCase):
+
+    def setUp(self):
+        prng = np.random.RandomState(5432)
+        self.Y = prng.normal(size=(4, 5, 50))
+
+    def test_process_backend(self):
+        result = map_spectra(scaled_cumsum, self.Y, n_jobs=2, chunk_size=3, scale=2.)
+
+        np.testing.assert_allclose(result, 2.*np.cumsum(self.Y, axis=-1))
+
+    def test_thread_backend(self):
+        result = map_spectra(scaled_cumsum, self.Y, n_jobs=3, chunk_size=1, backend='thread')
+
+        np.testing.assert_allclose(result, np.cumsum(self.Y, axis=-1))
+
+    def test_serial(self):
+        result = map_spectra(scaled_cumsum, self.Y, n_jobs=1)
+
+        np.testing.assert_allclose(result, np.cumsum(self.Y, axis=-1))
+
+    def test_out_channels(self):
+        result = map_spectra(row_sums, self.Y, n_jobs=2, chunk_size=7, out_channels=1)
+
+        self.assertEqual(result.shape, (4, 5, 1))
+        np.testing.assert_allclose(result[..., 0], self.Y.sum(axis=-1))
+
+    def test_row_kwargs(self):
+        scale = np.arange(20.).reshape((4, 5, 1))
+        for n_jobs, backend in ((1, 'process'), (2, 'process'), (2, 'thread')):
+            result = map_spectra(scaled_rows, self.Y, n_jobs=n_jobs, chunk_size=3, backend=backend,
+                    row_kwargs={'scale': scale})
+
+            np.testing.assert_allclose(result, scale*self.Y)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            map_spectra(scaled_cumsum, self.Y, backend='nope')
+
+    def test_arPLS_batch_n_jobs(self):
+        x = np.arange(0, 200, 1)
+        Y = 10. + 2.*x + self.Y.reshape((-1, 50)).repeat(4, axis=1)
+
+        np.testing.assert_allclose(arPLS_batch(Y, n_jobs=2, chunk_size=6), arPLS_batch(Y), rtol=1e-10)
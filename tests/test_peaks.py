@@ -0,0 +1,84 @@
+import unittest
+import numpy as np
+from scipy.signal import find_peaks as scipy_find_peaks, peak_prominences, peak_widths
+from spyctra import find_peaks, fit_batch, lorentz, gaussian
+
+
+class TestFindPeaks(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.linspace(0., 100., 1000)
+        self.params = np.array([[2., 30., 100.], [1., 60., 50.], [3., 80., 20.]])
+        prng = np.random.RandomState(1501)
+        self.y = lorentz(self.params, self.x) + prng.normal(size=1000)
+
+    def test_lorentz(self):
+        p0 = find_peaks(self.y, self.x)
+
+        self.assertEqual(p0.shape, (3, 3))
+        np.testing.assert_allclose(p0[:, 1], self.params[:, 1], atol=0.5)
+        np.testing.assert_allclose(p0[:, 2], self.params[:, 2], atol=4.)
+        np.testing.assert_allclose(p0[:, 0], self.params[:, 0], rtol=0.25)
+
+    def test_gaussian(self):
+        params = np.array([[2., 30., 100.], [4., 70., 40.]])
+        y = gaussian(params, self.x)
+
+        p0 = find_peaks(y, self.x, shape='gaussian')
+
+        np.testing.assert_allclose(p0, params, rtol=0.01)
+
+    def test_matches_scipy(self):
+        """
+        Tests the prominences and widths against scipy.signal, on random walks
+        which have peaks of all sizes.
+        """
+        prng = np.random.RandomState(1502)
+        Y = prng.normal(size=(10, 500)).cumsum(axis=-1)
+
+        p0, prominences = find_peaks(Y, prominence=0., full_output=True)
+
+        for y, p, prominence in zip(Y, p0, prominences):
+            peaks = scipy_find_peaks(y)[0]
+            found = np.isfinite(prominence)
+            np.testing.assert_array_equal(p[found, 1], peaks)
+            np.testing.assert_allclose(prominence[found], peak_prominences(y, peaks)[0])
+            np.testing.assert_allclose(2.*p[found, 0], peak_widths(y, peaks)[0])
+
+    def test_stack(self):
+        prng = np.random.RandomState(1503)
+        Y = np.array([lorentz(self.params, self.x), lorentz(self.params[:2], self.x)])
+        Y += prng.normal(size=Y.shape)
+
+        p0 = find_peaks(Y, self.x, chunk_size=1)
+
+        self.assertEqual(p0.shape, (2, 3, 3))
+        np.testing.assert_allclose(p0[0, :, 1], self.params[:, 1], atol=0.5)
+        np.testing.assert_allclose(p0[1, :2, 1], self.params[:2, 1], atol=0.5)
+        self.assertTrue(np.all(np.isnan(p0[1, 2])))
+
+    def test_max_peaks(self):
+        p0 = find_peaks(self.y, self.x, max_peaks=2)
+
+        np.testing.assert_allclose(p0[:, 1], self.params[:2, 1], atol=0.5)
+
+    def test_baseline(self):
+        y = self.y + 0.5*self.x + 20.
+
+        p0 = find_peaks(y, self.x, baseline=True, lambda_=1.e7)
+
+        np.testing.assert_allclose(p0[:, 1], self.params[:, 1], atol=0.5)
+        np.testing.assert_allclose(p0[:, 2], self.params[:, 2], atol=5.)
+
+    def test_fit_from_guess(self):
+        prng = np.random.RandomState(1504)
+        Y = lorentz(self.params, self.x)*np.linspace(0.8, 1.2, 5)[:, None] + prng.normal(size=(5, 1000))
+
+        p0 = find_peaks(Y, self.x)
+        fitted, cov = fit_batch(lorentz, self.x, Y, p0)
+
+        np.testing.assert_allclose(fitted.reshape((5, 3, 3))[:, :, :2], np.broadcast_to(self.params[:, :2], (5, 3, 2)), rtol=0.05)
+
+    def test_unknown_shape(self):
+        with self.assertRaises(ValueError):
+            find_peaks(self.y, shape='nope')
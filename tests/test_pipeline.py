@@ -0,0 +1,132 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from spyctra import arPLS_batch, remove_cosmics, lorentz
+from spyctra.cube import SpectralCube
+from spyctra.pipeline import Pipeline
+
+
+def double(block):
+    block *= 2.
+    return block
+
+
+class Crash(Exception):
+    pass
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        prng = np.random.RandomState(1701)
+        self.x = np.linspace(0., 100., 300)
+        self.params = np.array([[2., 40., 100.], [3., 70., 40.]])
+        self.Y = lorentz(self.params, self.x)*np.linspace(0.5, 1.5, 40)[:, None] + 0.2*self.x + prng.normal(size=(40, 300))
+        self.Y[5, 100] += 5000.
+        self.Y[33, 200] += 3000.
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def pipeline(self):
+        return Pipeline().remove_cosmics().subtract_baseline(lambda_=1.e6).normalize()
+
+    def expected(self):
+        Y = remove_cosmics(self.Y, copy=True)
+        Y -= arPLS_batch(Y, lambda_=1.e6)
+        return Y / Y.max(axis=-1, keepdims=True)
+
+    def test_matches_steps(self):
+        result = self.pipeline().run(self.Y, chunk_size=16)
+
+        np.testing.assert_allclose(result, self.expected())
+
+    def test_source_unchanged(self):
+        Y = self.Y.copy()
+
+        self.pipeline().run(Y, chunk_size=16)
+
+        np.testing.assert_array_equal(Y, self.Y)
+
+    def test_fit(self):
+        pipeline = Pipeline().remove_cosmics().subtract_baseline(lambda_=1.e6).fit(lorentz, self.x, [2.5, 41., 80., 2.5, 69., 30.])
+
+        result = pipeline.run(self.Y, chunk_size=16)
+
+        self.assertEqual(result.shape, (40, 6))
+        np.testing.assert_allclose(result[:, [1, 4]], np.tile([40., 70.], (40, 1)), atol=0.3)
+
+    def test_generator_source(self):
+        spectra = (y for y in self.Y)
+
+        starts = [start for start, result in self.pipeline().stream(spectra, chunk_size=16)]
+
+        self.assertEqual(starts, [0, 16, 32])
+        np.testing.assert_allclose(self.pipeline().run(iter(np.split(self.Y, 8)), chunk_size=16), self.expected())
+
+    def test_fused(self):
+        pipeline = self.pipeline().map(double, fused=True).map(double, fused=True)
+
+        groups = pipeline._groups()
+
+        self.assertEqual(len(groups), 3)
+        self.assertEqual([stage.name for stage in groups[-1]], ['normalize', 'double', 'double_2'])
+        np.testing.assert_allclose(pipeline.run(self.Y, chunk_size=16), 4.*self.expected())
+
+    def test_timings(self):
+        pipeline = self.pipeline()
+
+        pipeline.run(self.Y, chunk_size=16)
+
+        for name in ('read', 'remove_cosmics', 'subtract_baseline', 'normalize', 'write'):
+            self.assertIn(name, pipeline.timings)
+            self.assertIn(name, pipeline.report())
+
+    def test_n_jobs(self):
+        for backend in ('process', 'thread'):
+            pipeline = self.pipeline()
+
+            result = pipeline.run(self.Y, chunk_size=8, n_jobs=2, backend=backend)
+
+            np.testing.assert_allclose(result, self.expected())
+            self.assertIn('subtract_baseline', pipeline.timings)
+
+    def test_cube(self):
+        cube = SpectralCube(self.Y.reshape((4, 10, 300)), self.x)
+
+        out = self.pipeline().run(cube, out=self.path('out.npy'), chunk_size=16)
+
+        np.testing.assert_allclose(np.load(self.path('out.npy')), self.expected())
+
+    def test_resume(self):
+        calls = []
+
+        def crash(block):
+            calls.append(len(block))
+            if len(calls) == 2:
+                raise Crash()
+            return block
+
+        checkpoint = self.path('checkpoint.json')
+        out = self.path('out.npy')
+        with self.assertRaises(Crash):
+            self.pipeline().map(crash).run(self.Y, out=out, chunk_size=16, checkpoint=checkpoint)
+        self.assertTrue(os.path.exists(checkpoint))
+
+        calls = [None, None]
+        self.pipeline().map(crash).run(self.Y, out=out, chunk_size=16, checkpoint=checkpoint)
+
+        # only the chunks after the first one are run again
+        self.assertEqual(calls[2:], [16, 8])
+        self.assertFalse(os.path.exists(checkpoint))
+        np.testing.assert_allclose(np.load(out), self.expected())
+
+    def test_unknown_normalize(self):
+        with self.assertRaises(ValueError):
+            Pipeline().normalize('nope')